@@ -0,0 +1,288 @@
+import atexit
+import os
+import sys
+import threading
+import time
+import metrics
+from binary_save import _sample_state
+from save_journal import journal_for, load_state, touch_room
+
+# Saving in the background.
+# The game autosaves every turn, and writing a save means waiting for the disk to confirm it (an fsync),
+# which can take tens of milliseconds on a slow disk. An Autosaver takes that wait off the game thread.
+# The game thread only works out what changed since the last save (the same diff the save journal writes,
+# already turned into JSON, so later changes to the game state can't leak into it) and hands it over.
+# A background thread appends it to the journal and compacts the journal into a new snapshot now and then
+# (written to a temporary file and renamed over the save).
+#
+# Saves that arrive while the thread is still writing wait in a queue, and the thread writes everything
+# that's waiting at once with a single fsync, so a slow disk never makes the queue grow without limit.
+# A new snapshot makes everything queued before it unnecessary, so that's skipped.
+#
+#   python autosave.py                check that a save survives the game being killed mid-write,
+#                                     then compare saving in the background with saving in the game thread
+#   python autosave.py --check 50     the durability check with 50 kills
+
+
+class Autosaver:
+    """Write saves on a background thread, so the game never waits for the disk."""
+
+    def __init__(self):
+        self.requested = 0  # Saves handed over, numbered from 1
+        self.written = 0    # Every save up to this number is on disk
+        self.attempted = 0  # Every save up to this number has been written, or failed to be
+        self.writes = 0     # Times a save file was written (once for each file in a batch)
+        self.coalesced = 0  # Saves written together with a later one instead of on their own
+        self.max_depth = 0  # Most saves waiting at once
+        self.error = None   # What went wrong writing, raised again on the next save or flush
+        self.latency = metrics.Histogram()  # Seconds each write took
+        self._pending = {}  # Save file -> [(number, save)] waiting to be written, in order
+        self._failed = set()  # Save files whose last write failed, so their next save is a snapshot
+        self._depth = 0
+        self._lock = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="autosave", daemon=True)
+        self._thread.start()
+        # Finish writing if the game exits without stopping the autosaver (after a crash, say)
+        atexit.register(self.stop)
+        return self
+
+    # Waits for the saves already handed over to be written, then stops the thread
+    def stop(self):
+        if self._thread is None:
+            return
+        with self._lock:
+            self._stopping = True
+            self._lock.notify_all()
+        self._thread.join()
+        self._thread = None
+        atexit.unregister(self.stop)
+        self._raise_error()
+
+    # Works out what changed since the last save to this file and queues it to be written.
+    # Returns the save's number (see written), or the last one if nothing changed
+    def save(self, filename, state):
+        """Queue a save of the game state."""
+        journal = journal_for(filename)
+        with self._lock:
+            failed = filename in self._failed
+            self._failed.discard(filename)
+        if failed:
+            # The journal already counts the changes that weren't written as saved, so start over from
+            # a snapshot of the whole state
+            journal.forget()
+        self._raise_error()
+        changes = journal.changes(state)
+        if changes is None:
+            save = ("snapshot", journal.snapshot(state))
+        elif changes[1]:
+            save = ("journal",) + changes
+        else:
+            return self.requested
+        with self._lock:
+            self.requested += 1
+            self._pending.setdefault(filename, []).append((self.requested, save))
+            self._depth += 1
+            self.max_depth = max(self.max_depth, self._depth)
+            self._lock.notify_all()
+            return self.requested
+
+    def flush(self):
+        """Wait until every save handed over so far is written, raising the error if one couldn't be."""
+        with self._lock:
+            target = self.requested
+            while self.attempted < target and self.error is None:
+                self._lock.wait()
+        self._raise_error()
+
+    def stats(self):
+        """Return the queue depth, writes, coalesced saves and write latency percentiles in seconds."""
+        with self._lock:
+            p50, p95, p99 = self.latency.percentiles()
+            return {"queue_depth": self._depth, "max_queue_depth": self.max_depth, "saves": self.requested,
+                    "written": self.written, "writes": self.writes, "coalesced": self.coalesced,
+                    "write_p50": p50, "write_p95": p95, "write_p99": p99}
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending and not self._stopping:
+                    self._lock.wait()
+                if not self._pending:
+                    return
+                pending, self._pending = self._pending, {}
+                self._depth = 0
+            # A file that fails to be written doesn't stop the others. Its saves don't count as written,
+            # and neither does any later save, since 'written' means every save up to it is on disk
+            failed = []
+            for filename, saves in pending.items():
+                try:
+                    self._write(filename, saves)
+                except Exception as error:
+                    failed.append((filename, saves[0][0], error))
+            with self._lock:
+                self.attempted = max(number for saves in pending.values() for number, _ in saves)
+                if failed:
+                    self._failed.update(filename for filename, _, _ in failed)
+                    self.error = self.error or failed[0][2]
+                    self.written = min(first for _, first, _ in failed) - 1
+                else:
+                    self.written = self.attempted
+                self._lock.notify_all()
+
+    # Writes one file's waiting saves: the last snapshot among them, if any, and every journal entry after it
+    def _write(self, filename, saves):
+        started = time.perf_counter()
+        journal = journal_for(filename)
+        coalesced = len(saves) - 1
+        for index in range(len(saves) - 1, -1, -1):
+            if saves[index][1][0] == "snapshot":
+                journal.compact(saves[index][1][1])
+                saves = saves[index + 1:]
+                break
+        if saves:
+            journal.append("".join(save[1] for _, save in saves), sum(save[2] for _, save in saves))
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.writes += 1
+            self.coalesced += coalesced
+            self.latency.observe(elapsed)
+        metrics.observe("save_write", elapsed)
+
+
+# Changes a game state (from binary_save._sample_state) for the checks below: save number n has
+# n gold and one more generated room for every 5 saves
+def _advance(state, number):
+    state["player"]["gold"] = number
+    if number % 5 == 0:
+        room_id = f"autosave_room_{number}"
+        state["locations"][room_id] = {"description": f"Room {number}", "visited": False, "connections": {}}
+        state["dynamic_rooms"][room_id] = state["locations"][room_id]
+        touch_room(state, room_id)
+
+
+# Run in a separate process by check(): saves every millisecond and prints the number of each save
+# as soon as it's on disk, until it's killed
+def _save_forever(filename):
+    journal_for(filename).compact_every = 25  # Compact often, so kills land in snapshot writes too
+    autosaver = Autosaver().start()
+    state = _sample_state(50)
+    reported = 0
+    number = 0
+    while True:
+        number += 1
+        _advance(state, number)
+        autosaver.save(filename, state)
+        if autosaver.written != reported:
+            reported = autosaver.written
+            print(reported, flush=True)
+        time.sleep(0.001)
+
+
+def check(kills=20, binary=False):
+    """Kill a process that's autosaving at random moments and check the last save it finished loads."""
+    import random
+    import subprocess
+    import tempfile
+
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as directory:
+        for kill in range(kills):
+            filename = os.path.join(directory, f"kill{kill}.{'bin' if binary else 'json'}")
+            saver = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--save-forever", filename],
+                                     stdout=subprocess.PIPE, text=True)
+            reports = rng.randint(1, 100)
+            written = 0
+            try:
+                for _ in range(reports):
+                    line = saver.stdout.readline()
+                    if not line:
+                        raise RuntimeError(f"The saving process exited early with code {saver.wait()}")
+                    written = int(line)
+            finally:
+                saver.kill()
+            # Anything it reported before dying was on disk too
+            for line in saver.stdout.read().split():
+                written = int(line)
+            saver.wait()
+
+            state = load_state(filename)
+            gold = state["player"]["gold"]
+            rooms = sum(1 for room_id in state["locations"] if room_id.startswith("autosave_room_"))
+            if gold < written:
+                raise AssertionError(f"Kill {kill}: save {written} was written, but the save loaded is {gold}")
+            if rooms != gold // 5:
+                raise AssertionError(f"Kill {kill}: save {gold} loaded with {rooms} rooms, not {gold // 5}")
+    print(f"Killed mid-save {kills} times: the last finished save always loaded "
+          f"({'binary' if binary else 'JSON'} saves)")
+
+
+# Times the save at the start of each turn as the game thread sees it: written there and then,
+# or handed to an autosaver. 'pause' is the time between turns (the player takes far longer), and
+# 'fsync_delay' is added to every fsync to stand in for a slower disk
+def benchmark(turns=300, rooms=2000, pause=0.01, fsync_delay=0.0):
+    """Print the time a turn spends saving, with and without the autosaver."""
+    import tempfile
+    import save_journal
+
+    sync = save_journal._sync
+    if fsync_delay:
+        save_journal._sync = lambda fd: (sync(fd), time.sleep(fsync_delay))
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            results = {}
+            for mode in ("in the game thread", "in the background"):
+                filename = os.path.join(directory, f"{len(results)}.json")
+                state = _sample_state(rooms)
+                journal_for(filename).save(state)  # A game that's been saved before
+                autosaver = Autosaver().start() if mode == "in the background" else None
+                times = metrics.Histogram()
+                for number in range(1, turns + 1):
+                    _advance(state, number)
+                    started = time.perf_counter()
+                    if autosaver is None:
+                        journal_for(filename).save(state)
+                    else:
+                        autosaver.save(filename, state)
+                    times.observe(time.perf_counter() - started)
+                    time.sleep(pause)
+                if autosaver is not None:
+                    autosaver.stop()
+                    stats = autosaver.stats()
+                if load_state(filename)["player"]["gold"] != turns:
+                    raise AssertionError(f"Saving {mode} lost saves")
+                results[mode] = times
+    finally:
+        save_journal._sync = sync
+
+    print(f"{turns} turns {pause * 1000:g} ms apart, saving a castle with {rooms:,} rooms"
+          + (f", {fsync_delay * 1000:g} ms slower fsync" if fsync_delay else ""))
+    print(f"{'saving':>20} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'total s':>8}")
+    for mode, times in results.items():
+        p50, p95, _ = times.percentiles()
+        print(f"{mode:>20} {p50 * 1000:>8.3f} {p95 * 1000:>8.3f} {max(times.samples) * 1000:>8.3f} {times.sum:>8.3f}")
+    print(f"Background writes: {stats['writes']} for {stats['saves']} saves ({stats['coalesced']} coalesced), "
+          f"most waiting {stats['max_queue_depth']}, write p50 {stats['write_p50'] * 1000:.3f} ms, "
+          f"p95 {stats['write_p95'] * 1000:.3f} ms\n")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--save-forever":
+        _save_forever(sys.argv[2])
+    elif len(sys.argv) == 3 and sys.argv[1] == "--check":
+        check(int(sys.argv[2]))
+        check(int(sys.argv[2]), binary=True)
+    else:
+        check()
+        check(binary=True)
+        benchmark()
+        benchmark(fsync_delay=0.02)           # A laptop hard disk
+        benchmark(pause=0, fsync_delay=0.02)  # Saves arriving faster than the disk can take them
@@ -0,0 +1,190 @@
+import argparse
+import random
+
+import numpy as np
+
+import game_loop
+from content import ENEMY_ATTACK, ENEMY_HP, LOOT, GameRNG, game_rng
+from inventory import Inventory
+from simulation import GreedyPolicy
+
+# Monte Carlo balance analysis for combat and loot.
+# This models the exact rules of game_loop.combat, spawn_enemy, roll_dice, generate_loot and level_up,
+# but plays millions of fights at once: every fight is one slot in a set of NumPy arrays, and each
+# round rolls the dice for all fights still going in one call.
+#
+# The player follows the same potion rule as simulation.GreedyPolicy: always attack, except drink a
+# potion (which ends the turn without the enemy attacking) when at or below the potion threshold.
+# cross_check() plays the same fights through the real combat function, so the two can't drift apart.
+
+# Enemy stats and loot chances come from the content tables the game itself draws from
+_LOOT = {entry["item"]: entry for entry in LOOT}
+
+PLAYER_ATTACK = 3            # Attack power of the player (it never changes when levelling up)
+POTION_HEAL = 10             # use_health_potion: heals up to 10 HP, never past max HP
+XP_PER_VICTORY = 10
+GOLD_DROP = (_LOOT["gold"]["chance"], *_LOOT["gold"]["amount"])  # 50% chance of 5 to 20 gold
+POTION_DROP = _LOOT["health_potion"]["chance"]                   # 30% chance of a health potion
+KEY_DROP = _LOOT["key"]["chance"]                                # 20% chance of a key
+
+
+# Max HP at a level: the player starts with 20 and gains 3 for every level after the first
+def max_hp_at_level(level):
+    return 20 + 3 * (level - 1)
+
+
+def simulate_fights(fights, level=1, potions=2, potion_threshold=8, enemy_attack=None, seed=0):
+    """Play many fights at once. Returns per-fight arrays of the results."""
+    rng = np.random.default_rng(seed)
+    max_hp = max_hp_at_level(level)
+    player_hp = np.full(fights, max_hp, dtype=np.int32)
+    potions_left = np.full(fights, potions, dtype=np.int32)
+    enemy_hp = rng.integers(ENEMY_HP[0], ENEMY_HP[1] + 1, fights, dtype=np.int32)
+    if enemy_attack is None:
+        attack = rng.integers(ENEMY_ATTACK[0], ENEMY_ATTACK[1] + 1, fights, dtype=np.int32)
+    else:
+        attack = np.full(fights, enemy_attack, dtype=np.int32)
+    damage_taken = np.zeros(fights, dtype=np.int32)
+    active = np.ones(fights, dtype=bool)
+
+    while active.any():
+        # Player's turn: drink a potion if hurt, otherwise attack
+        drink = active & (potions_left > 0) & (player_hp <= potion_threshold) & (player_hp < max_hp)
+        player_hp += np.where(drink, np.minimum(POTION_HEAL, max_hp - player_hp), 0)
+        potions_left -= drink
+        attacking = active & ~drink
+        enemy_hp -= np.where(attacking, rng.integers(1, 7, fights, dtype=np.int32) + PLAYER_ATTACK, 0)
+        active &= ~(attacking & (enemy_hp <= 0))
+
+        # Enemy's turn, only against players who attacked (drinking a potion skips it)
+        hitting = attacking & active
+        hit = np.where(hitting, rng.integers(1, 7, fights, dtype=np.int32) + attack, 0)
+        player_hp -= hit
+        damage_taken += hit
+        active &= ~(player_hp <= 0)
+
+    won = enemy_hp <= 0
+    gold = np.where(won & (rng.random(fights) < GOLD_DROP[0]),
+                    rng.integers(GOLD_DROP[1], GOLD_DROP[2] + 1, fights), 0)
+    potion_drops = won & (rng.random(fights) < POTION_DROP)
+    key_drops = won & (rng.random(fights) < KEY_DROP)
+    return {
+        "won": won,
+        "enemy_attack": attack,
+        "damage_taken": damage_taken,
+        "potions_used": potions - potions_left,
+        "gold": gold,
+        "potion_drops": potion_drops,
+        "key_drops": key_drops,
+    }
+
+
+# Averages the per-fight results into a summary
+def summarize(results, mask=None):
+    if mask is None:
+        mask = np.ones(len(results["won"]), dtype=bool)
+    count = int(mask.sum())
+    if count == 0:
+        return {"fights": 0}
+    return {
+        "fights": count,
+        "win_probability": float(results["won"][mask].mean()),
+        "damage_taken": float(results["damage_taken"][mask].mean()),
+        "potions_used": float(results["potions_used"][mask].mean()),
+        "gold": float(results["gold"][mask].mean()),
+        "potion_drops": float(results["potion_drops"][mask].mean()),
+        "key_drops": float(results["key_drops"][mask].mean()),
+        "xp": float(results["won"][mask].mean()) * XP_PER_VICTORY,
+    }
+
+
+def analyze(fights=1_000_000, levels=(1, 2, 3, 5), potions=2, potion_threshold=8, seed=0):
+    """Report combat outcomes per enemy archetype (attack power) and player level."""
+    report = []
+    for level in levels:
+        results = simulate_fights(fights, level, potions, potion_threshold, seed=seed + level)
+        for attack in range(ENEMY_ATTACK[0], ENEMY_ATTACK[1] + 1):
+            row = summarize(results, results["enemy_attack"] == attack)
+            report.append(dict(row, level=level, enemy_attack=attack))
+        report.append(dict(summarize(results), level=level, enemy_attack="any"))
+    return report
+
+
+# The greedy policy, counting the potions it drinks during combat
+class _CountingPolicy(GreedyPolicy):
+    drinks = 0
+
+    def answer(self, kind, prompt):
+        answer = super().answer(kind, prompt)
+        if kind == "combat_action" and answer == "2":
+            self.drinks += 1
+        return answer
+
+
+# Plays fights through the real combat function, with the same potion rule, for comparison
+def simulate_fights_scalar(fights, level=1, potions=2, seed=0):
+    results = {"won": [], "potions_used": [], "gold": []}
+    policy = _CountingPolicy(random.Random(seed))
+    token = game_loop.game_io.set(policy)
+    rng_token = game_rng.set(GameRNG(seed))
+    try:
+        for _ in range(fights):
+            player = game_loop.new_game_state()["player"]
+            player["level"] = level
+            player["max_hp"] = player["current_hp"] = max_hp_at_level(level)
+            player["max_xp"] = 50 * level
+            player["inventory"] = Inventory.from_saved({"health_potion": potions})  # Keeps no empty stack
+            policy.game_state = {"player": player}
+            policy.drinks = 0
+            enemy = None
+            while enemy is None:
+                enemy = game_loop.spawn_enemy()
+            won = game_loop.combat(player, enemy) == "victory"
+            results["won"].append(won)
+            results["potions_used"].append(policy.drinks)
+            results["gold"].append(player["gold"])
+    finally:
+        game_loop.game_io.reset(token)
+        game_rng.reset(rng_token)
+    return {key: np.array(values) for key, values in results.items()}
+
+
+def cross_check(fights=20_000, level=1, potions=2, seed=0, tolerance=4.0):
+    """Compare the vectorized model with the real combat function on seeded runs.
+
+    Returns both estimates and whether each statistic agrees within 'tolerance' standard errors.
+    """
+    scalar = simulate_fights_scalar(fights, level, potions, seed)
+    vector = simulate_fights(fights, level, potions, seed=seed)
+    checks = {}
+    for key in ("won", "potions_used", "gold"):
+        a = scalar[key].astype(float)
+        b = vector[key].astype(float)
+        error = np.sqrt(a.var() / len(a) + b.var() / len(b)) or 1e-9
+        checks[key] = {
+            "scalar": float(a.mean()),
+            "vector": float(b.mean()),
+            "agrees": bool(abs(a.mean() - b.mean()) <= tolerance * error),
+        }
+    return checks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Monte Carlo balance analysis for combat and loot.")
+    parser.add_argument("--fights", type=int, default=1_000_000, help="fights simulated per player level")
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 2, 3, 5])
+    parser.add_argument("--potions", type=int, default=2, help="potions the player starts each fight with")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--check", action="store_true", help="cross-check against the real combat function")
+    args = parser.parse_args()
+
+    if args.check:
+        for key, check in cross_check(seed=args.seed, potions=args.potions).items():
+            status = "ok" if check["agrees"] else "MISMATCH"
+            print(f"{key:>13}: combat() {check['scalar']:.4f}  vectorized {check['vector']:.4f}  {status}")
+    else:
+        print(f"{'level':>5} {'enemy atk':>9} {'win %':>7} {'damage':>7} {'potions':>8} {'gold':>6} "
+              f"{'potion drops':>12} {'key drops':>9}")
+        for row in analyze(args.fights, args.levels, args.potions, seed=args.seed):
+            print(f"{row['level']:>5} {row['enemy_attack']:>9} {row['win_probability']:>7.1%} {row['damage_taken']:>7.2f} "
+                  f"{row['potions_used']:>8.3f} {row['gold']:>6.2f} {row['potion_drops']:>12.3f} {row['key_drops']:>9.3f}")
@@ -0,0 +1,230 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from json.encoder import encode_basestring_ascii
+
+import game_loop
+from content import GameRNG, game_rng
+from stub_llm import StubLLM
+
+# Scripted and batch play.
+# Bots and scripts play the game by sending it one command per line, from a file or a pipe. Each prompt
+# the game asks is answered with the next line, and the commands go through the same play_turn and
+# command table (game_loop.COMMANDS) as the console game, so the game behaves exactly as it does for a
+# person typing. Nothing is written to the terminal line by line: output is collected in a buffer and
+# written in large pieces, either as the text a player would see or as JSON lines, one event per line:
+#   {"event": "turn", "turn": 1, "location": "forest", "hp": 20, "gold": 0}
+#   {"event": "say", "text": "You are in forest: A dark forest"}
+#   {"event": "ask", "prompt": "Enter a direction ...", "input": "north"}
+#   {"event": "end", "turns": 12, "outcome": "quit", "location": "village"}
+# When the commands run out the game stops where it is (outcome "end of input"), saved if there's a save file.
+#
+#   python batch.py commands.txt                         play through the commands in a file
+#   my_bot | python batch.py - --jsonl                   read them from a pipe and write JSON lines
+#   python batch.py commands.txt --save game.json        continue a saved game and save it at the end
+#   python batch.py commands.txt --stub-llm 0            describe rooms and merchants offline
+#   python batch.py - --flush                            for a bot that reads the output before each command
+#   python batch.py --benchmark                          compare turns per second with line-by-line output
+
+
+class EndOfCommands(EOFError):
+    """Raised when the game asks for input after the last command."""
+
+
+class BatchIO:
+    """Answer the game's prompts from a stream of commands and buffer what it writes."""
+
+    def __init__(self, commands, out=sys.stdout, buffer_size=1 << 16, flush_on_ask=False):
+        self.commands = iter(commands)    # Lines of input, read one per prompt
+        self.out = out
+        self.buffer_size = buffer_size    # Characters collected before they're written
+        self.flush_on_ask = flush_on_ask  # Write everything before reading a command (for bots that wait on the output)
+        self.inputs = 0                   # Prompts answered
+        self._buffer = []
+        self._buffered = 0
+
+    def ask(self, prompt):
+        self.asking(prompt)
+        if self.flush_on_ask:
+            self.flush()
+        line = next(self.commands, None)
+        if line is None:
+            raise EndOfCommands(prompt)
+        self.inputs += 1
+        command = line.rstrip("\r\n")
+        self.answered(prompt, command)
+        return command
+
+    # The prompt is written before the command is read, so a bot reading the output sees what it's asked,
+    # and the command after it, as they'd look typed at the console
+    def asking(self, prompt):
+        self._add(prompt)
+
+    def answered(self, prompt, command):
+        self._add(command + "\n")
+
+    def say(self, text=""):
+        self._add(text + "\n")
+
+    def write(self, text):
+        self._add(text)
+
+    # Turns starting and the game ending only show in JSON lines
+    def event(self, kind, **fields):
+        pass
+
+    def _add(self, text):
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.out.write("".join(self._buffer))
+        self.out.flush()
+        self._buffer.clear()
+        self._buffered = 0
+
+
+class JsonLinesIO(BatchIO):
+    """Like BatchIO, but write the game's output as JSON lines, one event per line."""
+
+    def __init__(self, commands, out=sys.stdout, buffer_size=1 << 16, flush_on_ask=False):
+        super().__init__(commands, out, buffer_size, flush_on_ask)
+        self._line = []  # Text written a piece at a time, until the line ends
+
+    # A bot waiting on the output is told what it's asked, and every prompt is written with its answer
+    def asking(self, prompt):
+        if self.flush_on_ask:
+            self.event("waiting", prompt=prompt)
+
+    def answered(self, prompt, command):
+        self.event("ask", prompt=prompt, input=command)
+
+    # Most events are lines of text, so those are written without building and encoding a dict
+    def say(self, text=""):
+        if self._line:
+            text = "".join(self._line) + text
+            self._line.clear()
+        self._add('{"event": "say", "text": ' + encode_basestring_ascii(text) + "}\n")
+
+    def write(self, text):
+        self._line.append(text)
+
+    def event(self, kind, **fields):
+        self._add(json.dumps(dict(event=kind, **fields)) + "\n")
+
+
+def run_batch(io, save_file=None, max_turns=None):
+    """Play one game with the given BatchIO. Returns the game state, the player's location, the turns and the outcome."""
+    game_state = game_loop.load_game(save_file) if save_file else game_loop.new_game_state()
+    current_location = game_state["current_location"]
+    token = game_loop.game_io.set(io)
+    turns = 0
+    outcome = None
+    try:
+        while outcome is None and (max_turns is None or turns < max_turns):
+            turns += 1
+            player = game_state["player"]
+            io.event("turn", turn=turns, location=current_location, hp=player.current_hp, gold=player.gold)
+            try:
+                current_location, outcome = game_loop.play_turn(game_state, current_location)
+            except EndOfCommands:
+                outcome = "end of input"
+        # A defeated game keeps its last save, like the console game
+        if save_file and outcome != "defeat":
+            game_loop.save_game(game_state, current_location, save_file)
+            if outcome == "quit":
+                io.say("Game saved. Goodbye!")
+        io.event("end", turns=turns, outcome=outcome or "stopped", location=current_location)
+    finally:
+        io.flush()
+        game_loop.game_io.reset(token)
+    return game_state, current_location, turns, outcome
+
+
+# Answers the prompts like ConsoleIO does at a terminal, where every line is written as it's printed
+class _LineByLineIO(BatchIO):
+    def _add(self, text):
+        self.out.write(text)
+
+
+# Commands a bot might send without looking at the prompts: mostly moves, and answers for fights,
+# encounters and merchants
+def _random_commands(count, seed=0):
+    rng = random.Random(seed)
+    choices = ["north", "south", "east", "west"] * 3 + ["fight", "fight", "flee", "1", "1", "2", "use",
+                                                          "yes", "no", "slice", "dodge", "exit", "stats", "i"]
+    return [rng.choice(choices) for _ in range(count)]
+
+
+def benchmark(commands=200_000, seed=0):
+    """Print turns per second playing from a command list, with line-by-line, buffered and JSON lines output."""
+    game_loop.llm_backend = StubLLM()
+    game_loop.stream_output = False
+    script = _random_commands(commands, seed)
+    print(f"Games played back to back through {commands:,} random commands, output to {os.devnull}")
+    print(f"{'output':>14} {'turns':>8} {'seconds':>8} {'turns/s':>10}")
+    for name, io_class in (("line by line", _LineByLineIO), ("buffered", BatchIO), ("JSON lines", JsonLinesIO)):
+        rng_token = game_rng.set(GameRNG(seed))
+        with open(os.devnull, "w", buffering=1) as out:  # Line buffered, like a terminal
+            io = io_class(script, out)
+            turns = 0
+            started = time.perf_counter()
+            outcome = None
+            while outcome != "end of input":
+                _, _, played, outcome = run_batch(io)
+                turns += played
+            elapsed = time.perf_counter() - started
+        game_rng.reset(rng_token)
+        print(f"{name:>14} {turns:>8,} {elapsed:>8.2f} {turns / elapsed:>10,.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play the game from a file or pipe of commands, one per line.")
+    parser.add_argument("commands", nargs="?", help="file of commands, or - to read them from standard input")
+    parser.add_argument("--jsonl", action="store_true", help="write the game's output as JSON lines")
+    parser.add_argument("--flush", action="store_true",
+                        help="write the output before reading each command, for bots that answer what they see")
+    parser.add_argument("--save", help="continue the game in this save file and save it at the end")
+    parser.add_argument("--seed", type=int, help="make the dice repeatable")
+    parser.add_argument("--max-turns", type=int, help="stop after this many turns")
+    parser.add_argument("--stub-llm", type=float, default=None, metavar="LATENCY",
+                        help="use the offline stub LLM with this many seconds of latency")
+    parser.add_argument("--room-context-tokens", type=int, default=150,
+                        help="tokens of context about the world around a new room in its prompt (0 for none)")
+    parser.add_argument("--benchmark", action="store_true", help="time random commands with each kind of output")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark()
+        sys.exit()
+    if not args.commands:
+        parser.error("a file of commands (or - for standard input) is needed")
+
+    # Descriptions are written whole, and the AI model services start when the game first needs them
+    game_loop.stream_output = False
+    game_loop.room_context_tokens = args.room_context_tokens
+    if args.stub_llm is not None:
+        game_loop.llm_backend = StubLLM(latency=args.stub_llm)
+    else:
+        game_loop.start_llm_services = game_loop.start_console_services
+    if args.seed is not None:
+        game_rng.set(GameRNG(args.seed))
+
+    commands = sys.stdin if args.commands == "-" else open(args.commands)
+    started = time.perf_counter()
+    try:
+        io = (JsonLinesIO if args.jsonl else BatchIO)(commands, sys.stdout, flush_on_ask=args.flush)
+        _, _, turns, outcome = run_batch(io, args.save, args.max_turns)
+    finally:
+        if commands is not sys.stdin:
+            commands.close()
+        for service in (game_loop.room_prefetcher, game_loop.merchant_pool, game_loop.llm_client):
+            if service is not None:
+                service.stop()
+    elapsed = time.perf_counter() - started
+    print(f"{turns} turns ({outcome or 'stopped'}) in {elapsed:.2f}s", file=sys.stderr)
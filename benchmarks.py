@@ -0,0 +1,331 @@
+import argparse
+import copy
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+import game_loop
+import save_journal
+import simulation
+from content import GameRNG, game_rng
+from inventory import Inventory
+
+# Benchmarks for the game's hot paths.
+# The real functions in game_loop.py are driven headlessly: a quiet player answers every prompt with
+# "attack" and throws the output away, and room descriptions come from the offline stub LLM, so nothing
+# here waits on a person or the network. Each benchmark is run a few times and the median time per
+# operation is kept.
+#
+# Results are written as JSON. Given a baseline (the JSON from an earlier run, say before a change to
+# game_loop.py or state_map.py), every benchmark is compared against it, and any that got slower by more
+# than the threshold is reported as a regression and makes the run exit with status 1.
+#
+#   python benchmarks.py                                       run everything, write benchmark_results.json
+#   python benchmarks.py --output before.json                  keep the results as a baseline
+#   python benchmarks.py --baseline before.json                compare with it (regressions over 25%)
+#   python benchmarks.py --baseline before.json --threshold 0.1
+#   python benchmarks.py --only save --sizes 10 1000           just the save and load benchmarks, small worlds
+
+SIZES = (10, 1_000, 10_000, 100_000)   # Generated rooms in the worlds the benchmarks play in
+INVENTORY_SIZES = (10, 1_000, 100_000)  # Different kinds of item the player carries
+THRESHOLD = 0.25                        # Slower than the baseline by more than this is a regression
+DIRECTIONS = ("north", "south", "east", "west")
+
+
+class QuietPlayer:
+    """Attack whenever asked, ignore the output and count the prompts answered."""
+
+    def __init__(self):
+        self.inputs = 0
+
+    def say(self, text=""):
+        pass
+
+    def write(self, text):
+        pass
+
+    def ask(self, prompt):
+        self.inputs += 1
+        return "1"
+
+
+# Picks a castle room with an exit that hasn't been explored yet, and that exit.
+# 'open_rooms' is a list of the rooms that may still have one, and rooms found to have none are dropped from it
+def _unexplored_exit(game_state, open_rooms, rng):
+    while True:
+        index = rng.randrange(len(open_rooms))
+        location = open_rooms[index]
+        connections = game_state["locations"][location].get("connections", {})
+        unexplored = [direction for direction in DIRECTIONS if direction not in connections]
+        if unexplored:
+            return location, rng.choice(unexplored)
+        open_rooms[index] = open_rooms[-1]
+        open_rooms.pop()
+
+
+# A new game whose castle has grown to 'rooms' generated rooms, each one generated off a random unexplored
+# exit of the rooms before it, like a player wandering around would. Returns the game state and the rooms
+# that still have unexplored exits
+def grow_world(rooms, seed=0):
+    rng = random.Random(seed)
+    game_state = game_loop.new_game_state()
+    open_rooms = ["castle"]
+    while len(game_state["dynamic_rooms"]) < rooms:
+        location, direction = _unexplored_exit(game_state, open_rooms, rng)
+        before = len(game_state["dynamic_rooms"])
+        room_id = game_loop.generate_dynamic_room(direction, location, game_state)
+        if len(game_state["dynamic_rooms"]) > before:
+            open_rooms.append(room_id)
+    return game_state, open_rooms
+
+
+# The grown worlds, kept so every benchmark of the same size plays in the same world
+_worlds = {}
+
+# The world with 'rooms' generated rooms. Benchmarks that generate more rooms ask for a copy, so the
+# world stays the same size for the rest. (Copies of a game state share its room graph, so the copy's
+# graph is left out and built again from its rooms)
+def world(rooms, copied=False):
+    if rooms not in _worlds:
+        _worlds[rooms] = grow_world(rooms)
+    if not copied:
+        return _worlds[rooms]
+    game_state, open_rooms = _worlds[rooms]
+    game_state = copy.deepcopy({key: value for key, value in game_state.items() if key != "_world"})
+    game_loop.world_for(game_state)
+    return game_state, list(open_rooms)
+
+
+# Moves the player along 'steps' already explored exits, from a random walk through the castle
+def bench_move_player(rooms, steps=20_000):
+    game_state, _ = world(rooms)
+    rng = random.Random(rooms)
+    walk = []
+    location = rng.choice(list(game_state["dynamic_rooms"]))
+    for _ in range(steps):
+        direction, neighbor = rng.choice(list(game_state["locations"][location]["connections"].items()))
+        walk.append((location, direction))
+        location = neighbor
+    started = time.perf_counter()
+    for location, direction in walk:
+        game_loop.move_player(location, direction, game_state)
+    return time.perf_counter() - started, steps
+
+
+# Generates rooms off unexplored exits of a world that already has 'rooms' rooms (an exit that leads
+# to a room generated before joins it instead, which is timed too)
+def bench_generate_dynamic_room(rooms, generated=1_000):
+    game_state, open_rooms = world(rooms, copied=True)
+    rng = random.Random(rooms)
+    elapsed = 0.0
+    for _ in range(generated):
+        location, direction = _unexplored_exit(game_state, open_rooms, rng)
+        before = len(game_state["dynamic_rooms"])
+        started = time.perf_counter()
+        room_id = game_loop.generate_dynamic_room(direction, location, game_state)
+        elapsed += time.perf_counter() - started
+        if len(game_state["dynamic_rooms"]) > before:
+            open_rooms.append(room_id)
+    return elapsed, generated
+
+
+# Fights fresh level 1 characters against spawned enemies. An operation is one of the player's turns
+def bench_combat(_, combats=2_000):
+    player = game_loop.game_io.get()
+    turns = player.inputs
+    fights = []
+    while len(fights) < combats:
+        enemy = game_loop.spawn_enemy()
+        if enemy is not None:
+            fights.append((game_loop.new_game_state()["player"], enemy))
+    started = time.perf_counter()
+    for fighter, enemy in fights:
+        game_loop.combat(fighter, enemy)
+    return time.perf_counter() - started, player.inputs - turns
+
+
+# A player carrying 'kinds' different items, and 'potions' health potions
+def _loaded_player(kinds, potions=0):
+    player = game_loop.new_game_state()["player"]
+    player.inventory = Inventory({f"trinket_{number}": 1 for number in range(kinds)})
+    if potions:
+        player.inventory.add("health_potion", potions)
+    return player
+
+
+# Rolls an enemy's loot and hands it to a player with a full inventory
+def bench_loot(kinds, drops=20_000):
+    player = _loaded_player(kinds)
+    started = time.perf_counter()
+    for _ in range(drops):
+        game_loop.handle_loot(player, game_loop.generate_loot())
+    return time.perf_counter() - started, drops
+
+
+# Heals a badly hurt player with a full inventory, one potion at a time
+def bench_use_health_potion(kinds, uses=20_000):
+    player = _loaded_player(kinds, potions=uses)
+    elapsed = 0.0
+    for _ in range(uses):
+        player.current_hp = 1
+        started = time.perf_counter()
+        game_loop.use_health_potion(player)
+        elapsed += time.perf_counter() - started
+    return elapsed, uses
+
+
+# A save file in a temporary directory. Its journal (which keeps a copy of the last save) is dropped
+# along with the directory, so a run doesn't hold on to every world it saved
+class _SaveFile:
+    def __enter__(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "game_state.json")
+        return self.filename
+
+    def __exit__(self, *exc_info):
+        save_journal._journals.pop(self.filename, None)
+        self.directory.cleanup()
+
+
+# Saves a world for the first time, which writes all of it
+def bench_save_game_first(rooms):
+    game_state, _ = world(rooms)
+    with _SaveFile() as filename:
+        started = time.perf_counter()
+        game_loop.save_game(game_state, game_state["current_location"], filename)
+        return time.perf_counter() - started, 1
+
+
+# Saves a world turn after turn, with the player's gold changing every turn and a room generated every
+# other turn, the way autosaves happen in play. Generating the rooms isn't timed
+def bench_save_game(rooms, saves=50):
+    game_state, open_rooms = world(rooms, copied=True)
+    rng = random.Random(rooms)
+    elapsed = 0.0
+    with _SaveFile() as filename:
+        game_loop.save_game(game_state, game_state["current_location"], filename)
+        for turn in range(saves):
+            game_state["player"].gold += 1
+            if turn % 2:
+                location, direction = _unexplored_exit(game_state, open_rooms, rng)
+                open_rooms.append(game_loop.generate_dynamic_room(direction, location, game_state))
+            started = time.perf_counter()
+            game_loop.save_game(game_state, game_state["current_location"], filename)
+            elapsed += time.perf_counter() - started
+    return elapsed, saves
+
+
+# Loads a saved world: a snapshot and a few turns of saved changes on top of it
+def bench_load_game(rooms):
+    game_state, _ = world(rooms)
+    loads = max(1, 2_000 // rooms)
+    with _SaveFile() as filename:
+        game_loop.save_game(game_state, game_state["current_location"], filename)
+        for _ in range(5):
+            game_state["player"].gold += 1
+            game_loop.save_game(game_state, game_state["current_location"], filename)
+        started = time.perf_counter()
+        for _ in range(loads):
+            game_loop.load_game(filename)
+        return time.perf_counter() - started, loads
+
+
+# Every benchmark, with the sizes it runs at (rooms in the world, or kinds of item carried)
+BENCHMARKS = {
+    "move_player": (bench_move_player, SIZES),
+    "generate_dynamic_room": (bench_generate_dynamic_room, SIZES),
+    "combat": (bench_combat, (None,)),
+    "loot": (bench_loot, INVENTORY_SIZES),
+    "use_health_potion": (bench_use_health_potion, INVENTORY_SIZES),
+    "save_game_first": (bench_save_game_first, SIZES),
+    "save_game": (bench_save_game, SIZES),
+    "load_game": (bench_load_game, SIZES),
+}
+
+
+# The name a result is stored under, like "move_player[rooms=1000]"
+def result_name(name, size):
+    if size is None:
+        return name
+    unit = "items" if name in ("loot", "use_health_potion") else "rooms"
+    return f"{name}[{unit}={size}]"
+
+
+def run(only=None, sizes=None, repeats=5, seed=0):
+    """Run the benchmarks and return their results, with the median time per operation of each."""
+    results = {}
+    _worlds.clear()
+    simulation._init_worker()  # Play offline, with the stub LLM
+    io_token = game_loop.game_io.set(QuietPlayer())
+    rng_token = game_rng.set(GameRNG(seed))
+    try:
+        for name, (benchmark, default_sizes) in BENCHMARKS.items():
+            if only and not any(part in name for part in only):
+                continue
+            for size in default_sizes:
+                if sizes and size is not None and name not in ("loot", "use_health_potion") and size not in sizes:
+                    continue
+                per_op = []
+                for _ in range(repeats):
+                    elapsed, ops = benchmark(size)
+                    per_op.append(elapsed / ops)
+                median = sorted(per_op)[len(per_op) // 2]
+                results[result_name(name, size)] = {"seconds_per_op": median, "ops_per_second": 1 / median,
+                                                     "ops": ops, "repeats": repeats}
+                print(f"{result_name(name, size):>38} {median * 1e6:>12.2f} µs/op {1 / median:>14,.0f} ops/s",
+                      flush=True)
+    finally:
+        game_loop.game_io.reset(io_token)
+        game_rng.reset(rng_token)
+        _worlds.clear()
+    return {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+            "platform": platform.platform(), "results": results}
+
+
+def compare(report, baseline, threshold=THRESHOLD):
+    """Print each benchmark's change from a baseline report and return the names of the regressions."""
+    regressions = []
+    print(f"\n{'benchmark':>38} {'baseline µs':>12} {'now µs':>12} {'change':>8}")
+    for name, result in report["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            print(f"{name:>38} {'-':>12} {result['seconds_per_op'] * 1e6:>12.2f}      new")
+            continue
+        change = result["seconds_per_op"] / before["seconds_per_op"] - 1
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print(f"{name:>38} {before['seconds_per_op'] * 1e6:>12.2f} {result['seconds_per_op'] * 1e6:>12.2f} "
+              f"{change:>+8.1%}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the game's hot paths.")
+    parser.add_argument("--output", default="benchmark_results.json", help="where to write the results as JSON")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="a benchmark slower than the baseline by more than this share is a regression")
+    parser.add_argument("--only", nargs="+", help="run just the benchmarks whose names contain one of these")
+    parser.add_argument("--sizes", nargs="+", type=int, help="world sizes in rooms (default: 10 to 100,000)")
+    parser.add_argument("--repeats", type=int, default=5, help="runs of each benchmark, the median is kept")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    report = run(args.only, args.sizes, args.repeats)
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
+    if baseline is not None:
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) more than {args.threshold:.0%} slower than {args.baseline}")
+            sys.exit(1)
+        print(f"\nNo benchmark more than {args.threshold:.0%} slower than {args.baseline}")
@@ -0,0 +1,202 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+from entities import to_json
+
+# A compact binary save format where room descriptions are only read when they're needed.
+#
+# Layout of a .bin save:
+#   magic b"DDGS", format version (u16), header length (u32)
+#   header: the game state as JSON, with every room description left out
+#   index: room count (u32), then an (offset u64, length u32) entry per room, in the header's room order
+#   records: the UTF-8 room descriptions
+#
+# Loading parses only the header (player stats and the room graph). The file stays memory-mapped and
+# each description is read from the map when the game asks for it, so startup time and memory don't
+# grow with the amount of text the player has explored.
+
+MAGIC = b"DDGS"
+FORMAT_VERSION = 1
+PREAMBLE = struct.Struct("<4sHI")
+INDEX_ENTRY = struct.Struct("<QI")
+COUNT = struct.Struct("<I")
+NO_DESCRIPTION = 0xFFFFFFFF  # Index length used for rooms whose description is None
+
+
+# Checks the first bytes of a file for the binary save magic
+def is_binary_save(filename):
+    try:
+        with open(filename, "rb") as file:
+            return file.read(len(MAGIC)) == MAGIC
+    except FileNotFoundError:
+        return False
+
+
+class DescriptionSource:
+    """Read room descriptions out of a memory-mapped binary save."""
+
+    def __init__(self, file_map, index_offset):
+        self.file_map = file_map
+        self.index_offset = index_offset
+
+    def read(self, index):
+        offset, length = INDEX_ENTRY.unpack_from(self.file_map, self.index_offset + COUNT.size + index * INDEX_ENTRY.size)
+        if length == NO_DESCRIPTION:
+            return None
+        return self.file_map[offset:offset + length].decode("utf-8")
+
+    # The memory map is shared, never copied, when a state holding lazy rooms is copied
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class LazyRoom(dict):
+    """A room whose description is read from the save file each time it's looked up."""
+
+    __slots__ = ("_source", "_index")
+
+    def __init__(self, fields, source, index):
+        super().__init__(fields)
+        self._source = source
+        self._index = index
+
+    # Only called when 'description' hasn't been set on the room, so a new description always wins.
+    # The text isn't kept in the room, so explored rooms don't stay in memory
+    def __missing__(self, key):
+        if key != "description":
+            raise KeyError(key)
+        return self._source.read(self._index)
+
+
+# Writes save data (see save_schema.to_save_data) as a binary save
+def write_binary(filename, data):
+    """Write save data to a binary save file."""
+    locations = data.get("locations", {})
+    header_data = dict(data)
+    header_data["locations"] = {
+        room_id: {field: value for field, value in dict.items(room) if field != "description"}
+        for room_id, room in locations.items()
+    }
+    header = json.dumps(header_data, separators=(",", ":"), default=to_json).encode("utf-8")
+    records = [None if room["description"] is None else room["description"].encode("utf-8")
+               for room in locations.values()]
+
+    index_offset = PREAMBLE.size + len(header)
+    offset = index_offset + COUNT.size + len(records) * INDEX_ENTRY.size
+    index = bytearray(COUNT.pack(len(records)))
+    for record in records:
+        if record is None:
+            index += INDEX_ENTRY.pack(offset, NO_DESCRIPTION)
+        else:
+            index += INDEX_ENTRY.pack(offset, len(record))
+            offset += len(record)
+
+    with open(filename, "wb") as file:
+        file.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+        file.write(header)
+        file.write(index)
+        for record in records:
+            if record is not None:
+                file.write(record)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+# Reads a binary save into the same data a JSON save file holds, with lazy room descriptions
+def read_binary(filename):
+    """Read save data from a binary save file."""
+    with open(filename, "rb") as file:
+        file_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, header_length = PREAMBLE.unpack_from(file_map, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{filename} is not a binary save file")
+    if version > FORMAT_VERSION:
+        raise ValueError(f"Binary save version {version} is newer than this game supports ({FORMAT_VERSION})")
+    data = json.loads(file_map[PREAMBLE.size:PREAMBLE.size + header_length])
+    source = DescriptionSource(file_map, PREAMBLE.size + header_length)
+    data["locations"] = {
+        room_id: LazyRoom(fields, source, index)
+        for index, (room_id, fields) in enumerate(data.get("locations", {}).items())
+    }
+    return data
+
+
+# Converts a save between the JSON and binary formats. The format written is picked by the
+# destination's extension (.bin for binary)
+def convert(source, destination):
+    """Convert a save file to the other format."""
+    from save_journal import journal_path, load_state, write_snapshot
+    write_snapshot(destination, load_state(source))
+    if os.path.exists(journal_path(destination)):
+        os.remove(journal_path(destination))
+
+
+# Builds a game state with the given number of generated castle rooms, for benchmarking
+def _sample_state(rooms):
+    description = ("A cold, echoing hall of cracked flagstones. Faded banners hang from the rafters and "
+                   "something skitters in the dark beyond the broken doorway. ") * 4
+    state = {
+        "player": {"current_hp": 20, "max_hp": 20, "current_xp": 0, "max_xp": 50, "level": 1,
+                   "attack_power": 3, "gold": 0, "inventory": {"health_potion": 2}},
+        "locations": {
+            "forest": {"description": "A dark forest", "visited": False},
+            "village": {"description": "A quiet village", "visited": False},
+            "castle": {"description": "An abandoned and run-down castle", "visited": False, "connections": {}},
+        },
+        "dynamic_rooms": {},
+        "current_location": "castle",
+    }
+    previous = "castle"
+    for number in range(1, rooms + 1):
+        room_id = f"room_{number}"
+        room = {"description": description, "visited": True, "connections": {"south": previous}}
+        state["locations"][previous]["connections"]["north"] = room_id
+        state["locations"][room_id] = room
+        state["dynamic_rooms"][room_id] = room
+        previous = room_id
+    return state
+
+
+# Compares how long JSON and binary saves take to load, and how much memory loading needs
+def benchmark(sizes=(100, 10_000, 100_000), directory="."):
+    """Print load time and peak memory for JSON and binary saves of growing worlds."""
+    import tracemalloc
+
+    from save_journal import load_state, write_snapshot
+    print(f"{'rooms':>8} {'format':>7} {'file size':>12} {'load (s)':>10} {'peak memory':>12}")
+    for rooms in sizes:
+        state = _sample_state(rooms)
+        for extension in ("json", "bin"):
+            filename = os.path.join(directory, f"bench_save_{rooms}.{extension}")
+            write_snapshot(filename, state)
+            started = time.perf_counter()
+            loaded = load_state(filename)
+            elapsed = time.perf_counter() - started
+            del loaded
+            # Memory is measured on a second load, since tracing allocations slows loading down
+            tracemalloc.start()
+            loaded = load_state(filename)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            del loaded
+            print(f"{rooms:>8} {extension:>7} {os.path.getsize(filename):>12,} {elapsed:>10.4f} {peak:>12,}")
+            os.remove(filename)
+
+
+if __name__ == "__main__":
+    # python binary_save.py convert game_state.json game_state.bin
+    # python binary_save.py bench
+    if len(sys.argv) == 4 and sys.argv[1] == "convert":
+        convert(sys.argv[2], sys.argv[3])
+        print(f"Converted {sys.argv[2]} to {sys.argv[3]}.")
+    elif len(sys.argv) == 2 and sys.argv[1] == "bench":
+        benchmark()
+    else:
+        print("Usage: python binary_save.py convert SOURCE DESTINATION | bench")
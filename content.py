@@ -0,0 +1,213 @@
+import contextvars
+import random
+import sys
+import threading
+import time
+
+# Game content tables and the random numbers that pick from them.
+#
+# The encounter, enemy and loot tables are plain data, compiled once when the module loads into alias
+# tables, so picking from a table of any size costs one random number and one comparison.
+#
+# All of the game's dice go through a GameRNG. Each game (a console game, a server session, a simulated
+# game) can set its own with game_rng.set(), seeded so the same seed and the same inputs always play out
+# the same way. Dice rolls are drawn in blocks, which is several times cheaper than one randint() per roll.
+
+# Random encounters: one is picked at random (equal weights) when an encounter happens
+ENCOUNTERS = [
+    ({"type": "locked_chest", "difficulty": "simple"}, 1),
+    ({"type": "falling_bookshelf", "difficulty": "simple"}, 1),
+    ({"type": "mysterious_puzzle", "difficulty": "challenging"}, 1),
+    ({"type": "traveling_merchant", "difficulty": "none"}, 1),
+]
+
+# Enemies that can spawn in a room, with the ranges their stats are rolled from
+ENEMY_SPAWN_CHANCE = 0.4
+ENEMIES = [
+    ({"name": "Knight Statue"}, 1),
+    ({"name": "Skeleton"}, 1),
+    ({"name": "Giant Rat"}, 1),
+    ({"name": "Ghost"}, 1),
+    ({"name": "Looter"}, 1),
+]
+ENEMY_HP = (10, 20)
+ENEMY_ATTACK = (2, 5)
+
+# Loot dropped by a defeated enemy. Each entry drops on its own with its chance, so an enemy can drop
+# several items or none. 'amount' is a fixed number or a (low, high) range
+LOOT = [
+    {"item": "gold", "amount": (5, 20), "chance": 0.5},
+    {"item": "health_potion", "amount": 1, "chance": 0.3},
+    {"item": "key", "amount": 1, "chance": 0.2},
+]
+
+
+class AliasTable:
+    """Pick weighted values in constant time (Vose's alias method)."""
+
+    def __init__(self, entries):
+        self.values = [value for value, _ in entries]
+        count = len(entries)
+        total = sum(weight for _, weight in entries)
+        scaled = [weight * count / total for _, weight in entries]
+        self.probability = [1.0] * count
+        self.alias = list(range(count))
+        small = [index for index, weight in enumerate(scaled) if weight < 1.0]
+        large = [index for index, weight in enumerate(scaled) if weight >= 1.0]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            (small if scaled[more] < 1.0 else large).append(more)
+
+    # One random number picks both the column and which of its two values to use
+    def sample(self, rng):
+        position = rng.random() * len(self.values)
+        column = int(position)
+        if position - column < self.probability[column]:
+            return self.values[column]
+        return self.values[self.alias[column]]
+
+
+# Every combination of loot drops with its probability, so one draw decides all of them
+def _loot_outcomes(loot):
+    outcomes = [((), 1.0)]
+    for entry in loot:
+        outcomes = [(drops + (entry,), weight * entry["chance"]) for drops, weight in outcomes] + \
+                   [(drops, weight * (1 - entry["chance"])) for drops, weight in outcomes]
+    return [(drops, weight) for drops, weight in outcomes if weight > 0]
+
+
+ENCOUNTER_TABLE = AliasTable(ENCOUNTERS)
+ENEMY_TABLE = AliasTable(ENEMIES)
+LOOT_TABLE = AliasTable(_loot_outcomes(LOOT))
+
+
+class GameRNG:
+    """The random numbers for one game, with dice rolls drawn in blocks."""
+
+    def __init__(self, seed=None, block=256, source=None):
+        self.source = source if source is not None else random.Random(seed)  # random.Random, or the random module
+        self.block = block       # Rolls drawn at a time for each kind of die
+        self._rolls = {}         # Sides -> rolls drawn but not used yet
+        self._faces = {}         # Sides -> [1, 2, ..., sides]
+
+    def random(self):
+        return self.source.random()
+
+    def chance(self, probability):
+        return self.source.random() < probability
+
+    # A roll of a die with 'sides' sides, from 1 to sides
+    def roll(self, sides):
+        rolls = self._rolls.get(sides)
+        if not rolls:
+            faces = self._faces.get(sides)
+            if faces is None:
+                faces = self._faces[sides] = list(range(1, sides + 1))
+            rolls = self._rolls[sides] = self.source.choices(faces, k=self.block)
+        return rolls.pop()
+
+    def randint(self, low, high):
+        return low - 1 + self.roll(high - low + 1)
+
+    def choice(self, values):
+        return values[int(self.source.random() * len(values))]
+
+
+class _SharedGameRNG(GameRNG):
+    """The default GameRNG, shared by every thread that hasn't set its own, so rolls are drawn under a lock."""
+
+    def __init__(self):
+        super().__init__(source=random)
+        self._lock = threading.Lock()
+
+    # Two threads refilling or popping the same block at once could pop from an empty list
+    def roll(self, sides):
+        with self._lock:
+            return super().roll(sides)
+
+
+# The RNG used by the current game. The default uses the random module, like the game always has.
+# Threads that don't set their own (background generators, autosave, other callers' threads) share it
+game_rng = contextvars.ContextVar("game_rng", default=_SharedGameRNG())
+
+
+def draw_encounter(rng):
+    return ENCOUNTER_TABLE.sample(rng)
+
+
+# A new enemy, or None if nothing spawns
+def draw_enemy(rng):
+    if not rng.chance(ENEMY_SPAWN_CHANCE):
+        return None
+    return ENEMY_TABLE.sample(rng)["name"], rng.randint(*ENEMY_HP), rng.randint(*ENEMY_ATTACK)
+
+
+# The loot an enemy drops, as a list of {"item", "amount"}
+def draw_loot(rng):
+    return [{"item": entry["item"],
+             "amount": rng.randint(*entry["amount"]) if isinstance(entry["amount"], tuple) else entry["amount"]}
+            for entry in LOOT_TABLE.sample(rng)]
+
+
+# The randomness of a busy turn the way the game used to do it: tables rebuilt on every call and
+# every number drawn from the random module
+def _old_turn():
+    random.random()
+    if random.random() < 0.4:
+        random.choice(["Knight Statue", "Skeleton", "Giant Rat", "Ghost", "Looter"])
+        random.randint(10, 20)
+        random.randint(2, 5)
+    random.choice([
+        {"type": "locked_chest", "difficulty": "simple"},
+        {"type": "falling_bookshelf", "difficulty": "simple"},
+        {"type": "mysterious_puzzle", "difficulty": "challenging"},
+        {"type": "traveling_merchant", "difficulty": "none"},
+    ])
+    random.randint(1, 10)
+    for _ in range(4):
+        random.randint(1, 6)
+    loot_table = [
+        {"item": "gold", "amount": random.randint(5, 20), "chance": 0.5},
+        {"item": "health_potion", "amount": 1, "chance": 0.3},
+        {"item": "key", "amount": 1, "chance": 0.2},
+    ]
+    [{"item": loot["item"], "amount": loot["amount"]} for loot in loot_table if random.random() < loot["chance"]]
+
+
+def _new_turn(rng):
+    rng.random()
+    draw_enemy(rng)
+    draw_encounter(rng)
+    rng.roll(10)
+    for _ in range(4):
+        rng.roll(6)
+    draw_loot(rng)
+
+
+def benchmark(turns=200_000, seed=0):
+    """Print the cost of one turn's worth of random numbers, before and after the content tables."""
+    random.seed(seed)
+    started = time.perf_counter()
+    for _ in range(turns):
+        _old_turn()
+    old = (time.perf_counter() - started) / turns
+    rng = GameRNG(seed)
+    started = time.perf_counter()
+    for _ in range(turns):
+        _new_turn(rng)
+    new = (time.perf_counter() - started) / turns
+    print(f"Random numbers per turn: random module {old * 1e6:.2f} µs, content tables {new * 1e6:.2f} µs "
+          f"({old / new:.1f}x faster)")
+
+    # The same seed always gives the same game
+    first, second = GameRNG(seed), GameRNG(seed)
+    same = all(draw_loot(first) == draw_loot(second) and first.roll(6) == second.roll(6) for _ in range(10_000))
+    print(f"Same seed, same draws: {same}")
+
+
+if __name__ == "__main__":
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
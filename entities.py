@@ -0,0 +1,196 @@
+import random
+import sys
+import timeit
+import tracemalloc
+from copy import copy
+
+from inventory import Inventory
+
+# Typed game entities.
+# The player and enemies used to be plain dicts. These classes hold the same fields in __slots__, which
+# takes far less memory per object than a dict and makes attribute access faster in combat. They still
+# support the old string-key access (player["gold"]), so saves, policies and older code keep working, and
+# they turn into the same JSON as before, so existing save files load unchanged.
+#
+# Dirty tracking is done by comparing against the values from the last mark_clean(), so writing a field
+# costs nothing extra and dirty_fields() lists what changed since then.
+
+
+class Entity:
+    """Base class for slotted entities with dict-style access."""
+
+    __slots__ = ("_clean",)
+    FIELDS = ()   # Field names, in the order they're saved
+    TYPES = {}    # Field name -> type its value must have
+
+    def __init__(self, **fields):
+        for name in self.FIELDS:
+            setattr(self, name, fields[name])
+        self._clean = None
+
+    # Builds an entity from saved data, checking every field
+    @classmethod
+    def from_dict(cls, data):
+        """Create an entity from a dict, validating its fields."""
+        unknown = set(data) - set(cls.FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown {cls.__name__} field(s): {', '.join(sorted(unknown))}")
+        missing = set(cls.FIELDS) - set(data)
+        if missing:
+            raise ValueError(f"Missing {cls.__name__} field(s): {', '.join(sorted(missing))}")
+        for name, value in data.items():
+            cls.validate(name, value)
+        return cls(**data)
+
+    @classmethod
+    def validate(cls, name, value):
+        expected = cls.TYPES[name]
+        # bool is an int subclass, but True isn't a valid HP
+        if not isinstance(value, expected) or (expected is int and isinstance(value, bool)):
+            raise ValueError(f"{cls.__name__}.{name} must be {expected.__name__}, not {type(value).__name__}")
+
+    def to_dict(self):
+        """Return the entity as a plain dict, the way it's saved."""
+        return {name: self._copy(getattr(self, name)) for name in self.FIELDS}
+
+    @staticmethod
+    def _copy(value):
+        return copy(value) if isinstance(value, (list, dict)) else value
+
+    # Dict-style access, for code and saves that use string keys
+    def __getitem__(self, name):
+        if name not in self.TYPES:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        if name not in self.TYPES:
+            raise KeyError(name)
+        self.validate(name, value)
+        setattr(self, name, value)
+
+    def __contains__(self, name):
+        return name in self.TYPES
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def get(self, name, default=None):
+        return getattr(self, name) if name in self.TYPES else default
+
+    # Every field always has a value, so there's never a default to set
+    def setdefault(self, name, default=None):
+        return self[name]
+
+    def keys(self):
+        return list(self.FIELDS)
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in self.FIELDS]
+
+    def __eq__(self, other):
+        if isinstance(other, Entity):
+            return type(self) is type(other) and self.items() == other.items()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.FIELDS)
+        return f"{type(self).__name__}({fields})"
+
+    # Copies keep the fields and the dirty tracking
+    def __copy__(self):
+        entity = type(self)(**self.to_dict())
+        entity._clean = self._clean
+        return entity
+
+    def __deepcopy__(self, memo):
+        return self.__copy__()
+
+    # Dirty tracking: remembers the current values, so later changes show up in dirty_fields()
+    def mark_clean(self):
+        self._clean = tuple(self._copy(getattr(self, name)) for name in self.FIELDS)
+
+    def dirty_fields(self):
+        """List the fields changed since mark_clean() (every field if it was never called)."""
+        if self._clean is None:
+            return list(self.FIELDS)
+        return [name for name, clean in zip(self.FIELDS, self._clean) if getattr(self, name) != clean]
+
+
+class Player(Entity):
+    """The player's stats and inventory."""
+
+    __slots__ = ("current_hp", "max_hp", "current_xp", "max_xp", "level", "attack_power", "gold", "inventory")
+    FIELDS = __slots__
+    TYPES = {"current_hp": int, "max_hp": int, "current_xp": int, "max_xp": int, "level": int,
+             "attack_power": int, "gold": int, "inventory": Inventory}
+
+    # Saved inventories are plain JSON: a count mapping, or a list of items in older saves
+    @classmethod
+    def from_dict(cls, data):
+        if "inventory" in data and not isinstance(data["inventory"], Inventory):
+            data = dict(data, inventory=Inventory.from_saved(data["inventory"]))
+        return super().from_dict(data)
+
+
+class Enemy(Entity):
+    """An enemy the player can fight or flee from."""
+
+    __slots__ = ("name", "hp", "attack_power")
+    FIELDS = __slots__
+    TYPES = {"name": str, "hp": int, "attack_power": int}
+
+
+# The json.dump 'default' for saves: entities are written as the plain dicts they replaced
+def to_json(value):
+    if isinstance(value, Entity):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+# Measures the memory of many players and enemies as dicts and as entities
+def benchmark(sessions=50_000, seed=0):
+    """Print the memory used by player and enemy state as dicts and as slotted entities."""
+    rng = random.Random(seed)
+    rows = []
+    for _ in range(sessions):
+        player = {"current_hp": rng.randint(1, 20), "max_hp": 20, "current_xp": rng.randint(0, 49), "max_xp": 50,
+                  "level": 1, "attack_power": 3, "gold": rng.randint(0, 300), "inventory": {"health_potion": 2}}
+        enemy = {"name": "Skeleton", "hp": rng.randint(10, 20), "attack_power": rng.randint(2, 5)}
+        rows.append((player, enemy))
+
+    results = {}
+    for kind in ("dict", "entity"):
+        tracemalloc.start()
+        if kind == "dict":
+            state = [({**player, "inventory": dict(player["inventory"])}, dict(enemy)) for player, enemy in rows]
+        else:
+            state = [(Player.from_dict(player), Enemy.from_dict(enemy))
+                     for player, enemy in rows]
+        results[kind] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del state
+
+    print(f"{sessions:,} sessions (one player and one enemy each)")
+    for kind, memory in results.items():
+        print(f"{kind:>7}: {memory / 1e6:7.2f} MB ({memory / sessions:.0f} bytes per session)")
+    print(f"Saved: {1 - results['entity'] / results['dict']:.0%}")
+
+    # The hot path in combat: read and update HP
+    player_dict = dict(rows[0][0])
+    player = Player.from_dict(dict(rows[0][0]))
+    dict_time = timeit.timeit("p['current_hp'] -= 1; p['current_hp'] += 1", globals={"p": player_dict}, number=1_000_000)
+    entity_time = timeit.timeit("p.current_hp -= 1; p.current_hp += 1", globals={"p": player}, number=1_000_000)
+    print(f"HP update: dict {dict_time * 1000:.0f} ns, entity {entity_time * 1000:.0f} ns")
+
+
+if __name__ == "__main__":
+    # python entities.py [sessions]
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 50_000)
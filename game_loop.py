@@ -1,59 +1,202 @@
-import openai
 import os
-import json
-import random
-from dotenv import load_dotenv
+import time
+import contextvars
+from functools import partial
+from save_journal import journal_for, touch_room
+from llm_client import PRIORITY_INTERACTIVE, PRIORITY_PREFETCH, estimate_tokens
+from llm_stream import StreamStats, delta_text, timed
+from world_graph import WorldGraph, NO_ROOM
+from world_memory import WorldMemory, ENCOUNTER_EVENTS
+from entities import Player, Enemy
+from inventory import Inventory, ITEMS
+from content import GameRNG, game_rng, draw_encounter, draw_enemy, draw_loot
+import metrics
 
 # This is a test comment
 
-# Load environment variables from the .env file
-load_dotenv()
+# The openai package, the .env file and the AI model services (client, cache, room prefetcher, merchant pool)
+# are only loaded when the game first needs to generate text. Importing them takes most of the game's
+# startup time, and a game resumed in the forest, the village or a castle room it has already explored,
+# or a tool that only needs the game rules, may never generate anything
+_openai = None
 
-# Access the OpenAI API key
-openai.api_key = os.getenv("OPENAI_API_KEY")
+# Load environment variables from the .env file, the first time they're needed
+_environment_loaded = False
+
+def load_environment():
+    global _environment_loaded
+    if not _environment_loaded:
+        from dotenv import load_dotenv
+        load_dotenv()
+        _environment_loaded = True
+
+# The openai package, imported and given the API key the first time the game calls the API
+def openai_api():
+    global _openai
+    if _openai is None:
+        load_environment()
+        import openai
+        # Access the OpenAI API key
+        openai.api_key = os.getenv("OPENAI_API_KEY")
+        _openai = openai
+    return _openai
+
+# Starts the AI model services the first time the game needs them (set by the console game).
+# None when there's nothing to start
+start_llm_services = None
+
+def llm_services():
+    """Start the AI model services if they're set to start and haven't yet."""
+    global start_llm_services
+    if start_llm_services is not None:
+        start, start_llm_services = start_llm_services, None
+        start()
+
+# Where chat completions are sent. None uses the OpenAI API; any object with the same
+# create(model=..., messages=...) method (like stub_llm.StubLLM) can be swapped in to play offline
+llm_backend = None
+
+# Shared client that queues, rate limits, deduplicates and retries requests to the AI model.
+# Left as None, each prompt calls the backend directly on the calling thread
+llm_client = None
+
+# On-disk cache of AI model responses, so identical prompts don't pay for a new completion every time.
+# Left as None, every prompt is sent to the AI model
+llm_cache = None
+
+# Background generator that describes unexplored castle rooms before the player walks into them.
+# Left as None, every room is generated on demand when the player moves
+room_prefetcher = None
+
+# Merchant descriptions generated ahead of time in batches.
+# Left as None, each merchant is described on demand when they appear
+merchant_pool = None
+
+# Whether room and merchant descriptions generated on demand are shown word by word as the AI model
+# writes them, instead of all at once when the whole description is ready
+stream_output = False
+
+# Time to first token and total time of every streamed description
+stream_stats = StreamStats()
+
+# Records the session's seed, inputs and AI responses to a log that replay.py can play back.
+# Left as None, nothing is recorded
+replay_log = None
+
+# Writes saves on a background thread (see autosave.py), so a turn never waits for the disk.
+# Left as None, each save is written before save_game returns
+autosaver = None
+
+# Keeps saves in slots of a SQLite database (see sqlite_store.py) instead of files, with the save file
+# name as the slot. Left as None, each save is a file
+save_store = None
+
+# Castle rooms and merchants generated ahead of time (see world_pack.py). Rooms at positions the pack
+# covers and the pack's merchants are served from it; everything else is generated by the AI model.
+# Left as None, everything is generated by the AI model
+world_pack = None
+
+# Tokens of context about the world around a new room (the rooms near it, the player and what happened
+# lately, from world_memory.py) added to each room prompt. 0 leaves it out and describes every room on its own
+room_context_tokens = 0
+
+# Where the game reads the player's input and writes its output. This is the console by default, but
+# scripted players and simulations can swap in any object with the same ask/say methods
+class ConsoleIO:
+    def ask(self, prompt):
+        return input(prompt)
+
+    def say(self, text=""):
+        print(text)
+
+    def write(self, text):
+        print(text, end="", flush=True)
+
+# The input/output used by the current game. Each thread or task can set its own
+game_io = contextvars.ContextVar("game_io", default=ConsoleIO())
+
+# Writes a line of game output
+def say(text=""):
+    game_io.get().say(text)
+
+# Writes part of a line of game output, for text that arrives a piece at a time
+def write(text):
+    game_io.get().write(text)
+
+# Asks the player for input
+def ask(prompt):
+    with metrics.phase("input"):
+        return game_io.get().ask(prompt)
 
 # Load or initialize the game state
 def load_game(filename="game_state.json"):
     # Try catch block to check if a loaded save is on the computer
     try:
         # If there is a file, it will load the attributes of the player object
-        with open(filename, "r") as file:
-            state = json.load(file)
-            # Checks if there is a current location in the loaded game file
-            if "current_location" not in state:
-                state["current_location"] = "forest"  # Default to forest if missing
-            return state
+        # (the last full snapshot plus the changes saved since then)
+        with metrics.phase("load"):
+            if save_store is not None:
+                state = save_store.load(filename)
+                if state is None:
+                    raise FileNotFoundError(filename)  # An empty slot starts a new game, like a missing file
+            else:
+                if autosaver is not None:
+                    autosaver.flush()  # Saves still being written are part of the file
+                state = journal_for(filename).load()
+            return state_from_save(state)
     # If there is no game file, it will generate a new save
     except FileNotFoundError:
-        return {
-            "player": {
-                "current_hp": 20,                               # The current HP of the player
-                "max_hp": 20,                                   # The max HP of the player, cannot go past this
-                "current_xp": 0,                                # The current xp of the player for defeating enemies, bypassing encounters, etc.
-                "max_xp": 50,                                   # The xp needed before the player reaches the next level
-                "level": 1,                                     # The current level of the player. Will increae by 3 hp foe each level gainedd
-                "attack_power": 3,                              # The base attack power of the player
-                "gold": 0,                                      # The amount of gold the player has
-                "inventory": ["health_potion", "health_potion"] # The inventory of the player. Will hold items here and be discarded when they're used
-            },
-            # All the hard-coded locations. Was originally meant to be the tutorial section for the player, but was never fully implemented
-            "locations": {
-                "forest": {"description": "A dark forest", "visited": False},
-                "village": {"description": "A quiet village", "visited": False},
-                "castle": {"description": "An abandoned and run-down castle", "visited": False},
-            },
-            # Dynamic rooms the AI model will generate
-            "dynamic_rooms": {},
-            "current_location": "forest",  # Default starting location
+        return new_game_state()
 
-        }
+# Finishes a game state read from a save (or a replay log) so it can be played
+def state_from_save(state):
+    # Checks if there is a current location in the loaded game file
+    if "current_location" not in state:
+        state["current_location"] = "forest"  # Default to forest if missing
+    # Saves hold the player and enemies as plain dicts
+    state["player"] = Player.from_dict(state["player"])
+    for room in state["locations"].values():
+        if isinstance(room.get("enemy"), dict):
+            room["enemy"] = Enemy.from_dict(room["enemy"])
+    return state
+
+# The state of a brand new game
+def new_game_state():
+    return {
+        "player": Player(
+            current_hp=20,                                  # The current HP of the player
+            max_hp=20,                                      # The max HP of the player, cannot go past this
+            current_xp=0,                                   # The current xp of the player for defeating enemies, bypassing encounters, etc.
+            max_xp=50,                                      # The xp needed before the player reaches the next level
+            level=1,                                        # The current level of the player. Will increae by 3 hp foe each level gainedd
+            attack_power=3,                                 # The base attack power of the player
+            gold=0,                                         # The amount of gold the player has
+            inventory=Inventory({"health_potion": 2}),      # The inventory of the player: how many of each item they're carrying
+        ),
+        # All the hard-coded locations. Was originally meant to be the tutorial section for the player, but was never fully implemented
+        "locations": {
+            "forest": {"description": "A dark forest", "visited": False},
+            "village": {"description": "A quiet village", "visited": False},
+            "castle": {"description": "An abandoned and run-down castle", "visited": False},
+        },
+        # Dynamic rooms the AI model will generate
+        "dynamic_rooms": {},
+        "current_location": "forest",  # Default starting location
+
+    }
 
 # Save the game state
+# Only the changes since the last save are written, so saving every turn stays cheap
 def save_game(state, current_location, filename="game_state.json"):
     """Save the current game state, including the player's current location."""
     state["current_location"] = current_location
-    with open(filename, "w") as file:
-        json.dump(state, file)
+    with metrics.phase("save"):
+        if save_store is not None:
+            save_store.save(filename, state)
+        elif autosaver is not None:
+            autosaver.save(filename, state)
+        else:
+            journal_for(filename).save(state)
 
 
 # Map of the hard-coded location
@@ -63,23 +206,185 @@ game_map = {
     "castle": {"west": "village"}
 }
 
+# The graph of the castle's rooms, built the first time it's needed after a game is started or loaded.
+# It's kept in the game state under a '_' key, which saves leave out
+def world_for(game_state):
+    world = game_state.get("_world")
+    if world is None:
+        # Building the graph gives rooms without a position (the castle, rooms from older saves) one
+        unplaced = [room_id for room_id, room in game_state["locations"].items()
+                    if is_castle_room(room_id) and "position" not in room]
+        world = game_state["_world"] = WorldGraph.from_locations(game_state["locations"], is_castle_room)
+        for room_id in unplaced:
+            touch_room(game_state, room_id)
+    return world
+
+# The game's world memory for room prompts, kept in the game state under a '_' key like the room graph
+def memory_for(game_state):
+    memory = game_state.get("_memory")
+    if memory is None:
+        memory = game_state["_memory"] = WorldMemory(room_context_tokens)
+    return memory
+
+# Notes something that happened for later room prompts to mention
+def remember(game_state, event):
+    if room_context_tokens:
+        memory_for(game_state).record(event)
+
+# The context for the room behind an exit, or "" when room prompts leave it out
+def room_context(game_state, current_location, direction):
+    if not room_context_tokens:
+        return ""
+    return memory_for(game_state).context(game_state, world_for(game_state), current_location, direction)
+
 # Move the player
 def move_player(current_location, direction, game_state):
+    # Castle rooms: follow the exit if it's been explored, otherwise generate a new room
+    world = world_for(game_state)
+    room = world.id_of(current_location)
+    if room is not None:
+        neighbor = world.neighbor(room, direction)
+        if neighbor != NO_ROOM:
+            return world.name_of(neighbor)  # Move to the already connected room
+        return generate_dynamic_room(direction, current_location, game_state)
+
     if "connections" in game_state["locations"][current_location]:
         connections = game_state["locations"][current_location]["connections"]
         if direction in connections:
             return connections[direction]  # Move to the already connected room
 
-    # Otherwise, generate a new room
-    if current_location == "castle" or current_location.startswith("room"):
-        return generate_dynamic_room(direction, current_location, game_state)
-
     # Handle movement between hardcoded locations
-    elif direction in game_map.get(current_location, {}):
+    if direction in game_map.get(current_location, {}):
         return game_map[current_location][direction]
 
     return current_location  # Invalid move
 
+# The castle and every room generated from it lead to new AI generated rooms
+def is_castle_room(location):
+    return location == "castle" or location.startswith("room")
+
+# The chat messages for a prompt to the AI model
+def dungeon_master_messages(prompt):
+    return [{"role": "system", "content": "You are a creative Dungeon Master."},
+            {"role": "user", "content": prompt}]
+
+# Sends a prompt to the AI model and returns the text of its reply.
+# The priority only matters with the shared client: background generation passes PRIORITY_PREFETCH
+# so anything the player is waiting on is sent first
+def chat_completion(prompt, model="gpt-3.5-turbo", priority=PRIORITY_INTERACTIVE):
+    """Ask the AI model to respond to a prompt as the Dungeon Master."""
+    messages = dungeon_master_messages(prompt)
+    llm_services()
+    # Reuse a stored response for the same prompt if there is one
+    with metrics.phase("llm" if priority != PRIORITY_PREFETCH else "llm_prefetch"):
+        content = llm_cache.get(model, messages) if llm_cache is not None else None
+        if content is None:
+            if llm_client is not None:
+                content = llm_client.complete(model, messages, priority)
+            else:
+                backend = llm_backend if llm_backend is not None else openai_api().ChatCompletion
+                response = backend.create(model=model, messages=messages)
+                content = response["choices"][0]["message"]["content"].strip()
+            if llm_cache is not None:
+                llm_cache.put(model, messages, content)
+            count_llm_call(messages, content)
+        else:
+            metrics.count("llm_cache_hits")
+    # Responses generated ahead of time are logged when the game uses them, not here
+    if replay_log is not None and priority != PRIORITY_PREFETCH:
+        replay_log.llm(prompt, content)
+    return content
+
+# Streams the AI model's response to a prompt, yielding the text a piece at a time as it's generated.
+# A cached response is replayed in one piece right away, and the finished text is added to the cache
+def stream_completion(prompt, model="gpt-3.5-turbo", priority=PRIORITY_INTERACTIVE):
+    """Ask the AI model to respond to a prompt, yielding the response as it arrives."""
+    messages = dungeon_master_messages(prompt)
+    llm_services()
+    started = time.perf_counter()
+    cached = llm_cache.get(model, messages) if llm_cache is not None else None
+    if cached is not None:
+        yield from timed([cached], stream_stats, started, cached=True)
+        content = [cached]
+        metrics.count("llm_cache_hits")
+    else:
+        if llm_client is not None:
+            pieces = llm_client.stream(model, messages)
+        else:
+            backend = llm_backend if llm_backend is not None else openai_api().ChatCompletion
+            pieces = delta_text(backend.create(model=model, messages=messages, stream=True))
+        content = []
+        for text in timed(pieces, stream_stats, started):
+            content.append(text)
+            yield text
+        if llm_cache is not None:
+            llm_cache.put(model, messages, "".join(content).strip())
+        metrics.observe("llm_stream", time.perf_counter() - started)
+        count_llm_call(messages, "".join(content))
+    if replay_log is not None:
+        replay_log.llm(prompt, "".join(content))
+
+# Counts a request sent to the AI model. Tokens are estimated from the length of the text
+def count_llm_call(messages, content):
+    metrics.count("llm_calls")
+    metrics.count("llm_prompt_tokens", estimate_tokens(messages, completion_tokens=0))
+    metrics.count("llm_completion_tokens", len(content) // 4)
+
+# Shows a response to the player as it's generated and returns the whole text
+def stream_to_player(prompt):
+    content = []
+    for text in stream_completion(prompt):
+        if not content:
+            text = text.lstrip()  # The line already has its leading space
+            if not text:
+                continue
+        write(text)
+        content.append(text)
+    say()
+    return "".join(content).strip()
+
+# AI here will generate random rooms within the game map. The location is an abandoned castle.
+# The direction is part of the prompt so the rooms behind different exits get their own descriptions.
+# 'context' is what the world memory says about the rooms around it (see room_context)
+def room_prompt(current_location, direction, context=""):
+    prompt = (f"Describe a room in an abandoned medieval castle. The room is connected to {current_location} "
+              f"and lies to the {direction} of it.")
+    if context:
+        prompt += " " + context
+    metrics.count("room_prompts")
+    metrics.count("room_prompt_tokens", len(prompt) // 4)
+    return prompt
+
+def request_room_description(current_location, direction, context="", priority=PRIORITY_INTERACTIVE):
+    """Generate a description of a castle room connected to the current location."""
+    return chat_completion(room_prompt(current_location, direction, context), priority=priority)
+
+# The prompt for a generated room that has no description yet. A new room's first connection
+# leads back to the room it was generated from
+def room_description_prompt(game_state, room_id):
+    back_direction, origin = next(iter(game_state["locations"][room_id]["connections"].items()))
+    direction = opposite_direction(back_direction)
+    return room_prompt(origin, direction, room_context(game_state, origin, direction))
+
+# Finds the exits that would lead to a new room, starting from the player's location and
+# following already discovered connections up to 'depth' rooms away. Exits into a position that
+# already has a room don't count, since walking through them joins that room, and neither do exits
+# into a position the world pack has a room for
+def unexplored_exits(game_state, current_location, depth=1):
+    """List (location, direction) pairs of unexplored castle exits near the player."""
+    world = world_for(game_state)
+    start = world.id_of(current_location)
+    if start is None or depth <= 0:
+        return []
+    exits = []
+    for room in world.reachable(start, depth - 1):
+        for direction in ["north", "south", "east", "west"]:
+            position = world.step(room, direction)
+            if world.neighbor(room, direction) == NO_ROOM and world.room_at(*position) is None and \
+                    (world_pack is None or not world_pack.has_room(*position)):
+                exits.append((world.name_of(room), direction))
+    return exits
+
 # Generate dynamic rooms in the castle
 def generate_dynamic_room(direction, current_location, game_state):
     dynamic_rooms = game_state["dynamic_rooms"]
@@ -88,25 +393,56 @@ def generate_dynamic_room(direction, current_location, game_state):
     if direction in connections:
         return connections[direction]  # Return the existing room
 
-    # Name of the generated room
-    room_id = f"room_{len(dynamic_rooms) + 1}"
-    # AI here will generate random rooms within the game map. The location is an abandoned castle
+    # If a room was already generated at the position this exit leads to, the exit joins that room,
+    # as long as the side facing this way isn't already connected somewhere else
+    world = world_for(game_state)
+    origin = world.id_of(current_location)
+    x, y = world.step(origin, direction)
+    existing = world.room_at(x, y)
+    if existing is not None and world.neighbor(existing, opposite_direction(direction)) == NO_ROOM:
+        room_id = world.name_of(existing)
+        connections[direction] = room_id
+        game_state["locations"][room_id].setdefault("connections", {})[opposite_direction(direction)] = current_location
+        world.connect(origin, direction, existing)
+        touch_room(game_state, current_location)
+        touch_room(game_state, room_id)
+        return room_id
+
+    # Name of the generated room, from the next free id in the graph
+    room_id = world.name_of(world.next_id())
     if room_id not in dynamic_rooms:
-        prompt = f"Describe a room in an abandoned medieval castle. The room is connected to {current_location}."
-        description = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "system", "content": "You are a creative Dungeon Master."},
-                      {"role": "user", "content": prompt}]
-        )["choices"][0]["message"]["content"].strip()
+        # Use the world pack's room for this position, or the description generated in the background if
+        # there is one, otherwise generate it now.
+        # With the shared client an unfinished prefetch isn't waited on: asking for the same room again
+        # joins the request already queued and moves it to the front of the queue
+        description = None
+        with metrics.phase("room_generation"):
+            if world_pack is not None:
+                description = world_pack.room_at(x, y)
+                if description is not None:
+                    metrics.count("rooms_from_pack")
+            if description is None and room_prefetcher is not None:
+                description = room_prefetcher.take(current_location, direction, timeout=0 if llm_client is not None else None)
+                if description is not None:
+                    metrics.count("rooms_prefetched")
+            # When streaming, the description is left empty here and streamed when the player enters the room
+            if description is None and not stream_output:
+                description = request_room_description(current_location, direction,
+                                                       room_context(game_state, current_location, direction))
+        metrics.count("rooms_generated")
 
         # Allows traversal between previously discovered rooms
         dynamic_rooms[room_id] = {
             "description": description,
             "visited": False,
             "connections": {opposite_direction(direction): current_location},
+            "position": [x, y],
         }
         game_state["locations"][room_id] = dynamic_rooms[room_id]
         connections[direction] = room_id
+        world.connect(origin, direction, world.add_room(x, y))
+        touch_room(game_state, current_location)
+        touch_room(game_state, room_id)
 
     return room_id
 
@@ -118,14 +454,8 @@ def opposite_direction(direction):
 # However, the 'traveling_merchant' does use generative AI to describe the merchant, including their physical appearance, what they say, etc.
 def generate_random_encounter():
     """Generate a random encounter."""
-    encounters = [
-        {"type": "locked_chest", "difficulty": "simple"},
-        {"type": "falling_bookshelf", "difficulty": "simple"},
-        {"type": "mysterious_puzzle", "difficulty": "challenging"},
-        {"type": "traveling_merchant", "difficulty": "none"}
-    ]
-    # One of the random encounters will be returned if the player gets a random encounter
-    return random.choice(encounters)
+    # One of the random encounters (content.ENCOUNTERS) will be returned if the player gets a random encounter
+    return draw_encounter(game_rng.get())
 
 # Skill checks to determine how difficult the random encounters are to achieve
 def perform_skill_check(difficulty):
@@ -142,106 +472,113 @@ def perform_skill_check(difficulty):
 
     return success, roll
 
-# Handles the list of possible random encounters
-def handle_encounter(game_state, encounter):
-    """Handle a random encounter."""
+# A locked chest: can either be lockpicked or use a key to obtain gold
+# If the player fails to lockpick the chest, the lock will 'break' and cannot be opened
+def locked_chest(game_state, encounter):
     player = game_state["player"]
-
-    # A locked chest: can either be lockpicked or use a key to obtain gold
-    # If the player fails to lockpick the chest, the lock will 'break' and cannot be opened
-    if encounter["type"] == "locked_chest":
-        print("\nYou find a locked chest!")
-        if "key" in player["inventory"]:
-            print("You use a key from your inventory to unlock the chest.")
-            print("Inside, you find 20 gold!")
-            player["gold"] += 20  # Add gold to player
-            player["inventory"].remove("key")
-        else:
-            print("You don't have a key. Do you want to try lockpicking it?")
-            choice = input("Enter 'yes' to try lockpicking or 'no' to ignore: ").lower()
-            if choice == "yes":
-                success, roll = perform_skill_check(encounter["difficulty"])
-                if success:
-                    print(f"Success! You rolled a {roll}. You unlock the chest and find 20 gold!")
-                    player["gold"] += 20  # Add gold to player
-                else:
-                    print(f"Failure! You rolled a {roll}. The lock remains shut.")
-            else:
-                print("You decide to leave the chest alone.")
-
-    # A falling bookshelf. The player can either dodge the bookshelf or 'cut' through it with their weapon
-    # If the player succeeds, they will get xp if they dodge it, or more xp if they cut slice through it
-    # If the player fails, it will fall into the player and will lose a small amount of health
-    # If the player doesn't select either option, the bookshelf will fall on them and will lose a small amount of health
-    elif encounter["type"] == "falling_bookshelf":
-        print("\nYou come bookshelf that is about to fall on you! Do you dodge it or slice it with your weapon?")
-        choice = input("Enter 'dodge' to attempt crossing or 'slice' to find another way: ").lower()
-        if choice == "dodge":
-            success, roll = perform_skill_check(encounter["difficulty"])
-            if success:
-                print(f"Success! You rolled a {roll}. You dodged the bookshelf and gained xp.")
-                player["current_xp"] += 5
-                level_up({"player": player})
-            else:
-                print(f"Failure! You rolled a {roll}. You slip and lose 5 HP.")
-                player["current_hp"] -= 5
-                if player["current_hp"] <= 0:
-                    print("You succumb to your injuries. Game Over.")
-                    return "defeat"
-        elif choice == "slice":
+    say("\nYou find a locked chest!")
+    if "key" in player.inventory:
+        say("You use a key from your inventory to unlock the chest.")
+        say("Inside, you find 20 gold!")
+        player.gold += 20  # Add gold to player
+        player.inventory.remove("key")
+    else:
+        say("You don't have a key. Do you want to try lockpicking it?")
+        choice = ask("Enter 'yes' to try lockpicking or 'no' to ignore: ").lower()
+        if choice == "yes":
             success, roll = perform_skill_check(encounter["difficulty"])
             if success:
-                print(f"Success! You rolled a {roll}. You sliced through the bookshelf and gained xp.")
-                player["current_xp"] += 10
-                level_up({"player": player})
+                say(f"Success! You rolled a {roll}. You unlock the chest and find 20 gold!")
+                player.gold += 20  # Add gold to player
             else:
-                print(f"Failure! You rolled a {roll}. You slip and lose 5 HP.")
-                player["current_hp"] -= 5
-                if player["current_hp"] <= 0:
-                    print("You succumb to your injuries. Game Over.")
-                    return "defeat"
+                say(f"Failure! You rolled a {roll}. The lock remains shut.")
         else:
-            print("You waited too long and the bookshelf falls on top of you.")
-            player["current_hp"] -= 5
-            if player["current_hp"] <= 0:
-                print("You succumb to your injuries. Game Over.")
-                return "defeat"
+            say("You decide to leave the chest alone.")
 
-    # A mysterious puzzle: A puzzle will appear that the player can try and solve
-    # If the player solves the puzzle, they will recieve a health potion in the inventory
-    # If the player fails to solve it, the puzzle will dissapear 
-    elif encounter["type"] == "mysterious_puzzle":
-        print("\nYou encounter a mysterious puzzle etched into the wall.")
-        choice = input("Do you want to attempt solving it? (yes/no): ").lower()
-        if choice == "yes":
-            success, roll = perform_skill_check(encounter["difficulty"])
-            if success:
-                print(f"Success! You rolled a {roll}. The puzzle glows and grants you a health potion!")
-                player["inventory"].append("health_potion")
-            else:
-                print(f"Failure! You rolled a {roll}. The puzzle fades away, leaving you puzzled.")
+# A falling bookshelf. The player can either dodge the bookshelf or 'cut' through it with their weapon
+# If the player succeeds, they will get xp if they dodge it, or more xp if they cut slice through it
+# If the player fails, it will fall into the player and will lose a small amount of health
+# If the player doesn't select either option, the bookshelf will fall on them and will lose a small amount of health
+def falling_bookshelf(game_state, encounter):
+    player = game_state["player"]
+    say("\nYou come bookshelf that is about to fall on you! Do you dodge it or slice it with your weapon?")
+    choice = ask("Enter 'dodge' to attempt crossing or 'slice' to find another way: ").lower()
+    # XP for getting out of the way: more for slicing through it than for dodging
+    reward = {"dodge": (5, "dodged the bookshelf"), "slice": (10, "sliced through the bookshelf")}.get(choice)
+    if reward is not None:
+        success, roll = perform_skill_check(encounter["difficulty"])
+        if success:
+            say(f"Success! You rolled a {roll}. You {reward[1]} and gained xp.")
+            player.current_xp += reward[0]
+            level_up(player)
+            return None
+        say(f"Failure! You rolled a {roll}. You slip and lose 5 HP.")
+    else:
+        say("You waited too long and the bookshelf falls on top of you.")
+    player.current_hp -= 5
+    if player.current_hp <= 0:
+        say("You succumb to your injuries. Game Over.")
+        return "defeat"
+
+# A mysterious puzzle: A puzzle will appear that the player can try and solve
+# If the player solves the puzzle, they will recieve a health potion in the inventory
+# If the player fails to solve it, the puzzle will dissapear
+def mysterious_puzzle(game_state, encounter):
+    say("\nYou encounter a mysterious puzzle etched into the wall.")
+    choice = ask("Do you want to attempt solving it? (yes/no): ").lower()
+    if choice == "yes":
+        success, roll = perform_skill_check(encounter["difficulty"])
+        if success:
+            say(f"Success! You rolled a {roll}. The puzzle glows and grants you a health potion!")
+            game_state["player"].inventory.add("health_potion")
         else:
-            print("You decide not to engage with the puzzle.")
+            say(f"Failure! You rolled a {roll}. The puzzle fades away, leaving you puzzled.")
+    else:
+        say("You decide not to engage with the puzzle.")
+
+def traveling_merchant(game_state, encounter):
+    merchant_encounter(game_state)
 
-    elif encounter["type"] == "traveling_merchant":
-        merchant_encounter(game_state)
+# Each kind of random encounter (content.ENCOUNTERS) and the function that plays it out.
+# They return "defeat" if the encounter kills the player
+ENCOUNTER_HANDLERS = {
+    "locked_chest": locked_chest,
+    "falling_bookshelf": falling_bookshelf,
+    "mysterious_puzzle": mysterious_puzzle,
+    "traveling_merchant": traveling_merchant,
+}
+
+# Handles the list of possible random encounters
+def handle_encounter(game_state, encounter):
+    """Handle a random encounter."""
+    remember(game_state, ENCOUNTER_EVENTS[encounter["type"]])
+    return ENCOUNTER_HANDLERS[encounter["type"]](game_state, encounter)
+
+MERCHANT_PROMPT = (
+    "Describe a traveling merchant in a medieval fantasy setting. Include their physical appearance, "
+    "personality, and a short line of dialogue they might say to the player."
+)
 
 # A merchant NPC: This is a non-enemy NPC where they will sell items to the player they can purhase with gold they collect
 # The merchant uses AI generation to describe their physical appearance, what they say, how they say it, personality, etc.
 def generate_merchant_description():
     """Generate a unique description of the merchant."""
-    prompt = (
-        "Describe a traveling merchant in a medieval fantasy setting. Include their physical appearance, "
-        "personality, and a short line of dialogue they might say to the player."
-    )
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "You are a creative Dungeon Master."},
-            {"role": "user", "content": prompt}
-        ]
+    return chat_completion(MERCHANT_PROMPT)
+
+# Generates several merchant descriptions with a single prompt, used to fill the merchant pool
+def generate_merchant_descriptions(count, priority=PRIORITY_INTERACTIVE):
+    """Generate a batch of unique merchant descriptions."""
+    return split_merchant_descriptions(chat_completion(merchant_batch_prompt(count), priority=priority))
+
+def merchant_batch_prompt(count):
+    return (
+        f"Describe {count} different traveling merchants in a medieval fantasy setting. For each one, include their "
+        "physical appearance, personality, and a short line of dialogue they might say to the player. "
+        "Separate each merchant with a line containing only ---"
     )
-    return response["choices"][0]["message"]["content"].strip()
+
+def split_merchant_descriptions(response):
+    return [part.strip() for part in response.split("\n---") if part.strip(" -\n")]
 
 # The merchant NPC can sell health potions and keys at a price. If the player has enough gold,
 # they will lose the number of gold based on the item price and receive the item in their inventory
@@ -250,37 +587,41 @@ def merchant_encounter(game_state):
     """Handle a merchant encounter."""
     player = game_state["player"]
 
-    # Generate or retrieve merchant description
-    merchant_description = generate_merchant_description()
-    print("\nYou encounter a traveling merchant!")
-    print(merchant_description)
+    # Take a merchant description from the world pack or the pool, or generate one if neither has any
+    merchant_description = world_pack.take_merchant(game_state) if world_pack is not None else None
+    if merchant_description is None:
+        llm_services()
+    with metrics.phase("merchant_description"):
+        if merchant_description is None and merchant_pool is not None:
+            merchant_description = merchant_pool.take()
+        say("\nYou encounter a traveling merchant!")
+        if merchant_description is None and stream_output:
+            stream_to_player(MERCHANT_PROMPT)
+        else:
+            say(merchant_description if merchant_description is not None else generate_merchant_description())
 
-    print("\nThe merchant offers the following items:")
-    print("1. Health Potion (5 gold)")
-    print("2. Key (10 gold)")
+    # The items for sale, numbered as the player picks them
+    wares = {"1": "health_potion", "2": "key"}
+    say("\nThe merchant offers the following items:")
+    for number, item in wares.items():
+        say(f"{number}. {ITEMS[item]['name']} ({ITEMS[item]['price']} gold)")
 
     # Players can buy multiple items until they decide to leave the merchant
     while True:
-        choice = input("Do you want to buy something? (1/2/exit): ").strip()
-        if choice == "1":
-            if player["gold"] >= 5:
-                player["gold"] -= 5
-                player["inventory"].append("health_potion")
-                print("You bought a health potion!")
-            else:
-                print("You don't have enough gold.")
-        elif choice == "2":
-            if player["gold"] >= 10:
-                player["gold"] -= 10
-                player["inventory"].append("key")
-                print("You bought a key!")
+        choice = ask("Do you want to buy something? (1/2/exit): ").strip()
+        if choice in wares:
+            item = wares[choice]
+            if player.gold >= ITEMS[item]["price"]:
+                player.gold -= ITEMS[item]["price"]
+                player.inventory.add(item)
+                say(f"You bought a {ITEMS[item]['name'].lower()}!")
             else:
-                print("You don't have enough gold.")
+                say("You don't have enough gold.")
         elif choice == "exit":
-            print("You decide not to buy anything.")
+            say("You decide not to buy anything.")
             break
         else:
-            print("Invalid choice. Please choose again.")
+            say("Invalid choice. Please choose again.")
 
 # Once a player enters a room, it will print a description of the room location and the status if
 # that room was visited in will turn true.
@@ -290,50 +631,62 @@ def enter_room(game_state, current_location):
     location_state = game_state["locations"][current_location]
 
     if not location_state.get("visited", True):
-        print(f"\nYou are in {current_location}: {location_state['description']}")
+        # Indexing (not .get) so a room from a binary save reads its description from the file
+        if location_state["description"] is None and current_location in game_state["dynamic_rooms"]:
+            # A room generated in streaming mode: describe it now, as the AI model writes it (or all at
+            # once, when a game saved while streaming is played without it)
+            if stream_output:
+                write(f"\nYou are in {current_location}: ")
+                location_state["description"] = stream_to_player(room_description_prompt(game_state, current_location))
+            else:
+                location_state["description"] = chat_completion(room_description_prompt(game_state, current_location))
+                say(f"\nYou are in {current_location}: {location_state['description']}")
+        else:
+            say(f"\nYou are in {current_location}: {location_state['description']}")
         location_state["visited"] = True
+        touch_room(game_state, current_location)
 
         # Random encounters are generated here
-        if random.random() < 0.3:  # 30% chance for an encounter
+        if game_rng.get().chance(0.3):  # 30% chance for an encounter
             encounter = generate_random_encounter()
             result = handle_encounter(game_state, encounter)
             if result == "defeat":
                 return "defeat"
     else:
-        print(f"\nYou are in {current_location}.")
+        say(f"\nYou are in {current_location}.")
 
 # Use health potions to heal the player.
 # Players cannot go past their max health (if a playes health is 15/20, they will only heal up to 5 hp, and not 25)
-def use_health_potion(game_state):
+def use_health_potion(player):
     """Use a health potion to restore HP up to max_hp."""
-    player = game_state["player"]
     # Checks if the player has health potions in their inventory
-    if "health_potion" in player["inventory"]:
-        heal_amount = min(10, player["max_hp"] - player["current_hp"])  # Heal only up to max_hp
-        # Checks if the player can heal using potions
-        if heal_amount > 0:
-            player["current_hp"] += heal_amount
-            player["inventory"].remove("health_potion") # Once the uses a health potion, the item gets removed from their inventory
-            print(f"You used a health potion and restored {heal_amount} HP!")
+    if "health_potion" in player.inventory:
+        heal_amount = min(ITEMS["health_potion"]["amount"], player.max_hp - player.current_hp)  # Heal only up to max_hp
         # If the player is at max health, they cannot use any potions
+        if heal_amount <= 0:
+            say("You're already at max HP!")
+        # Once the uses a health potion, the item gets removed from their inventory. It only heals if one was taken out
+        elif player.inventory.remove("health_potion"):
+            player.current_hp += heal_amount
+            say(f"You used a health potion and restored {heal_amount} HP!")
         else:
-            print("You're already at max HP!")
+            say("You don't have any health potions left!")
     # If the player doesn't have any health potions, they cannot heal        
     else:
-        print("You don't have any health potions left!")
+        say("You don't have any health potions left!")
 
 
 # Display player's inventory
 def display_inventory(game_state):
     # Checks if the player have items in their inventory
-    if game_state["player"]["inventory"]:
-        print("Your Inventory:")
-        # Prints out a list of the items in the inventory
-        for item in game_state["player"]["inventory"]:
-            print(f"- {item}")
+    if game_state["player"].inventory:
+        say("Your Inventory:")
+        # Prints out a list of the items in the inventory, one line per kind of item ("health_potion x3")
+        for stack in game_state["player"].inventory.stacks():
+            say(f"- {stack}")
     # If the player has no items, will print saying their inventory is empty
     else:
-        print("Your inventory is empty.")
+        say("Your inventory is empty.")
 
 # Will display the current stats of the player, the following are as follows:
 # Their current xp
@@ -342,27 +695,27 @@ def display_inventory(game_state):
 # The number of gold they have on them
 def display_stats(game_state):
     """Display the player's current XP."""
-    print(f"Your current XP level is {game_state['player']['current_xp']} XP")
-    print(f"Your current level is level {game_state['player']['level']}")
-    print(f"Your current hp is {game_state['player']['current_hp']}/{game_state['player']['max_hp']}")
-    print(f"You currently have {game_state['player']['gold']} piece(s) of gold in your inventory to buy items")
+    say(f"Your current XP level is {game_state['player'].current_xp} XP")
+    say(f"Your current level is level {game_state['player'].level}")
+    say(f"Your current hp is {game_state['player'].current_hp}/{game_state['player'].max_hp}")
+    say(f"You currently have {game_state['player'].gold} piece(s) of gold in your inventory to buy items")
 
 # Simulates a dice role based on the number of sides there are
 def roll_dice(sides):
     """Simulate a dice roll."""
-    return random.randint(1, sides)
+    return game_rng.get().roll(sides)
 
 # Will randomly spawn one of several enemies that are appropriate based on the setting of the game.
 # The original idea was to use AI to generate a variety of enemies, but proved to be inconsistent
 def spawn_enemy():
     """Randomly determine if an enemy spawns and assign attributes."""
-    if random.random() < 0.4:  # 40% chance to spawn an enemy
-        return {
-            "name": random.choice(["Knight Statue", "Skeleton", "Giant Rat", "Ghost", "Looter"]),
-            "hp": random.randint(10, 20),  # Random HP between 10 and 20
-            "attack_power": random.randint(2, 5)  # Random attack power between 2 and 5
-        }
-    return None
+    # 40% chance to spawn one of content.ENEMIES, with random HP between 10 and 20
+    # and random attack power between 2 and 5
+    spawned = draw_enemy(game_rng.get())
+    if spawned is None:
+        return None
+    name, hp, attack_power = spawned
+    return Enemy(name=name, hp=hp, attack_power=attack_power)
 
 # Allows to player to flee from an enemy if they're too difficult to fight
 def flee(player, enemy):
@@ -371,57 +724,45 @@ def flee(player, enemy):
     enemy_roll = roll_dice(6)
     # If the player rolls a higher number, they will flee from the enemy
     if player_roll >= enemy_roll:
-        print(f"You successfully fled from the {enemy['name']}!")
+        say(f"You successfully fled from the {enemy.name}!")
         return "fled"
     # If the enemy rolls a higher number, they failed to flee and will start the combat
     else:
-        print(f"You failed to flee and have to fight the {enemy['name']}!")
+        say(f"You failed to flee and have to fight the {enemy.name}!")
         return "fight"
 
 # Level up function to improve the player's stats
-def level_up(game_state):
+def level_up(player):
     """Level up the player if XP threshold is reached."""
-    player = game_state["player"]
     # If the player's current xp is higher than their max xp, they will gain 1 level
-    if player["current_xp"] >= player["max_xp"]:
-        player["level"] += 1  # Increase level
-        player["current_xp"] -= player["max_xp"]  # Carry over extra XP
-        player["max_xp"] += 50  # Increase XP requirement for next level
-        player["max_hp"] += 3  # Increase max HP
-        player["current_hp"] = player["max_hp"]  # Restore HP to new max
-        print(f"Congratulations! You leveled up to Level {player['level']}!")
-        print(f"Your max HP is now {player['max_hp']}!")
+    if player.current_xp >= player.max_xp:
+        player.level += 1  # Increase level
+        player.current_xp -= player.max_xp  # Carry over extra XP
+        player.max_xp += 50  # Increase XP requirement for next level
+        player.max_hp += 3  # Increase max HP
+        player.current_hp = player.max_hp  # Restore HP to new max
+        say(f"Congratulations! You leveled up to Level {player.level}!")
+        say(f"Your max HP is now {player.max_hp}!")
 
 # Several different items that can be generated during the game from defeated enemies.
 # Either one, several, or no items can be dropped, based on randomness
 # Note: the amount of gold dropped ranges from 5 to 20
 def generate_loot():
     """Generate loot dropped by an enemy."""
-    loot_table = [
-        {"item": "gold", "amount": random.randint(5, 20), "chance": 0.5},  # 50% chance
-        {"item": "health_potion", "amount": 1, "chance": 0.3},  # 30% chance
-        {"item": "key", "amount": 1, "chance": 0.2},  # 20% chance
-    ]
-
-    # An array of potential items dropped by defeated enemies
-    dropped_items = []
-    for loot in loot_table:
-        if random.random() < loot["chance"]:  # Check if the loot drops
-            dropped_items.append({"item": loot["item"], "amount": loot["amount"]})
-
-    return dropped_items
+    # Gold has a 50% chance, a health potion 30% and a key 20% (content.LOOT).
+    # All of the drops are decided by one draw from the precomputed loot table
+    return draw_loot(game_rng.get())
 
 # Function to add gold and item to the player's inventory
 def handle_loot(player, loot):
     """Add loot to the player's inventory or gold."""
     for drop in loot:
         if drop["item"] == "gold":
-            player["gold"] += drop["amount"]
-            print(f"You found {drop['amount']} gold!")
+            player.gold += drop["amount"]
+            say(f"You found {drop['amount']} gold!")
         else:
-            for _ in range(drop["amount"]):  # Add the item multiple times if necessary
-                player["inventory"].append(drop["item"])
-            print(f"You found {drop['amount']} {drop['item']}(s)!")
+            player.inventory.add(drop["item"], drop["amount"])
+            say(f"You found {drop['amount']} {drop['item']}(s)!")
 
 # Combat system between the player and enemy.
 # Combat is based on turn-table strategy, where the player will roll a dice and deliver an attack, same with the enemy
@@ -430,56 +771,56 @@ def handle_loot(player, loot):
 # If the player is defeated, the game will end and they will need to start a new game
 def combat(player, enemy):
     """Handle turn-based combat between the player and an enemy."""
-    print(f"A wild {enemy['name']} appears!")
-    print(f"The {enemy['name']} has {enemy['hp']} HP and {enemy['attack_power']} Attack Power.\n")
+    say(f"A wild {enemy.name} appears!")
+    say(f"The {enemy.name} has {enemy.hp} HP and {enemy.attack_power} Attack Power.\n")
 
     # Combat will be engaged until either the player or enemy is victorious
     # Will check whoever's hp reaches down to 0 first
-    while player["current_hp"] > 0 and enemy["hp"] > 0:
+    while player.current_hp > 0 and enemy.hp > 0:
         # Player's turn
-        print("\nYour turn!")
-        print(f"Your HP: {player['current_hp']} | Enemy HP: {enemy['hp']}")
-        print("1. Attack")
-        print("2. Use Health Potion")
+        say("\nYour turn!")
+        say(f"Your HP: {player.current_hp} | Enemy HP: {enemy.hp}")
+        say("1. Attack")
+        say("2. Use Health Potion")
 
         # Potential actions the player can take
-        player_choice = input("Choose an action (1/2): ").strip()
+        player_choice = ask("Choose an action (1/2): ").strip()
         if player_choice == "1":  # Attack
             player_roll = roll_dice(6)
-            player_damage = player_roll + player["attack_power"]
-            enemy["hp"] -= player_damage
-            print(f"You attack the {enemy['name']} and deal {player_damage} damage!")
+            player_damage = player_roll + player.attack_power
+            enemy.hp -= player_damage
+            say(f"You attack the {enemy.name} and deal {player_damage} damage!")
         elif player_choice == "2":  # Use Health Potion
-            use_health_potion({"player": player})
+            use_health_potion(player)
             continue  # Skip the rest of the player's turn
         # If a player selects a non-valid option, they will lose their turn
         else:
-            print("Invalid choice. You lose your turn!")
+            say("Invalid choice. You lose your turn!")
         
         # Check if enemy is defeated
-        if enemy["hp"] <= 0:
-            print(f"\nYou defeated the {enemy['name']}!")
-            player["current_xp"] += 10  # Award 10 XP
-            print(f"You gained 10 XP! Current XP: {player['current_xp']} / {player['max_xp']}")
-            level_up({"player": player})  # Check if the player levels up
+        if enemy.hp <= 0:
+            say(f"\nYou defeated the {enemy.name}!")
+            player.current_xp += 10  # Award 10 XP
+            say(f"You gained 10 XP! Current XP: {player.current_xp} / {player.max_xp}")
+            level_up(player)  # Check if the player levels up
             loot = generate_loot()  # Generate loot from the enemy
             if loot:
                 handle_loot(player, loot)  # Add loot to the player's inventory or gold
             return "victory"
 
         # Enemy's turn
-        print(f"\nThe {enemy['name']}'s turn!")
+        say(f"\nThe {enemy.name}'s turn!")
         enemy_roll = roll_dice(6)
-        enemy_damage = enemy_roll + enemy["attack_power"]
-        player["current_hp"] -= enemy_damage
-        print(f"The {enemy['name']} attacks you and deals {enemy_damage} damage!")
+        enemy_damage = enemy_roll + enemy.attack_power
+        player.current_hp -= enemy_damage
+        say(f"The {enemy.name} attacks you and deals {enemy_damage} damage!")
 
         # Check if player is defeated
-        if player["current_hp"] <= 0:
-            print(f"\nYou were defeated by the {enemy['name']}...")
+        if player.current_hp <= 0:
+            say(f"\nYou were defeated by the {enemy.name}...")
             return "defeat"
 
-    return "defeat" if player["current_hp"] <= 0 else "victory"
+    return "defeat" if player.current_hp <= 0 else "victory"
 
 # Function will spawn in an enemy in the player's current location
 def check_for_enemy(game_state, current_location):
@@ -487,78 +828,271 @@ def check_for_enemy(game_state, current_location):
     location = game_state["locations"][current_location]
     if "enemy" not in location:
         location["enemy"] = spawn_enemy()  # Spawn an enemy if one doesn't exist
+        touch_room(game_state, current_location)
+    elif location["enemy"] is not None:
+        touch_room(game_state, current_location)  # The player is about to fight it (or flee from it)
 
     return location["enemy"]
 
+# What the player can do about an enemy in the room: their answer -> the function that carries it out.
+# Each returns the turn's result (location, outcome) if the turn ends there, or None to go on to the player's action
+# If the player enter's 'fight' combat will engage against the enemy
+def fight_enemy(game_state, current_location, enemy):
+    if combat(game_state["player"], enemy) == "defeat":
+        say("Game Over. You can restart from a saved state.")
+        return current_location, "defeat"
+    game_state["locations"][current_location]["enemy"] = None  # Remove the enemy after victory
+    touch_room(game_state, current_location)
+    remember(game_state, f"defeated a {enemy.name}")
+
+# If the player flees, they will try and run away from the enemy and return to the same location after
+def flee_enemy(game_state, current_location, enemy):
+    if flee(game_state["player"], enemy) == "fled":
+        say(f"You fled back to the previous room and later return to find the {enemy.name} gone.")
+        remember(game_state, f"fled from a {enemy.name}")
+        game_state["locations"][current_location]["enemy"] = None  # Remove the enemy after fleeing
+        touch_room(game_state, current_location)
+        return current_location, None  # Skip the rest of the turn to allow the player to flee
+    combat(game_state["player"], enemy)
+
+# If the enters an invalid choice, combat will engage
+def enemy_attacks(game_state, current_location, enemy):
+    say("Invalid choice. The enemy attacks!")
+    if combat(game_state["player"], enemy) == "defeat":
+        say("Game Over. You can restart from a saved state.")
+        return current_location, "defeat"
+
+ENEMY_CHOICES = {"fight": fight_enemy, "flee": flee_enemy}
+
+# The player's commands at the action prompt.
+# Each takes the game state, the player's location and the command, and returns the player's location after it
+# and "quit" if the game is over (None otherwise)
+def go(game_state, current_location, direction):
+    new_location = move_player(current_location, direction, game_state)
+    if new_location != current_location:
+        say(f"You move {direction} to {new_location}.")
+        return new_location, None
+    say("You can't go that way.")
+    return current_location, None
+
+def show_inventory(game_state, current_location, command):
+    display_inventory(game_state)
+    return current_location, None
+
+def use_potion(game_state, current_location, command):
+    use_health_potion(game_state["player"])
+    return current_location, None
+
+def show_stats(game_state, current_location, command):
+    display_stats(game_state)
+    return current_location, None
+
+def quit_game(game_state, current_location, command):
+    return current_location, "quit"
+
+# Players enter one of four directions (north, south, east, west)
+# Players can check their inventoy (I)
+# Players can use their health potions if the have any (use)
+# Players can check their character's stats (stats)
+# Players can quit and save their game (quit)
+COMMANDS = {
+    "north": go,
+    "south": go,
+    "east": go,
+    "west": go,
+    "i": show_inventory,
+    "inventory": show_inventory,
+    "use": use_potion,
+    "stats": show_stats,
+    "quit": quit_game,
+}
+
+ACTION_PROMPT = ("Enter a direction (north/south/east/west), 'I' for Inventory, 'use' to use a health potion, "
+                 "'stats' for stats, 'quit' to save and exit: ")
+
+# Carries out a command typed at the action prompt (already lowercase).
+# An invalid input will print out the input doesn't exist or is implemented
+def dispatch(game_state, current_location, command):
+    """Carry out one of the player's commands and return their location after it and the outcome."""
+    handler = COMMANDS.get(command)
+    if handler is None:
+        say("Invalid action.")
+        return current_location, None
+    return handler(game_state, current_location, command)
+
+# Plays a single turn of the game: entering the room, dealing with any enemy in it and the player's next action.
+# Returns the player's location after the turn, and "defeat" or "quit" if the game is over (None otherwise)
+def play_turn(game_state, current_location):
+    """Play one turn of the game."""
+    # Enter the room (process random encounters, descriptions, etc.)
+    result = enter_room(game_state, current_location)
+    if result == "defeat":  # Handle defeat during an encounter
+        say("Game Over. You can restart from a saved state.")
+        return current_location, "defeat"
+
+    # Describe the rooms behind the unexplored exits while the player decides what to do.
+    # The AI model services start the first time the player is in the castle
+    if is_castle_room(current_location):
+        llm_services()
+    # The prompts' context is made here on the game thread, not on the prefetcher's threads
+    if room_prefetcher is not None:
+        room_prefetcher.prefetch(unexplored_exits(game_state, current_location, room_prefetcher.depth),
+                                 partial(room_context, game_state) if room_context_tokens else None)
+
+    # Check for enemies, and let the player either fight or flee from one
+    enemy = check_for_enemy(game_state, current_location)
+    if enemy:
+        say(f"A {enemy.name} is here!")
+        combat_choice = ask("Do you want to fight or flee? (fight/flee): ").lower()
+        result = ENEMY_CHOICES.get(combat_choice, enemy_attacks)(game_state, current_location, enemy)
+        if result is not None:
+            return result
+
+    # Get player action
+    return dispatch(game_state, current_location, ask(ACTION_PROMPT).lower())
+
+# Starts the console game's AI model services, configured by environment variables (which can be set in .env)
+def start_console_services():
+    global llm_client, llm_cache, room_prefetcher, merchant_pool
+    from llm_cache import LLMCache
+    from llm_client import LLMClient, use_pooled_http_session
+    from merchant_pool import MerchantPool
+    from room_prefetch import RoomPrefetcher
+
+    load_environment()
+    # Send every request to the AI model through one client with a few workers sharing pooled
+    # connections, kept under the API's rate limits (LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE)
+    llm_workers = int(os.getenv("LLM_WORKERS", "4"))
+    if llm_backend is None:
+        use_pooled_http_session(openai_api(), llm_workers)
+    llm_client = LLMClient(
+        llm_backend if llm_backend is not None else openai_api().ChatCompletion,
+        workers=llm_workers,
+        requests_per_minute=int(os.getenv("LLM_REQUESTS_PER_MINUTE", "3500")),
+        tokens_per_minute=int(os.getenv("LLM_TOKENS_PER_MINUTE", "90000")),
+        max_retries=int(os.getenv("LLM_MAX_RETRIES", "5")),
+    ).start()
+
+    # Cache AI model responses on disk. LLM_CACHE_VARIANTS is how many different responses each prompt
+    # collects before repeats are served from the cache
+    llm_cache = LLMCache(
+        os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3"),
+        variants=int(os.getenv("LLM_CACHE_VARIANTS", "3")),
+        max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000")),
+        ttl=float(os.getenv("LLM_CACHE_TTL")) if os.getenv("LLM_CACHE_TTL") else None,
+    )
+
+    # Start describing nearby castle rooms in the background.
+    # ROOM_PREFETCH_DEPTH=0 turns this off and generates every room on demand
+    room_prefetcher = RoomPrefetcher(
+        partial(request_room_description, priority=PRIORITY_PREFETCH),
+        concurrency=int(os.getenv("ROOM_PREFETCH_CONCURRENCY", "2")),
+        depth=int(os.getenv("ROOM_PREFETCH_DEPTH", "1")),
+    ).start()
+
+    # Keep a few merchant descriptions ready so merchants appear without waiting on the AI model.
+    # A world pack with merchants already has them ready
+    if world_pack is None or not world_pack.merchants:
+        merchant_pool = MerchantPool(
+            partial(generate_merchant_descriptions, priority=PRIORITY_PREFETCH),
+            size=int(os.getenv("MERCHANT_POOL_SIZE", "6")),
+            low_water=int(os.getenv("MERCHANT_POOL_LOW_WATER", "2")),
+            batch_size=int(os.getenv("MERCHANT_POOL_BATCH", "3")),
+        ).start()
+
+    if replay_log is not None:
+        room_prefetcher = replay_log.prefetcher(room_prefetcher)
+        if merchant_pool is not None:
+            merchant_pool = replay_log.merchant_pool(merchant_pool)
+
 # Main game loop
 if __name__ == "__main__":
-    # Load or initialize the game state
-    game_state = load_game()
+    # METRICS_FILE collects timings of each phase of a turn and counts of AI requests and saves, written
+    # to the file every turn (JSON for .json names, Prometheus text otherwise). PROFILE_FILE samples where
+    # the game spends its time every PROFILE_INTERVAL milliseconds and writes the stacks when the game ends
+    metrics_file = os.getenv("METRICS_FILE")
+    if metrics_file:
+        metrics.enable()
+    profiler = None
+    if os.getenv("PROFILE_FILE"):
+        profiler = metrics.SamplingProfiler(float(os.getenv("PROFILE_INTERVAL", "5")) / 1000).start()
+
+    # Load or initialize the game state. SAVE_FILE picks the save file; names ending in .bin use the
+    # binary save format, which reads room descriptions from disk only when they're shown
+    save_file = os.getenv("SAVE_FILE", "game_state.json")
+    # SAVE_DB keeps the game in a SQLite save store instead, in the slot named by SAVE_FILE
+    if os.getenv("SAVE_DB"):
+        from sqlite_store import SaveStore
+        save_store = SaveStore(os.getenv("SAVE_DB"))
+    game_state = load_game(save_file)
     current_location = game_state["current_location"]  # Load the saved location
 
+    # GAME_SEED makes the dice repeatable: the same seed and the same choices play out the same way.
+    # REPLAY_LOG records the session to a file (compressed if the name ends in .gz) for replay.py,
+    # with a seed picked at random if there isn't one
+    seed = os.getenv("GAME_SEED")
+    replay_file = os.getenv("REPLAY_LOG")
+    if replay_file and not seed:
+        seed = str(int.from_bytes(os.urandom(4), "big"))
+    if seed:
+        game_rng.set(GameRNG(int(seed)))
+
+    # Descriptions generated on demand are shown as they're written. STREAM_OUTPUT=0 shows them whole
+    stream_output = os.getenv("STREAM_OUTPUT", "1") != "0"
+
+    # Room prompts tell the AI model about the rooms around the new one, the player and what happened
+    # lately, in at most ROOM_CONTEXT_TOKENS tokens. ROOM_CONTEXT_TOKENS=0 describes each room on its own
+    room_context_tokens = int(os.getenv("ROOM_CONTEXT_TOKENS", "150"))
+
+    # WORLD_PACK serves castle rooms and merchants from a pack made by world_pack.py
+    if os.getenv("WORLD_PACK"):
+        from world_pack import WorldPack
+        world_pack = WorldPack(os.getenv("WORLD_PACK"))
+
+    if replay_file:
+        from replay import Recorder
+        replay_log = Recorder(replay_file, int(seed), game_state, current_location, stream_output,
+                              prefetch=True, merchant_pool=world_pack is None or not world_pack.merchants,
+                              world_pack=world_pack, room_context_tokens=room_context_tokens)
+        game_io.set(replay_log.io(game_io.get()))
+
+    start_llm_services = start_console_services
+
+    # Write autosaves on a background thread. AUTOSAVE_BACKGROUND=0 writes each one before the turn goes on.
+    # (A save store's saves are small transactions and are always written right away)
+    if save_store is None and os.getenv("AUTOSAVE_BACKGROUND", "1") != "0":
+        from autosave import Autosaver
+        autosaver = Autosaver().start()
+
     # Loop will keep running through until the player is defeated or they quit the game
+    first_turn = True
     while True:
-        # Enter the room (process random encounters, descriptions, etc.)
-        result = enter_room(game_state, current_location)
-        if result == "defeat":  # Handle defeat during an encounter
-            print("Game Over. You can restart from a saved state.")
-            break
+        # Autosave at the start of every turn, so a crash only loses the turn in progress.
+        # A game that was just loaded is already saved
+        if not first_turn:
+            save_game(game_state, current_location, save_file)
+        first_turn = False
 
-        # Check for enemies
-        enemy = check_for_enemy(game_state, current_location)
-        if enemy:
-            print(f"A {enemy['name']} is here!")
-            # Allow he ability for the player to either fight or flee from the enemy
-            combat_choice = input("Do you want to fight or flee? (fight/flee): ").lower()
-            # If the player enter's 'fight' combat will engage against the enemy
-            if combat_choice == "fight":
-                result = combat(game_state["player"], enemy)
-                if result == "defeat":
-                    print("Game Over. You can restart from a saved state.")
-                    break
-                else:
-                    game_state["locations"][current_location]["enemy"] = None  # Remove the enemy after victory
-            # If the player flees, they will try and run away from the enemy and return to the same location after
-            elif combat_choice == "flee":
-                result = flee(game_state["player"], enemy)
-                if result == "fled":
-                    print(f"You fled back to the previous room and later return to find the {enemy['name']} gone.")
-                    game_state["locations"][current_location]["enemy"] = None  # Remove the enemy after fleeing
-                    continue  # Skip the rest of the loop to allow the player to flee
-                else:
-                    combat(game_state["player"], enemy)
-            # If the enters an invalid choice, combat will engage 
-            else:
-                print("Invalid choice. The enemy attacks!")
-                result = combat(game_state["player"], enemy)
-                if result == "defeat":
-                    print("Game Over. You can restart from a saved state.")
-                    break
-
-        # Get player action.
-        # Players enter one of four directions (north, south, east, west)
-        # Players can check their inventoy (I)
-        # Players can use their health potions if the have any (use)
-        # Players can check their character's stats (stats)
-        # Players can quit and save their game (quit)
-        # An invalid input will print out the input doesn't exist or is implemented
-        action = input("Enter a direction (north/south/east/west), 'I' for Inventory, 'use' to use a health potion, 'stats' for stats, 'quit' to save and exit: ").lower()
-        if action == "quit":
-            save_game(game_state, current_location)
-            print("Game saved. Goodbye!")
+        if replay_log is not None:
+            replay_log.turn(game_state, current_location)
+        with metrics.phase("turn"):
+            current_location, outcome = play_turn(game_state, current_location)
+        metrics.count("turns")
+        if metrics_file:
+            metrics.collector.write(metrics_file)
+        if replay_log is not None and outcome is not None:
+            replay_log.finish(game_state, current_location, outcome)
+        if profiler is not None and outcome is not None:
+            profiler.stop()
+            profiler.write(os.getenv("PROFILE_FILE"))
+        if outcome == "quit":
+            save_game(game_state, current_location, save_file)
+            if autosaver is not None:
+                autosaver.stop()  # Waits for the save to be written
+            say("Game saved. Goodbye!")
+            for service in (room_prefetcher, merchant_pool, llm_client):
+                if service is not None:
+                    service.stop()
+            break
+        elif outcome == "defeat":
             break
-        elif action in ["north", "south", "east", "west"]:
-            new_location = move_player(current_location, action, game_state)
-            if new_location != current_location:
-                print(f"You move {action} to {new_location}.")
-                current_location = new_location
-            else:
-                print("You can't go that way.")
-        elif action == "i" or action == "inventory":
-            display_inventory(game_state)
-        elif action == "use":
-            use_health_potion(game_state)
-        elif action == "stats":
-            display_stats(game_state)
-        else:
-            print("Invalid action.")
@@ -0,0 +1,339 @@
+import argparse
+import asyncio
+import os
+import queue
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import game_loop
+from content import GameRNG, game_rng
+from llm_client import LLMClient
+from simulation import ANSWERS, prompt_kind
+from stub_llm import StubLLM
+
+# A game server for many players at once.
+# Players connect over TCP and play with plain lines of text, like the console game. Each connection is a
+# session with its own game state. The session's coroutine runs the game one turn at a time on a worker
+# thread, so a turn that waits on the player or on the AI model (a new room, a merchant) never holds up
+# any other session.
+#
+#   python game_server.py --port 8765
+#   python game_server.py --load-test 200      (plays 200 simulated sessions against a local server)
+
+
+# Characters taken out of a player's name to make their save slot (and file name)
+NAME_UNSAFE = r"[^A-Za-z0-9_-]"
+
+
+class SessionClosed(Exception):
+    """The player disconnected or went idle in the middle of a turn."""
+
+
+class SessionIO:
+    """Game input and output for one network session."""
+
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.loop_thread = threading.get_ident()  # Sessions are created on the event loop's thread
+        self.writer = writer
+        self.lines = queue.Queue()  # Lines received from the player, or None once the connection is gone
+        self.closed = False
+        self.rng = GameRNG()        # The session's own dice, so sessions on a shared thread don't mix rolls
+
+    # Output from a session's worker thread is handed to the event loop, which owns the connection
+    def _write(self, text):
+        if threading.get_ident() == self.loop_thread:
+            self._send(text.encode("utf-8"))
+        else:
+            self.loop.call_soon_threadsafe(self._send, text.encode("utf-8"))
+
+    def _send(self, data):
+        if not self.closed and not self.writer.is_closing():
+            self.writer.write(data)
+
+    # Ends the session: anything still waiting on the player gets SessionClosed
+    def close(self):
+        self.closed = True
+        self.lines.put(None)
+
+    def say(self, text=""):
+        self._write(f"{text}\n")
+
+    # Writes part of a line, sent straight away so streamed descriptions appear as they're generated
+    def write(self, text):
+        self._write(text)
+
+    # Sends the prompt and waits (on the session's worker thread) for the player's next line
+    def ask(self, prompt):
+        self._write(prompt)
+        line = self.lines.get()
+        if line is None:
+            raise SessionClosed()
+        return line
+
+
+class GameServer:
+    """Serve the game to many players over a line-based TCP protocol."""
+
+    def __init__(self, host="127.0.0.1", port=8765, max_sessions=500, idle_timeout=300.0, save_dir=None):
+        self.host = host
+        self.port = port
+        self.max_sessions = max_sessions  # Connections past this are turned away
+        self.idle_timeout = idle_timeout  # Seconds a player can go without sending anything
+        self.save_dir = save_dir          # Where each player's game is saved, or None to not save
+        self.active = 0
+        self.total = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self._server = None
+        self._sessions = {}  # Running session task -> its SessionIO
+        self._playing = set()  # Save slots of the sessions playing now (only touched on the event loop)
+        # Every session can be waiting on its player at once, so there is a thread for each one
+        self._executor = ThreadPoolExecutor(max_workers=max_sessions, thread_name_prefix="session")
+
+    async def start(self):
+        # The listen backlog has room for every session connecting at once
+        self._server = await asyncio.start_server(
+            self.handle_client, self.host, self.port, backlog=max(100, self.max_sessions)
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    # Stops accepting players, ends every session and waits for them to finish their current turn
+    async def close(self):
+        self._server.close()
+        for io in self._sessions.values():
+            io.close()
+        await asyncio.gather(*self._sessions, return_exceptions=True)
+        await self._server.wait_closed()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    # Passes the player's lines to the session until they disconnect or go idle
+    async def _read_lines(self, reader, io):
+        try:
+            while True:
+                line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                if not line:
+                    break
+                io.lines.put(line.decode("utf-8", "replace").rstrip("\r\n"))
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            io.say("\nYou've been idle too long. Goodbye!")
+        except ConnectionError:
+            pass
+        finally:
+            io.close()
+
+    # Runs one turn on the session's worker thread, with the session's own input, output and dice
+    @staticmethod
+    def _play_turn(io, game_state, current_location):
+        token = game_loop.game_io.set(io)
+        rng_token = game_rng.set(io.rng)
+        try:
+            return game_loop.play_turn(game_state, current_location)
+        finally:
+            game_rng.reset(rng_token)
+            game_loop.game_io.reset(token)
+
+    @staticmethod
+    def _ask_name(io):
+        token = game_loop.game_io.set(io)
+        try:
+            return game_loop.ask("Enter your name: ")
+        finally:
+            game_loop.game_io.reset(token)
+
+    # A save slot no other session is playing. A second session with a name already in play gets its own
+    # numbered slot, so two worker threads never save (and journal) the same game at once. The number
+    # follows a '.', which a player's name never keeps, so it can't be anyone else's slot
+    def _claim_slot(self, io, slot):
+        claimed, number = slot, 1
+        while claimed in self._playing:
+            number += 1
+            claimed = f"{slot}.{number}"
+        if claimed != slot:
+            io.say(f"{slot} is already playing, so this game is saved as {claimed}.")
+        self._playing.add(claimed)
+        return claimed
+
+    async def handle_client(self, reader, writer):
+        if self.active >= self.max_sessions:
+            self.rejected += 1
+            writer.write(b"The server is full. Please try again later.\n")
+            await writer.drain()
+            writer.close()
+            return
+
+        self.active += 1
+        self.total += 1
+        loop = asyncio.get_running_loop()
+        io = SessionIO(loop, writer)
+        self._sessions[asyncio.current_task()] = io
+        reading = asyncio.create_task(self._read_lines(reader, io))
+        slot = None
+        try:
+            name = await loop.run_in_executor(self._executor, self._ask_name, io)
+            filename = None
+            if self.save_dir or game_loop.save_store is not None:
+                # With a save store the player's name is their slot, otherwise it names their save file
+                filename = slot = self._claim_slot(io, re.sub(NAME_UNSAFE, "", name) or "player")
+                if game_loop.save_store is None:
+                    filename = os.path.join(self.save_dir, filename + ".json")
+                game_state = await loop.run_in_executor(self._executor, game_loop.load_game, filename)
+            else:
+                game_state = game_loop.new_game_state()
+            current_location = game_state["current_location"]
+
+            while True:
+                if filename:
+                    await loop.run_in_executor(self._executor, game_loop.save_game, game_state, current_location, filename)
+                current_location, outcome = await loop.run_in_executor(
+                    self._executor, self._play_turn, io, game_state, current_location
+                )
+                if outcome == "quit":
+                    if filename:
+                        await loop.run_in_executor(self._executor, game_loop.save_game, game_state, current_location, filename)
+                    io.say("Game saved. Goodbye!")
+                    break
+                elif outcome == "defeat":
+                    break
+                await writer.drain()
+        except (SessionClosed, ConnectionError):
+            pass
+        finally:
+            self.active -= 1
+            self._playing.discard(slot)
+            del self._sessions[asyncio.current_task()]
+            reading.cancel()
+            try:
+                await writer.drain()
+                writer.close()
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+# Plays one simulated session against the server with random answers.
+# Returns how long each turn took, from sending a command to seeing the next command prompt
+async def _simulated_session(host, port, turns, rng):
+    reader, writer = await asyncio.open_connection(host, port)
+    latencies = []
+    buffer = ""
+    turn_started = None
+    try:
+        while len(latencies) < turns:
+            data = await asyncio.wait_for(reader.read(4096), 60.0)
+            if not data:
+                break
+            buffer += data.decode("utf-8")
+            if not buffer.endswith(": "):
+                continue  # Still waiting for the next prompt
+            prompt = buffer[buffer.rfind("\n") + 1:]
+            kind = prompt_kind(prompt)
+            if kind is None and "name" not in prompt:
+                continue  # Part of a line that happens to end like a prompt
+            buffer = ""
+            if kind == "action":
+                if turn_started is not None:
+                    latencies.append(time.perf_counter() - turn_started)
+                turn_started = time.perf_counter()
+            answer = "loadtest" if "name" in prompt else rng.choice(ANSWERS.get(kind, ["quit"]))
+            writer.write(f"{answer}\n".encode("utf-8"))
+            await writer.drain()
+        writer.write(b"quit\n")
+        await writer.drain()
+    finally:
+        writer.close()
+    return latencies
+
+
+async def load_test(sessions=200, turns=20, host=None, port=None, stub_latency=0.5, seed=0, llm_workers=0):
+    """Drive many simulated sessions against a server and report turn latency.
+
+    Without a host and port a local server using the stub LLM is started for the test,
+    sending its requests through a shared client with 'llm_workers' workers (0 calls the stub directly).
+    """
+    server = None
+    if host is None:
+        game_loop.llm_backend = StubLLM(latency=stub_latency)
+        if llm_workers:
+            game_loop.llm_client = LLMClient(game_loop.llm_backend, workers=llm_workers).start()
+        server = await GameServer(port=0, max_sessions=sessions).start()
+        host, port = server.host, server.port
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(_simulated_session(host, port, turns, random.Random(seed + number)) for number in range(sessions)),
+        return_exceptions=True,
+    )
+    elapsed = time.perf_counter() - started
+    if server is not None:
+        await server.close()
+        if game_loop.llm_client is not None:
+            game_loop.llm_client.stop()
+    latencies = sorted(latency for result in results if isinstance(result, list) for latency in result)
+    failed = sum(1 for result in results if isinstance(result, Exception))
+
+    def percentile(fraction):
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] if latencies else 0.0
+
+    return {
+        "sessions": sessions,
+        "failed_sessions": failed,
+        "turns": len(latencies),
+        "seconds": elapsed,
+        "turns_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "p50": percentile(0.50),
+        "p95": percentile(0.95),
+        "p99": percentile(0.99),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the game to many players over TCP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-sessions", type=int, default=500)
+    parser.add_argument("--idle-timeout", type=float, default=300.0, help="seconds before an idle player is disconnected")
+    parser.add_argument("--save-dir", default=None, help="save each player's game in this directory")
+    parser.add_argument("--save-db", default=None, help="save every player's game in this SQLite database")
+    parser.add_argument("--stub-llm", type=float, default=None, metavar="LATENCY",
+                        help="use the offline stub LLM with this many seconds of latency")
+    parser.add_argument("--llm-workers", type=int, default=0,
+                        help="send AI model requests through a shared, rate-limited client with this many workers")
+    parser.add_argument("--room-context-tokens", type=int, default=150,
+                        help="tokens of context about the world around a new room in its prompt (0 for none)")
+    parser.add_argument("--load-test", type=int, default=0, metavar="SESSIONS",
+                        help="run this many simulated sessions against a local server and exit")
+    parser.add_argument("--turns", type=int, default=20, help="turns per simulated session in the load test")
+    args = parser.parse_args()
+
+    if args.load_test:
+        stats = asyncio.run(load_test(args.load_test, args.turns, stub_latency=args.stub_llm or 0.5,
+                                      llm_workers=args.llm_workers))
+        print(f"{stats['sessions']} sessions ({stats['failed_sessions']} failed), {stats['turns']} turns "
+              f"in {stats['seconds']:.2f}s ({stats['turns_per_second']:.1f} turns/s)")
+        print(f"Turn latency p50 {stats['p50'] * 1000:.1f}ms  p95 {stats['p95'] * 1000:.1f}ms  p99 {stats['p99'] * 1000:.1f}ms")
+    else:
+        if args.stub_llm is not None:
+            game_loop.llm_backend = StubLLM(latency=args.stub_llm)
+        game_loop.stream_output = True
+        game_loop.room_context_tokens = args.room_context_tokens
+        if args.llm_workers:
+            game_loop.llm_client = LLMClient(game_loop.llm_backend or game_loop.openai_api().ChatCompletion,
+                                             workers=args.llm_workers).start()
+        if args.save_dir:
+            os.makedirs(args.save_dir, exist_ok=True)
+        if args.save_db:
+            from sqlite_store import SaveStore
+            game_loop.save_store = SaveStore(args.save_db, pool_size=8)
+        server = GameServer(args.host, args.port, args.max_sessions, args.idle_timeout, args.save_dir)
+        print(f"Serving on {args.host}:{args.port}")
+        asyncio.run(server.serve_forever())
@@ -0,0 +1,103 @@
+import sys
+import time
+
+# The player's inventory, kept as item -> count.
+# The inventory used to be a list with one string per item, so checking for a potion or using one
+# scanned the whole list, and a player with a hundred potions had a hundred strings. Counting each item
+# once makes adding, removing and checking for an item take the same time no matter how much the player
+# is carrying. Only items the player has at least one of are kept, so 'item in inventory' means they have it.
+#
+# Inventory is a dict, so it saves as a plain JSON object ({"health_potion": 2}) and compares equal to one.
+
+# What every item is and does. 'price' is what merchants sell it for
+ITEMS = {
+    "health_potion": {"name": "Health Potion", "price": 5, "effect": "heal", "amount": 10},
+    "key": {"name": "Key", "price": 10, "effect": "unlock"},
+}
+
+
+class Inventory(dict):
+    """Counts of the items the player is carrying."""
+
+    __slots__ = ()
+
+    # Counts of zero or less (from a hand-edited save, or set directly) are left out, so 'item in
+    # inventory' always means the player has one
+    def __init__(self, counts=(), **more):
+        super().__init__()
+        self.update(counts, **more)
+
+    def __setitem__(self, item, count):
+        if count > 0:
+            super().__setitem__(item, count)
+        else:
+            self.pop(item, None)
+
+    def update(self, counts=(), **more):
+        for item, count in dict(counts, **more).items():
+            self[item] = count
+
+    # Builds an inventory from either saved form: a list of item names (saves from before inventories
+    # were counted) or an item -> count mapping
+    @classmethod
+    def from_saved(cls, value):
+        """Create an inventory from a saved list of items or a mapping of counts."""
+        inventory = cls()
+        if isinstance(value, dict):
+            for item, count in value.items():
+                inventory.add(sys.intern(item), count)
+        else:
+            for item in value:
+                inventory.add(sys.intern(item))
+        return inventory
+
+    def add(self, item, amount=1):
+        if amount > 0:
+            self[item] = self.get(item, 0) + amount
+
+    # Takes items out. Returns False, and takes nothing, if there aren't enough
+    def remove(self, item, amount=1):
+        count = self.get(item, 0)
+        if count < amount:
+            return False
+        if count == amount:
+            del self[item]
+        else:
+            self[item] = count - amount
+        return True
+
+    def has(self, item, amount=1):
+        return self.get(item, 0) >= amount
+
+    def count(self, item):
+        return self.get(item, 0)
+
+    def total(self):
+        return sum(self.values())
+
+    # Lines for showing the inventory, one per kind of item ("health_potion x12")
+    def stacks(self):
+        return [item if count == 1 else f"{item} x{count}" for item, count in self.items()]
+
+
+# Times a potion check and use with a very full inventory, as a list and as an Inventory
+def benchmark(items=100_000, uses=1_000):
+    """Print the time to check for and use a potion with a large inventory."""
+    as_list = ["key"] * items + ["health_potion"] * uses
+    as_counts = Inventory.from_saved(as_list)
+    started = time.perf_counter()
+    for _ in range(uses):
+        if "health_potion" in as_list:
+            as_list.remove("health_potion")
+    list_time = (time.perf_counter() - started) / uses
+    started = time.perf_counter()
+    for _ in range(uses):
+        if as_counts.has("health_potion"):
+            as_counts.remove("health_potion")
+    counted_time = (time.perf_counter() - started) / uses
+    print(f"Potion use with {items:,} other items: list {list_time * 1e6:.1f} µs, "
+          f"counted {counted_time * 1e6:.2f} µs")
+
+
+if __name__ == "__main__":
+    benchmark()
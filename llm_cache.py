@@ -0,0 +1,108 @@
+import hashlib
+import json
+import random
+import sqlite3
+import threading
+import time
+
+# A cache of AI model responses kept in a small SQLite database.
+# Many prompts in the game are exactly the same every time (the merchant prompt, rooms connected to the castle),
+# so instead of paying for a new completion each time, the stored response is reused.
+# Each prompt can keep several different responses ('variants') so repeat prompts don't always read the same.
+
+
+class LLMCache:
+    """Store AI model responses on disk, keyed by a hash of the model and messages."""
+
+    def __init__(self, path="llm_cache.sqlite3", variants=3, max_entries=10000, ttl=None):
+        self.path = path
+        self.variants = variants          # Responses kept per prompt before repeats are served from the cache
+        self.max_entries = max_entries    # Size cap. The least recently used responses are evicted past this
+        self.ttl = ttl                    # Seconds a response stays valid, or None to keep them forever
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT NOT NULL,"
+            " variant INTEGER NOT NULL,"
+            " content TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (key, variant))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._db.commit()
+        # Responses stored, counted once here and kept up to date after, since COUNT(*) reads the whole table
+        self.entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    # The cache key: the same model and messages always hash to the same key
+    @staticmethod
+    def make_key(model, messages):
+        data = json.dumps({"model": model, "messages": messages}, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    # Returns a stored response, or None if the prompt needs a new completion.
+    # A prompt only counts as a hit once all of its variants have been filled
+    def get(self, model, messages):
+        """Look up a cached response for a prompt."""
+        key = self.make_key(model, messages)
+        now = time.time()
+        with self._lock:
+            if self.ttl is not None:
+                expired = self._db.execute("DELETE FROM responses WHERE key = ? AND created < ?", (key, now - self.ttl))
+                self.entries -= expired.rowcount
+            rows = self._db.execute("SELECT variant, content FROM responses WHERE key = ?", (key,)).fetchall()
+            if len(rows) < self.variants:
+                self.misses += 1
+                self._db.commit()
+                return None
+            variant, content = random.choice(rows)
+            self._db.execute("UPDATE responses SET last_used = ? WHERE key = ? AND variant = ?", (now, key, variant))
+            self._db.commit()
+            self.hits += 1
+            return content
+
+    # Stores a new response for a prompt, replacing its least recently used variant if it already has enough
+    def put(self, model, messages, content):
+        """Save a response for a prompt."""
+        key = self.make_key(model, messages)
+        now = time.time()
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT variant FROM responses WHERE key = ? ORDER BY last_used", (key,)
+            ).fetchall()
+            if len(rows) < self.variants:
+                used = {row[0] for row in rows}
+                variant = next(v for v in range(len(rows) + 1) if v not in used)
+                self.entries += 1
+            else:
+                variant = rows[0][0]
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, variant, content, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, variant, content, now, now),
+            )
+            self._evict()
+            self._db.commit()
+
+    # Removes the least recently used responses until the cache is back under its size cap
+    def _evict(self):
+        extra = self.entries - self.max_entries
+        if extra > 0:
+            evicted = self._db.execute(
+                "DELETE FROM responses WHERE rowid IN (SELECT rowid FROM responses ORDER BY last_used LIMIT ?)",
+                (extra,),
+            ).rowcount
+            self.entries -= evicted
+            self.evictions += evicted
+
+    def stats(self):
+        """Return the cache counters."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": self.entries}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,248 @@
+import itertools
+import queue
+import random
+import threading
+import time
+
+from llm_stream import delta_text
+
+# One shared client for every request to the AI model.
+# Requests are queued and sent by a small pool of worker threads, which keeps the number of open
+# connections bounded and stays under the API's requests-per-minute and tokens-per-minute limits.
+# Identical prompts that are already on their way share one request, failed requests are retried
+# with exponential backoff, and a room the player is waiting on goes ahead of background prefetches.
+
+# Priority lanes. Lower numbers are sent first
+PRIORITY_INTERACTIVE = 0   # The player is waiting on this response
+PRIORITY_PREFETCH = 10     # Generated ahead of time in the background
+
+# Errors that won't be fixed by trying again (matched by class name, so the OpenAI package isn't needed)
+NON_RETRYABLE_ERRORS = {"InvalidRequestError", "AuthenticationError", "PermissionError"}
+
+
+class TokenBucket:
+    """Allow up to 'rate' units per minute, with bursts up to one minute's worth."""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Waits until 'amount' units are available and takes them
+    def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+                wait = (amount - self.available) / self.rate
+            time.sleep(wait)
+
+    # Adjusts for the difference between the estimated and the actual amount used
+    def settle(self, amount):
+        with self._lock:
+            self._refill()
+            self.available = min(self.capacity, self.available - amount)
+
+
+# A rough token count for rate limiting: about four characters per token
+def estimate_tokens(messages, completion_tokens=300):
+    return sum(len(message["content"]) for message in messages) // 4 + completion_tokens
+
+
+# concurrent.futures (and the logging package it loads) is imported when the first request is made, so
+# importing this module for its priorities doesn't slow down starting the game
+def _future():
+    from concurrent.futures import Future
+    return Future()
+
+
+class _Request:
+    def __init__(self, key, model, messages):
+        self.key = key
+        self.model = model
+        self.messages = messages
+        self.future = _future()
+        self.started = False
+
+
+class LLMClient:
+    """Send chat completions through a rate-limited, deduplicating worker pool."""
+
+    def __init__(self, backend, workers=4, requests_per_minute=3500, tokens_per_minute=90000,
+                 max_retries=5, base_delay=0.5, max_delay=30.0):
+        self.backend = backend          # Object with create(model=..., messages=...), like openai.ChatCompletion
+        self.workers = workers
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.submitted = 0
+        self.coalesced = 0              # Requests that joined an identical request already in flight
+        self.completed = 0
+        self.retries = 0
+        self.failures = 0
+        self.streams = 0
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()  # Keeps requests with the same priority in arrival order
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self._running = False
+
+    def start(self):
+        if self._running:
+            return self
+        self._running = True
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"llm-worker-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        for _ in self._threads:
+            self._queue.put((float("inf"), next(self._order), None))
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    # Queues a request and returns a future for the response text.
+    # If the same prompt is already queued or being sent, the caller shares that request instead. When
+    # the new caller is more urgent, the shared request is also queued again in the faster lane
+    def submit(self, model, messages, priority=PRIORITY_INTERACTIVE):
+        """Queue a chat completion and return a Future for its text."""
+        from llm_cache import LLMCache  # Imported here for the same reason as _future(): it loads sqlite3
+
+        key = LLMCache.make_key(model, messages)
+        with self._lock:
+            self.submitted += 1
+            request = self._in_flight.get(key)
+            if request is not None:
+                self.coalesced += 1
+                if not request.started:
+                    self._queue.put((priority, next(self._order), request))
+                return request.future
+            request = _Request(key, model, messages)
+            self._in_flight[key] = request
+        self._queue.put((priority, next(self._order), request))
+        return request.future
+
+    def complete(self, model, messages, priority=PRIORITY_INTERACTIVE):
+        """Send a chat completion and wait for its text."""
+        return self.submit(model, messages, priority).result()
+
+    # Streams a response on the calling thread, since the caller reads it as it arrives.
+    # It still waits for the rate limits, and retries if the request fails before any text comes back
+    def stream(self, model, messages):
+        """Send a streaming chat completion and yield its text as it arrives."""
+        with self._lock:
+            self.streams += 1
+        estimate = estimate_tokens(messages)
+        for attempt in range(self.max_retries + 1):
+            self.requests.acquire()
+            self.tokens.acquire(estimate)
+            try:
+                chunks = iter(self.backend.create(model=model, messages=messages, stream=True))
+                first = next(chunks, None)
+            except Exception as error:
+                if type(error).__name__ in NON_RETRYABLE_ERRORS or attempt == self.max_retries:
+                    with self._lock:
+                        self.failures += 1
+                    raise
+                self._backoff(attempt)
+                continue
+            break
+        if first is not None:
+            yield from delta_text(itertools.chain([first], chunks))
+        with self._lock:
+            self.completed += 1
+
+    # Sleeps before retry number 'attempt', doubling each time, with jitter so retries don't line up
+    def _backoff(self, attempt):
+        with self._lock:
+            self.retries += 1
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def _work(self):
+        while True:
+            _, _, request = self._queue.get()
+            if request is None:
+                return
+            with self._lock:
+                if request.started:
+                    continue  # Already picked up from another lane
+                request.started = True
+            try:
+                result = self._send(request)
+            except Exception as error:
+                with self._lock:
+                    self.failures += 1
+                request.future.set_exception(error)
+            else:
+                with self._lock:
+                    self.completed += 1
+                request.future.set_result(result)
+            finally:
+                with self._lock:
+                    self._in_flight.pop(request.key, None)
+
+    # Sends one request, waiting for the rate limits and retrying errors with exponential backoff
+    def _send(self, request):
+        estimate = estimate_tokens(request.messages)
+        for attempt in range(self.max_retries + 1):
+            self.requests.acquire()
+            self.tokens.acquire(estimate)
+            try:
+                response = self.backend.create(model=request.model, messages=request.messages)
+            except Exception as error:
+                if type(error).__name__ in NON_RETRYABLE_ERRORS or attempt == self.max_retries:
+                    raise
+                self._backoff(attempt)
+                continue
+            usage = response.get("usage") or {}
+            if "total_tokens" in usage:
+                self.tokens.settle(usage["total_tokens"] - estimate)
+            return response["choices"][0]["message"]["content"].strip()
+
+    def stats(self):
+        """Return the client's counters."""
+        with self._lock:
+            return {
+                "submitted": self.submitted,
+                "coalesced": self.coalesced,
+                "completed": self.completed,
+                "retries": self.retries,
+                "failures": self.failures,
+                "streams": self.streams,
+                "queued": self._queue.qsize(),
+                "in_flight": len(self._in_flight),
+            }
+
+
+# Makes the OpenAI package reuse a pool of HTTP connections (one per worker) instead of opening a
+# new connection for every request
+def use_pooled_http_session(openai_module, workers=4):
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    openai_module.requestssession = session
+    return session
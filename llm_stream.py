@@ -0,0 +1,64 @@
+import threading
+import time
+
+import metrics
+
+# Streaming AI model responses.
+# With stream=True the API sends a reply in small chunks as it's generated. Showing each chunk as it
+# arrives means the player starts reading after the first few words instead of waiting for the whole
+# description, so how long a room "takes" is the time to the first token, not the time to the last.
+
+
+# Pulls the text out of the API's streamed chunks, skipping the ones that carry no text
+# (the role at the start and the finish reason at the end)
+def delta_text(chunks):
+    for chunk in chunks:
+        text = chunk["choices"][0].get("delta", {}).get("content")
+        if text:
+            yield text
+
+
+class StreamStats:
+    """Time to first token and total time of streamed responses."""
+
+    def __init__(self):
+        self.first_token = metrics.Histogram()  # Seconds from the request to the first piece of text
+        self.total = metrics.Histogram()        # Seconds from the request to the end of the response
+        self.cached = 0                         # Responses replayed from the cache instead of generated
+        self._lock = threading.Lock()           # Game server sessions stream at the same time
+
+    def record(self, first_token, total, cached=False):
+        with self._lock:
+            self.first_token.observe(first_token)
+            self.total.observe(total)
+            if cached:
+                self.cached += 1
+
+    def summary(self):
+        """Return the count and the average and median timings."""
+        def average(histogram):
+            return histogram.sum / histogram.count if histogram.count else 0.0
+
+        with self._lock:
+            return {
+                "streams": self.total.count,
+                "cached": self.cached,
+                "first_token_avg": average(self.first_token),
+                "first_token_p50": self.first_token.percentiles((0.5,))[0],
+                "total_avg": average(self.total),
+                "total_p50": self.total.percentiles((0.5,))[0],
+            }
+
+
+# Passes the pieces of a stream through while timing it. 'started' is when the request was made,
+# so connecting and waiting for the model count towards the time to the first token
+def timed(pieces, stats, started=None, cached=False):
+    started = time.perf_counter() if started is None else started
+    first_token = None
+    for text in pieces:
+        if first_token is None:
+            first_token = time.perf_counter() - started
+        yield text
+    total = time.perf_counter() - started
+    if stats is not None:
+        stats.record(total if first_token is None else first_token, total, cached)
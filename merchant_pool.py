@@ -0,0 +1,112 @@
+import threading
+import time
+
+# A pool of merchant descriptions generated ahead of time.
+# A background thread keeps the pool topped up by asking the AI model for several merchants in one
+# completion, so when a traveling merchant appears the description is handed out instantly.
+
+
+class MerchantPool:
+    """Keep a supply of pre-generated merchant descriptions."""
+
+    def __init__(self, generate_batch, size=6, low_water=2, batch_size=3):
+        self.generate_batch = generate_batch  # Blocking function: generate_batch(count) -> list of descriptions
+        self.size = size                      # Most descriptions the pool will hold
+        self.low_water = low_water            # The pool is refilled when it drops below this many descriptions
+        self.batch_size = batch_size          # Descriptions requested per completion
+        self.served = 0                       # Encounters served straight from the pool
+        self.misses = 0                       # Encounters that found the pool empty
+        self.refills = 0                      # Batched completions made to refill the pool
+        self.generated = 0                    # Descriptions added to the pool in total
+        self.failures = 0                     # Refills that raised an error or came back with no descriptions
+        self.last_refill_time = 0.0           # Seconds the most recent refill took
+        self._descriptions = []
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    # Starts the background refill thread. It fills the pool up right away
+    def start(self):
+        if self._thread is not None:
+            return self
+        self._running = True
+        self._thread = threading.Thread(target=self._refill_loop, name="merchant-pool", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is None:
+            return
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        self._thread.join()
+        self._thread = None
+
+    # Waits until the pool runs low, then refills it to its full size one batch at a time
+    def _refill_loop(self):
+        while True:
+            with self._condition:
+                while self._running and len(self._descriptions) >= self.low_water:
+                    self._condition.wait()
+                if not self._running:
+                    return
+            while self._running and len(self) < self.size:
+                if not self.refill():
+                    time.sleep(1.0)  # Back off a little before trying again after an error
+                    break
+
+    # Makes one batched completion and adds its descriptions to the pool.
+    # Returns False if the completion failed, or gave nothing usable (like a reply that ignored the
+    # '---' separators and split into blanks), so the refill thread backs off instead of asking again at once
+    def refill(self):
+        """Request a batch of merchant descriptions and add them to the pool."""
+        count = min(self.batch_size, max(1, self.size - len(self)))
+        started = time.perf_counter()
+        try:
+            descriptions = [description for description in self.generate_batch(count) if description]
+        except Exception:
+            descriptions = []
+        with self._condition:
+            if not descriptions:
+                self.failures += 1
+                return False
+            self.refills += 1
+            self.last_refill_time = time.perf_counter() - started
+            # A reply with more merchants than were asked for doesn't push the pool past its size
+            descriptions = descriptions[:min(count, max(0, self.size - len(self._descriptions)))]
+            self._descriptions.extend(descriptions)
+            self.generated += len(descriptions)
+        return True
+
+    # Hands out a description straight from the pool, or None if it's empty so the caller can generate one.
+    # Taking from the pool wakes the refill thread when it drops below the low-water mark
+    def take(self):
+        """Return a pre-generated merchant description, or None."""
+        with self._condition:
+            if not self._descriptions:
+                self.misses += 1
+                self._condition.notify_all()
+                return None
+            description = self._descriptions.pop(0)
+            self.served += 1
+            if len(self._descriptions) < self.low_water:
+                self._condition.notify_all()
+            return description
+
+    def __len__(self):
+        with self._condition:
+            return len(self._descriptions)
+
+    def stats(self):
+        """Return the pool size and refill counters."""
+        with self._condition:
+            return {
+                "pool_size": len(self._descriptions),
+                "served": self.served,
+                "misses": self.misses,
+                "refills": self.refills,
+                "generated": self.generated,
+                "failures": self.failures,
+                "last_refill_time": self.last_refill_time,
+            }
@@ -0,0 +1,284 @@
+import json
+import os
+import random
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+
+# Timers and counters for where a turn's time goes.
+# The game marks its phases (waiting for the player, waiting for the AI model, saving, loading, combat)
+# with 'with metrics.phase("name"):' and counts things with metrics.count("name", amount). Nothing is
+# collected until enable() is called: until then phase() hands back one shared do-nothing timer and
+# count() returns right away, so the marks cost a function call each.
+#
+# Collected metrics can be written as JSON or as Prometheus text for dashboards. An optional sampling
+# profiler records where the game thread is every few milliseconds, in the collapsed-stack format that
+# flame graph tools read.
+#
+# The console game collects metrics when METRICS_FILE is set (a .json name writes JSON, anything else
+# Prometheus text), rewriting the file every turn, and profiles when PROFILE_FILE is set.
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SAMPLES = 4096  # Durations kept per phase for percentiles (a random sample once there are more)
+
+
+class Histogram:
+    """Durations of one phase: bucket counts, totals and a sample for percentiles."""
+
+    __slots__ = ("count", "sum", "buckets", "samples", "_rng")
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)  # The last bucket is everything over the largest bound
+        self.samples = []
+        self._rng = random.Random(0)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+        # Reservoir sampling keeps every duration equally likely to be in the sample
+        if len(self.samples) < SAMPLES:
+            self.samples.append(seconds)
+        else:
+            index = int(self._rng.random() * self.count)
+            if index < SAMPLES:
+                self.samples[index] = seconds
+
+    def percentiles(self, fractions=(0.5, 0.95, 0.99)):
+        ordered = sorted(self.samples)
+        if not ordered:
+            return [0.0 for _ in fractions]
+        return [ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] for fraction in fractions]
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "started")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.started)
+        return False
+
+
+class Metrics:
+    """Counters and phase histograms, safe to update from any thread."""
+
+    def __init__(self):
+        self.counters = Counter()
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def timer(self, name):
+        return _Timer(self, name)
+
+    def snapshot(self):
+        """Return the counters and each phase's count, total and p50/p95/p99 in seconds."""
+        with self.lock:
+            phases = {}
+            for name, histogram in sorted(self.histograms.items()):
+                p50, p95, p99 = histogram.percentiles()
+                phases[name] = {"count": histogram.count, "sum": histogram.sum, "p50": p50, "p95": p95, "p99": p99}
+            return {"uptime": time.time() - self.started, "counters": dict(sorted(self.counters.items())),
+                    "phases": phases}
+
+    def prometheus(self):
+        """Return the metrics in the Prometheus text format."""
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE game_{name}_total counter")
+                lines.append(f"game_{name}_total {value}")
+            if self.histograms:
+                lines.append("# TYPE game_phase_seconds histogram")
+            for name, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, bucket in zip(BUCKETS + ("+Inf",), histogram.buckets):
+                    cumulative += bucket
+                    lines.append(f'game_phase_seconds_bucket{{phase="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'game_phase_seconds_sum{{phase="{name}"}} {histogram.sum:.6f}')
+                lines.append(f'game_phase_seconds_count{{phase="{name}"}} {histogram.count}')
+            if self.histograms:
+                lines.append("# TYPE game_phase_quantile_seconds gauge")
+            for name, histogram in sorted(self.histograms.items()):
+                for quantile, value in zip(("0.5", "0.95", "0.99"), histogram.percentiles()):
+                    lines.append(f'game_phase_quantile_seconds{{phase="{name}",quantile="{quantile}"}} {value:.6f}')
+        return "\n".join(lines) + "\n"
+
+    # Writes to a temporary file first, so a dashboard never reads half a file
+    def write(self, filename):
+        """Write the metrics as JSON (for .json names) or Prometheus text."""
+        if filename.endswith(".json"):
+            data = json.dumps(self.snapshot(), indent=2)
+        else:
+            data = self.prometheus()
+        with open(filename + ".tmp", "w") as file:
+            file.write(data)
+        os.replace(filename + ".tmp", filename)
+
+    def report(self):
+        """Return a table of the phases, slowest total first."""
+        snapshot = self.snapshot()
+        lines = [f"{'phase':>22} {'count':>7} {'total s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"]
+        for name, phase in sorted(snapshot["phases"].items(), key=lambda item: -item[1]["sum"]):
+            lines.append(f"{name:>22} {phase['count']:>7} {phase['sum']:>9.3f} {phase['p50'] * 1000:>9.3f} "
+                         f"{phase['p95'] * 1000:>9.3f} {phase['p99'] * 1000:>9.3f}")
+        for name, value in snapshot["counters"].items():
+            lines.append(f"{name:>22} {value:>7}")
+        return "\n".join(lines)
+
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_TIMER = _NoTimer()
+
+# The metrics being collected, or None when they're off
+collector = None
+
+
+def enable():
+    """Start collecting metrics and return the collector."""
+    global collector
+    if collector is None:
+        collector = Metrics()
+    return collector
+
+
+def disable():
+    global collector
+    collector = None
+
+
+# Times a phase: 'with metrics.phase("save"):'
+def phase(name):
+    return _NO_TIMER if collector is None else _Timer(collector, name)
+
+
+def count(name, amount=1):
+    if collector is not None:
+        collector.count(name, amount)
+
+
+def observe(name, seconds):
+    if collector is not None:
+        collector.observe(name, seconds)
+
+
+class SamplingProfiler:
+    """Samples a thread's stack at an interval and counts the stacks it sees."""
+
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.main_thread().ident
+        self.stacks = Counter()  # "file:function;file:function;..." from the outermost call -> samples
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    # The functions seen most often, counting a sample for every function on the stack
+    def top(self, limit=15):
+        """Return (function, share of samples it was on the stack for) for the busiest functions."""
+        functions = Counter()
+        for stack, samples in self.stacks.items():
+            for function in set(stack.split(";")):
+                functions[function] += samples
+        return [(function, samples / max(1, self.samples)) for function, samples in functions.most_common(limit)]
+
+    def write(self, filename):
+        """Write the samples as collapsed stacks (one 'stack count' per line) for flame graph tools."""
+        with open(filename, "w") as file:
+            for stack, samples in self.stacks.most_common():
+                file.write(f"{stack} {samples}\n")
+
+
+# Measures what the marks cost with metrics off and on, then plays simulated games with metrics and
+# the profiler on and prints where the time went
+def benchmark(marks=1_000_000, games=200):
+    """Print the overhead of phase timers and a per-phase report of simulated games."""
+    disable()
+    started = time.perf_counter()
+    for _ in range(marks):
+        with phase("bench"):
+            pass
+    off = (time.perf_counter() - started) / marks
+    enable()
+    started = time.perf_counter()
+    for _ in range(marks):
+        with phase("bench"):
+            pass
+    on = (time.perf_counter() - started) / marks
+    disable()
+    print(f"Phase timer: {off * 1e9:.0f} ns with metrics off, {on * 1e9:.0f} ns with metrics on")
+
+    import simulation
+    simulation._init_worker()
+    metrics = enable()
+    profiler = SamplingProfiler(interval=0.001).start()
+    for seed in range(games):
+        simulation.simulate_game(seed)
+    profiler.stop()
+    print(f"\n{games} simulated games:")
+    print(metrics.report())
+    print(f"\nBusiest functions ({profiler.samples} samples):")
+    for function, share in profiler.top(10):
+        print(f"{share:>7.1%}  {function}")
+    disable()
+
+
+if __name__ == "__main__":
+    # The game imports this module as 'metrics', so run the benchmark there rather than in __main__
+    import metrics
+    metrics.benchmark()
@@ -0,0 +1,392 @@
+import argparse
+import gzip
+import hashlib
+import json
+import time
+
+from content import GameRNG, game_rng
+from entities import to_json
+from save_schema import from_save_data, to_save_data
+
+# Recording and replaying game sessions.
+# A session depends on three things from outside the game: the dice, the player's input and the AI
+# model's text. The recorder writes all three to a log, one JSON event per line (gzipped if the name ends
+# in .gz): the seed and starting state, then every answer the player gives and every AI response the game
+# uses, in the order the game uses them. The replayer plays the session again from that log with no
+# input, output or network, as fast as the game rules run, and can stop at any turn to look at the state.
+#
+#   python replay.py session.jsonl.gz                          replay a session and check it comes out the same
+#   python replay.py session.jsonl.gz --to-turn 40 --save s.json   stop before turn 40 and save the game there
+#   python replay.py session.jsonl.gz --show 38                show the game's output from turn 38 on
+#   python replay.py session.jsonl.gz --bench 20               time 20 replays
+#   python replay.py --record-sim sim.jsonl.gz --seed 7        record a simulated game (offline stub AI)
+#
+# The console game records a session when REPLAY_LOG is set.
+
+REPLAY_VERSION = 1
+
+
+class ReplayError(Exception):
+    """The game did something the replay log doesn't have: the session didn't replay the same way."""
+
+
+def open_log(filename, mode="r"):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, mode + "t", encoding="utf-8")
+    return open(filename, mode, encoding="utf-8")
+
+
+# A short fingerprint of a game state, to check a replay ended where the session did
+def state_digest(game_state, current_location):
+    data = dict(to_save_data(game_state), current_location=current_location)
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=to_json).encode("utf-8")).hexdigest()[:16]
+
+
+class Recorder:
+    """Writes a replay log of one session."""
+
+    def __init__(self, filename, seed, game_state, current_location, stream_output=False,
+                 prefetch=False, merchant_pool=False, world_pack=None, room_context_tokens=0):
+        self.file = open_log(filename, "w")
+        self.turns = 0
+        # Whether rooms and merchants were generated ahead of time changes when the game asks for
+        # text, so the replay sets the game up the same way. A world pack is replayed from the same pack file,
+        # and room prompts get the same amount of world context
+        self._write({"event": "start", "version": REPLAY_VERSION, "seed": seed, "current_location": current_location,
+                     "stream_output": stream_output, "prefetch": prefetch, "merchant_pool": merchant_pool,
+                     "world_pack": None if world_pack is None else {"file": world_pack.filename, "id": world_pack.pack_id},
+                     "room_context_tokens": room_context_tokens,
+                     "state": to_save_data(game_state)})
+
+    def _write(self, event):
+        self.file.write(json.dumps(event, default=to_json) + "\n")
+
+    # Marks the start of a turn. Where the player is and their HP and gold let a replay catch a
+    # difference on the turn it happens. The log is flushed every turn, so a crash keeps all but the last
+    def turn(self, game_state, current_location):
+        self.turns += 1
+        player = game_state["player"]
+        self._write({"event": "turn", "turn": self.turns, "location": current_location,
+                     "hp": player["current_hp"], "gold": player["gold"]})
+        self.file.flush()
+
+    def input(self, text):
+        self._write({"event": "input", "text": text})
+
+    def llm(self, prompt, text):
+        self._write({"event": "llm", "prompt": prompt, "text": text})
+
+    def finish(self, game_state, current_location, outcome):
+        self._write({"event": "end", "turns": self.turns, "outcome": outcome,
+                     "digest": state_digest(game_state, current_location)})
+        self.close()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    # Wrappers for the game's input/output, room prefetcher and merchant pool that log what the game gets from them
+    def io(self, io):
+        return _RecordingIO(self, io)
+
+    def prefetcher(self, prefetcher):
+        return _RecordingPrefetcher(self, prefetcher)
+
+    def merchant_pool(self, pool):
+        return _RecordingMerchantPool(self, pool)
+
+
+class _Wrapper:
+    def __init__(self, recorder, wrapped):
+        self._recorder = recorder
+        self._wrapped = wrapped
+
+    def __getattr__(self, name):
+        return getattr(self._wrapped, name)
+
+
+class _RecordingIO(_Wrapper):
+    def ask(self, prompt):
+        text = self._wrapped.ask(prompt)
+        self._recorder.input(text)
+        return text
+
+
+class _RecordingPrefetcher(_Wrapper):
+    # Logs each exit the prefetcher makes a room prompt's context for. The context is kept for the exit and
+    # used when the player walks through it, so the replay has to make it at the same point
+    def prefetch(self, exits, context=None):
+        def logged_context(location, direction):
+            self._recorder._write({"event": "context", "location": location, "direction": direction})
+            return context(location, direction)
+        self._wrapped.prefetch(exits, logged_context if context is not None else None)
+
+    def take(self, location, direction, timeout=None):
+        text = self._wrapped.take(location, direction, timeout=timeout)
+        self._recorder._write({"event": "room", "location": location, "direction": direction, "text": text})
+        return text
+
+
+class _RecordingMerchantPool(_Wrapper):
+    def take(self):
+        text = self._wrapped.take()
+        self._recorder._write({"event": "merchant", "text": text})
+        return text
+
+
+class ReplayLog:
+    """The events of a recorded session, handed out in order as the replayed game asks for them."""
+
+    def __init__(self, filename):
+        with open_log(filename) as file:
+            events = [json.loads(line) for line in file if line.strip()]
+        if not events or events[0].get("event") != "start":
+            raise ReplayError(f"{filename} isn't a replay log")
+        if events[0]["version"] > REPLAY_VERSION:
+            raise ReplayError(f"Replay log version {events[0]['version']} is newer than this game supports")
+        self.header = events[0]
+        self.events = events[1:]
+        self.position = 0
+        self.turn = 0
+        # A session that crashed has no end event
+        self.end = self.events[-1] if self.events and self.events[-1]["event"] == "end" else None
+
+    def peek(self):
+        return self.events[self.position]["event"] if self.position < len(self.events) else None
+
+    def next(self, kind):
+        if self.position >= len(self.events):
+            raise ReplayError(f"Turn {self.turn}: the game asked for {kind}, but the log has ended")
+        event = self.events[self.position]
+        if event["event"] != kind:
+            raise ReplayError(f"Turn {self.turn}: the game asked for {kind}, but the log has {event['event']}")
+        self.position += 1
+        return event
+
+
+class _ReplayIO:
+    def __init__(self, log):
+        self.log = log
+        self.show = False  # Print the game's output (from the turn being looked at)
+
+    def ask(self, prompt):
+        text = self.log.next("input")["text"]
+        if self.show:
+            print(prompt + text)
+        return text
+
+    def say(self, text=""):
+        if self.show:
+            print(text)
+
+    def write(self, text):
+        if self.show:
+            print(text, end="")
+
+
+# Answers chat completions from the log, in the same shape as the API
+class _ReplayBackend:
+    def __init__(self, log):
+        self.log = log
+
+    def create(self, model, messages, stream=False):
+        event = self.log.next("llm")
+        if event["prompt"] != messages[-1]["content"]:
+            raise ReplayError(f"Turn {self.log.turn}: the game sent a different prompt than the log has:\n"
+                              f"  game: {messages[-1]['content']}\n  log:  {event['prompt']}")
+        if stream:
+            return [{"choices": [{"delta": {"content": event["text"]}}]}]
+        return {"choices": [{"message": {"role": "assistant", "content": event["text"]}}]}
+
+
+class _ReplayPrefetcher:
+    depth = 0  # Nothing to look ahead for
+
+    def __init__(self, log):
+        self.log = log
+
+    def prefetch(self, exits, context=None):
+        while self.log.peek() == "context":
+            event = self.log.next("context")
+            if context is not None:
+                context(event["location"], event["direction"])
+
+    def take(self, location, direction, timeout=None):
+        event = self.log.next("room")
+        if (event["location"], event["direction"]) != (location, direction):
+            raise ReplayError(f"Turn {self.log.turn}: the game took room {location} {direction}, "
+                              f"but the log has {event['location']} {event['direction']}")
+        return event["text"]
+
+
+class _ReplayMerchantPool:
+    def __init__(self, log):
+        self.log = log
+
+    def take(self):
+        return self.log.next("merchant")["text"]
+
+
+# Opens the world pack a session was recorded with, which has to be the same pack
+def _replay_world_pack(recorded):
+    if recorded is None:
+        return None
+    from world_pack import WorldPack
+    try:
+        pack = WorldPack(recorded["file"])
+    except FileNotFoundError:
+        raise ReplayError(f"The session was played with the world pack {recorded['file']}, which is missing")
+    if pack.pack_id != recorded["id"]:
+        raise ReplayError(f"{recorded['file']} isn't the world pack the session was played with")
+    return pack
+
+
+def replay(filename, to_turn=None, show_from=None):
+    """Play a recorded session again without input, output or network.
+
+    Stops before turn 'to_turn' if it's given. Returns the game state, the player's location, the turns
+    played and the outcome, and raises ReplayError if the game doesn't do what the log says it did.
+    """
+    import game_loop
+
+    log = ReplayLog(filename)
+    header = log.header
+    game_state = game_loop.state_from_save(from_save_data(header["state"]))
+    current_location = header["current_location"]
+    io = _ReplayIO(log)
+    world_pack = _replay_world_pack(header.get("world_pack"))
+
+    # Everything the game would get from outside comes from the log instead
+    saved = {name: getattr(game_loop, name) for name in
+             ("llm_backend", "llm_client", "llm_cache", "room_prefetcher", "merchant_pool", "stream_output", "replay_log",
+              "world_pack", "start_llm_services", "room_context_tokens")}
+    game_loop.llm_backend = _ReplayBackend(log)
+    game_loop.llm_client = None
+    game_loop.llm_cache = None
+    game_loop.room_prefetcher = None
+    game_loop.merchant_pool = None
+
+    # The session's prefetcher and merchant pool started when the game first needed them, and looking for
+    # exits to prefetch builds the room graph, so the replay's start at the same point
+    def start_services():
+        game_loop.room_prefetcher = _ReplayPrefetcher(log) if header["prefetch"] else None
+        game_loop.merchant_pool = _ReplayMerchantPool(log) if header["merchant_pool"] else None
+    game_loop.start_llm_services = start_services
+    game_loop.stream_output = header["stream_output"]
+    game_loop.replay_log = None
+    game_loop.world_pack = world_pack
+    game_loop.room_context_tokens = header.get("room_context_tokens", 0)
+    io_token = game_loop.game_io.set(io)
+    rng_token = game_rng.set(GameRNG(header["seed"]))
+    outcome = None
+    try:
+        while log.peek() == "turn" and (to_turn is None or log.turn + 1 < to_turn):
+            event = log.next("turn")
+            log.turn = event["turn"]
+            player = game_state["player"]
+            played = {"location": current_location, "hp": player["current_hp"], "gold": player["gold"]}
+            recorded = {key: event[key] for key in played}
+            if played != recorded:
+                raise ReplayError(f"Turn {log.turn} starts differently: replay {played}, log {recorded}")
+            io.show = show_from is not None and log.turn >= show_from
+            current_location, outcome = game_loop.play_turn(game_state, current_location)
+            if log.peek() not in ("turn", "end", None):
+                raise ReplayError(f"Turn {log.turn} ended before using everything the log has for it "
+                                  f"(next: {log.peek()})")
+            if outcome is not None:
+                break
+    finally:
+        game_rng.reset(rng_token)
+        game_loop.game_io.reset(io_token)
+        for name, value in saved.items():
+            setattr(game_loop, name, value)
+
+    # A whole replay has to end exactly where the session did
+    if to_turn is None and log.end is not None:
+        if (outcome or "survived", log.turn) != (log.end["outcome"], log.end["turns"]) or \
+                state_digest(game_state, current_location) != log.end["digest"]:
+            raise ReplayError(f"The replay ended differently from the session "
+                              f"(turn {log.turn}, {outcome}; the log has turn {log.end['turns']}, {log.end['outcome']})")
+    return {"game_state": game_state, "location": current_location, "turns": log.turn, "outcome": outcome}
+
+
+# Records a game played by a simulation policy with the offline stub AI, for a replay corpus
+def record_simulated(filename, seed=0, max_turns=200, policy="greedy"):
+    """Play and record a simulated game. Returns the number of turns played."""
+    import random
+
+    import game_loop
+    from simulation import POLICIES
+    from stub_llm import StubLLM
+
+    saved = {name: getattr(game_loop, name) for name in
+             ("llm_backend", "llm_client", "llm_cache", "room_prefetcher", "merchant_pool", "stream_output", "replay_log",
+              "world_pack", "room_context_tokens")}
+    game_loop.llm_backend = StubLLM(seed=seed)
+    game_loop.llm_client = game_loop.llm_cache = game_loop.room_prefetcher = game_loop.merchant_pool = None
+    game_loop.stream_output = False
+    game_loop.world_pack = None
+    game_loop.room_context_tokens = 0
+    game_state = game_loop.new_game_state()
+    current_location = game_state["current_location"]
+    recorder = game_loop.replay_log = Recorder(filename, seed, game_state, current_location)
+    io_token = game_loop.game_io.set(recorder.io(POLICIES[policy](random.Random(seed), game_state)))
+    rng_token = game_rng.set(GameRNG(seed))
+    try:
+        outcome = None
+        for _ in range(max_turns):
+            recorder.turn(game_state, current_location)
+            current_location, outcome = game_loop.play_turn(game_state, current_location)
+            if outcome is not None:
+                break
+        recorder.finish(game_state, current_location, outcome or "survived")
+    finally:
+        recorder.close()
+        game_rng.reset(rng_token)
+        game_loop.game_io.reset(io_token)
+        for name, value in saved.items():
+            setattr(game_loop, name, value)
+    return recorder.turns
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded game session.")
+    parser.add_argument("log", nargs="?", help="replay log (.jsonl or .jsonl.gz)")
+    parser.add_argument("--to-turn", type=int, help="stop before this turn")
+    parser.add_argument("--show", type=int, metavar="TURN", help="show the game's output from this turn on")
+    parser.add_argument("--save", help="save the game where the replay stopped, to play on from there")
+    parser.add_argument("--bench", type=int, metavar="TIMES", help="time this many replays of the log")
+    parser.add_argument("--record-sim", metavar="LOG", help="record a simulated game to this log")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--turns", type=int, default=200, help="turns for --record-sim")
+    args = parser.parse_args()
+
+    if args.record_sim:
+        turns = record_simulated(args.record_sim, args.seed, args.turns)
+        print(f"Recorded {turns} turns to {args.record_sim}")
+        args.log = args.log or args.record_sim
+    if not args.log:
+        parser.error("a replay log is needed")
+
+    if args.bench:
+        started = time.perf_counter()
+        for _ in range(args.bench):
+            result = replay(args.log)
+        elapsed = time.perf_counter() - started
+        turns = result["turns"] * args.bench
+        print(f"{args.bench} replays, {turns:,} turns in {elapsed:.2f}s "
+              f"({turns / elapsed:,.0f} turns/s, {elapsed / turns * 1e6:.0f} µs per turn)")
+        return
+
+    result = replay(args.log, args.to_turn, args.show)
+    player = result["game_state"]["player"]
+    print(f"Replayed {result['turns']} turns ({result['outcome'] or 'stopped'}) at {result['location']}: "
+          f"level {player.level}, {player.current_hp}/{player.max_hp} HP, {player.gold} gold")
+    if args.save:
+        import game_loop
+        game_loop.save_game(result["game_state"], result["location"], args.save)
+        print(f"Saved to {args.save}")
+
+
+if __name__ == "__main__":
+    main()
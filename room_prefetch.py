@@ -0,0 +1,86 @@
+import asyncio
+import threading
+
+# Speculative room generation.
+# While the player is reading a room description or fighting, the exits they haven't explored yet are
+# described in the background. When the player walks through one of those exits the description is
+# already waiting, so the move doesn't have to wait on the AI model at all.
+
+
+class RoomPrefetcher:
+    """Generate room descriptions for unexplored exits in the background."""
+
+    def __init__(self, generate, concurrency=2, depth=1):
+        self.generate = generate          # Blocking function: generate(location, direction) -> description
+        self.concurrency = concurrency    # How many descriptions can be generated at the same time
+        self.depth = depth                # How many rooms away from the player exits are prefetched
+        self.hits = 0                     # Moves served from a prefetched description
+        self.misses = 0                   # Moves that had to fall back to on-demand generation
+        self._pending = {}                # (location, direction) -> future holding the description
+        self._loop = None
+        self._thread = None
+        self._semaphore = None
+
+    # Starts the event loop the generations run on. The game loop itself stays synchronous
+    def start(self):
+        if self._loop is not None:
+            return self
+        self._loop = asyncio.new_event_loop()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._thread = threading.Thread(target=self._loop.run_forever, name="room-prefetch", daemon=True)
+        self._thread.start()
+        return self
+
+    # Cancels anything still being generated and shuts the event loop down
+    def stop(self):
+        if self._loop is None:
+            return
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+        self._thread = None
+
+    # Runs one generation on a worker thread, holding a slot of the concurrency limit while it runs
+    async def _generate(self, location, direction, *context):
+        async with self._semaphore:
+            return await self._loop.run_in_executor(None, self.generate, location, direction, *context)
+
+    # Schedules generation for each (location, direction) exit that isn't already being generated.
+    # Exits that are no longer near the player are dropped so the number of pending rooms stays bounded.
+    # If 'context' is given, context(location, direction) is called here, on the caller's thread, for each
+    # exit about to be generated, and what it returns is passed on to generate as a third argument
+    def prefetch(self, exits, context=None):
+        """Start generating descriptions for the given unexplored exits."""
+        if self._loop is None or self.depth <= 0:
+            return
+        exits = list(exits)
+        wanted = set(exits)
+        for key in list(self._pending):
+            if key not in wanted:
+                self._pending.pop(key).cancel()
+        for key in exits:
+            if key not in self._pending:
+                arguments = key + (context(*key),) if context is not None else key
+                self._pending[key] = asyncio.run_coroutine_threadsafe(self._generate(*arguments), self._loop)
+
+    # Hands over the description generated for an exit.
+    # If the generation is still running this waits for it, since it was started ahead of time.
+    # Returns None when nothing was prefetched or the generation failed, so the caller can generate on demand
+    def take(self, location, direction, timeout=None):
+        """Return the prefetched description for an exit, or None."""
+        future = self._pending.pop((location, direction), None)
+        if future is None:
+            self.misses += 1
+            return None
+        try:
+            description = future.result(timeout)
+        except Exception:
+            future.cancel()
+            self.misses += 1
+            return None
+        self.hits += 1
+        return description
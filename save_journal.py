@@ -0,0 +1,365 @@
+import copy
+import json
+import os
+import metrics
+from binary_save import is_binary_save, read_binary, write_binary
+from entities import Entity, to_json
+from save_schema import SAVE_VERSION, from_save_data, intern_string, to_save_data
+
+# Incremental saves.
+# Instead of rewriting the whole game state on every save, each save appends only what changed since the
+# last one (a room was added, a connection was made, a player stat or inventory count changed) to a journal
+# file next to the save. Every so often the journal is compacted: the full state is written as a new
+# snapshot and the journal starts over. Loading reads the snapshot and replays the journal on top of it.
+#
+# The snapshot is the normal save file (game_state.json, or a binary save for .bin files), so it still
+# loads on its own. The snapshot and
+# its journal share a generation number, so a journal left over from before a compaction is never replayed
+# onto the newer snapshot.
+#
+# Working out what changed doesn't look at the whole state either. The game notes each room it changes
+# with touch_room(), and the player keeps track of its own changed fields (entities.Entity.dirty_fields),
+# so a save only compares those rooms and fields with the saved copy. A state the journal hasn't saved
+# before (just loaded, copied, or last saved by something else) is compared in full once.
+
+# Flushes file data to disk. fdatasync skips the metadata update where the platform has it
+_sync = getattr(os, "fdatasync", os.fsync)
+
+
+# Flushes a directory's entries to disk, so a file just renamed into it is still there after a crash.
+# Windows can't open a directory to sync it (and its renames don't need it)
+def _sync_directory(filename):
+    if os.name != "posix":
+        return
+    directory = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+# The journal that goes with a save file
+def journal_path(filename):
+    return filename + ".journal"
+
+
+# Counts how many of each item are in an inventory (already counted, or a list from an older state)
+def _inventory_counts(inventory):
+    if isinstance(inventory, dict):
+        return inventory
+    counts = {}
+    for item in inventory:
+        counts[item] = counts.get(item, 0) + 1
+    return counts
+
+
+class DirtyRooms:
+    """The rooms changed in a game state since its last save, and the save that's keeping track."""
+
+    def __init__(self):
+        self.rooms = set()  # Ids of the rooms changed or added
+        self.owner = None   # What saved the state last and has kept track since (a journal, a store slot), or None
+
+    # A copy of the state hasn't been saved by anything, so its first save compares everything
+    def __copy__(self):
+        return DirtyRooms()
+
+    def __deepcopy__(self, memo):
+        return DirtyRooms()
+
+
+# The dirty rooms of a game state, kept under a '_' key like the room graph so they're never saved
+def dirty_rooms(state):
+    dirty = state.get("_dirty")
+    if dirty is None:
+        dirty = state["_dirty"] = DirtyRooms()
+    return dirty
+
+
+def touch_room(state, room_id):
+    """Note that a room was added or changed, so the next save looks at it."""
+    dirty_rooms(state).rooms.add(room_id)
+
+
+# Compares the last saved state with the current state and lists the changes as journal entries.
+# 'rooms' and 'player_fields' limit it to the rooms and player fields known to have changed; left
+# as None, every room and field is compared
+def diff_state(saved, state, rooms=None, player_fields=None):
+    """Return the journal entries that turn the saved state into the current state."""
+    ops = []
+    for key, value in state.items():
+        if key.startswith("_"):
+            continue  # Never saved (see save_schema.to_save_data)
+        elif key == "player":
+            saved_player = saved.get("player", {})
+            fields = value.items() if player_fields is None else [(field, value[field]) for field in player_fields]
+            for field, field_value in fields:
+                if field == "inventory":
+                    saved_counts = _inventory_counts(saved_player.get("inventory", []))
+                    counts = _inventory_counts(field_value)
+                    for item in saved_counts.keys() | counts.keys():
+                        if saved_counts.get(item, 0) != counts.get(item, 0):
+                            ops.append({"op": "inventory", "item": item, "count": counts.get(item, 0)})
+                elif saved_player.get(field) != field_value or field not in saved_player:
+                    ops.append({"op": "player", "field": field, "value": field_value})
+        elif key == "locations":
+            saved_locations = saved.get("locations", {})
+            changed = value.items() if rooms is None else [(room_id, value[room_id]) for room_id in rooms if room_id in value]
+            for room_id, room in changed:
+                if room_id not in saved_locations:
+                    ops.append({"op": "room", "id": room_id, "value": room})
+                    continue
+                saved_room = saved_locations[room_id]
+                for field, field_value in room.items():
+                    if field == "connections":
+                        saved_connections = saved_room.get("connections", {})
+                        for direction, target in field_value.items():
+                            if saved_connections.get(direction) != target:
+                                ops.append({"op": "connection", "id": room_id, "direction": direction, "target": target})
+                    elif saved_room.get(field) != field_value or field not in saved_room:
+                        ops.append({"op": "room_field", "id": room_id, "field": field, "value": field_value})
+        elif key == "dynamic_rooms":
+            # Generated rooms are the same objects as their entries in 'locations', so only new ids are recorded
+            saved_dynamic = saved.get("dynamic_rooms", {})
+            for room_id in (value if rooms is None else [room_id for room_id in rooms if room_id in value]):
+                if room_id not in saved_dynamic:
+                    ops.append({"op": "dynamic_room", "id": room_id})
+        elif saved.get(key) != value or key not in saved:
+            ops.append({"op": "set", "key": key, "value": value})
+    return ops
+
+
+# Starts keeping track of a state's changes for 'owner', from the save it has just made
+def track_changes(state, owner):
+    dirty = dirty_rooms(state)
+    dirty.rooms.clear()
+    dirty.owner = owner
+    player = state.get("player")
+    if isinstance(player, Entity):
+        player.mark_clean()
+
+
+# The changes since 'owner' last saved the state, comparing only the touched rooms and changed player fields
+# if it has kept track since then, or everything if not. Tracks the state for 'owner' from here on
+def diff_changes(saved, state, owner):
+    """Return the journal entries for what changed since 'owner' last saved the state."""
+    dirty = dirty_rooms(state)
+    player = state.get("player")
+    if dirty.owner == owner:
+        ops = diff_state(saved, state, dirty.rooms, player.dirty_fields() if isinstance(player, Entity) else None)
+    else:
+        ops = diff_state(saved, state)
+    track_changes(state, owner)
+    return ops
+
+
+# Applies one journal entry to a game state
+def apply_op(state, op):
+    kind = op["op"]
+    if kind == "player":
+        state.setdefault("player", {})[op["field"]] = op["value"]
+    elif kind == "inventory":
+        item = intern_string(op["item"])
+        inventory = state.setdefault("player", {}).setdefault("inventory", {})
+        if op["count"]:
+            inventory[item] = op["count"]
+        else:
+            inventory.pop(item, None)
+    elif kind == "room":
+        state.setdefault("locations", {})[op["id"]] = op["value"]
+        if op["id"] in state.get("dynamic_rooms", {}):
+            state["dynamic_rooms"][op["id"]] = op["value"]
+    elif kind == "room_field":
+        state["locations"][op["id"]][op["field"]] = op["value"]
+    elif kind == "connection":
+        connections = state["locations"][op["id"]].setdefault("connections", {})
+        connections[intern_string(op["direction"])] = intern_string(op["target"])
+    elif kind == "dynamic_room":
+        state.setdefault("dynamic_rooms", {})[op["id"]] = state["locations"][op["id"]]
+    elif kind == "set":
+        state[op["key"]] = op["value"]
+
+
+# Reads the save data in a snapshot file, in either the JSON or binary format
+def read_snapshot(filename):
+    if is_binary_save(filename):
+        return read_binary(filename)
+    with open(filename, "r") as file:
+        return json.load(file)
+
+
+# Writes a game state as a snapshot file. Saves ending in .bin use the binary format
+def write_snapshot(filename, state, generation=0, binary=None):
+    data = dict(to_save_data(state), save_generation=generation)
+    if binary is None:
+        binary = filename.endswith(".bin")
+    if binary:
+        write_binary(filename, data)
+        return
+    with open(filename, "w") as file:
+        json.dump(data, file, default=to_json)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+# Reads a save: the snapshot plus every journal entry written after it.
+# Returns the state, the snapshot's generation, the number of journal entries replayed and
+# whether the snapshot is in an older save format.
+# A half-written entry at the end of the journal (from a crash mid-save) is ignored
+def read_save(filename):
+    data = read_snapshot(filename)
+    generation = data.pop("save_generation", 0)
+    outdated = data.get("version", 1) < SAVE_VERSION
+    state = from_save_data(data)
+    try:
+        with open(journal_path(filename), "r") as journal:
+            lines = journal.read().split("\n")
+    except FileNotFoundError:
+        return state, generation, None, outdated
+    try:
+        header = json.loads(lines[0])
+    except ValueError:
+        return state, generation, None, outdated
+    if header.get("generation") != generation:
+        return state, generation, None, outdated  # The journal belongs to an older snapshot
+    entries = 0
+    for line in lines[1:]:
+        try:
+            op = json.loads(line)
+        except ValueError:
+            break
+        apply_op(state, op)
+        entries += 1
+    return state, generation, entries, outdated
+
+
+def load_state(filename):
+    """Load a game state from its snapshot and journal."""
+    return read_save(filename)[0]
+
+
+# Stands in for the saved copy of a state that was just loaded, until the first save reads it
+_ON_DISK = object()
+
+
+class SaveJournal:
+    """Save a game state incrementally to a snapshot and an append-only journal."""
+
+    def __init__(self, filename="game_state.json", compact_every=200):
+        self.filename = filename
+        self.compact_every = compact_every  # Journal entries written before the state is compacted into a snapshot
+        self.entries = 0                    # Journal entries since the last snapshot
+        self.generation = 0
+        self._saved = None                  # Copy of the state as of the last save (_ON_DISK: not read yet)
+
+    # Loads the save and remembers it as already saved, so the next save only writes what changed.
+    # The copy that saves compare against isn't made here: the first save reads it from the file again,
+    # which is much faster than copying the state and keeps loading (and so starting the game) quick
+    def load(self):
+        """Load the game state from the snapshot and journal."""
+        state, self.generation, entries, outdated = read_save(self.filename)
+        if outdated:
+            # Older save formats are rewritten as a new snapshot on the next save
+            self._saved = None
+            self.entries = 0
+            return state
+        self._saved = _ON_DISK
+        if entries is None:
+            # The journal is missing or stale, so start a fresh one for this snapshot
+            self._start_journal()
+            self.entries = 0
+            return state
+        # Cut off anything after the last good entry (like a half-written one left by a crash),
+        # so new entries start on a clean line
+        with open(journal_path(self.filename), "r+") as journal:
+            lines = journal.read().split("\n")
+            journal.seek(0)
+            journal.truncate(len("".join(line + "\n" for line in lines[:entries + 1]).encode("utf-8")))
+        self.entries = entries
+        return state
+
+    # Appends the changes since the last save to the journal and returns how many entries were written
+    def save(self, state):
+        """Save what changed since the last save."""
+        changes = self.changes(state)
+        if changes is None:
+            self.compact(state)
+            self._saved = copy.deepcopy(state)
+            track_changes(state, self)
+            return 0
+        data, entries = changes
+        if entries:
+            self.append(data, entries, state)
+        return entries
+
+    # Works out what changed since the last save and counts it as saved.
+    # Returns the journal entries as lines of JSON ready to append, and how many there are, or None if
+    # there's no saved copy to compare with yet and the whole state has to be written as a snapshot.
+    # Nothing is written here, so the writing can be left to another thread (see autosave.py)
+    def changes(self, state):
+        if self._saved is None:
+            return None
+        if self._saved is _ON_DISK:
+            self._saved = read_save(self.filename)[0]
+        ops = diff_changes(self._saved, state, self)
+        data = "".join(json.dumps(op, separators=(",", ":"), default=to_json) + "\n" for op in ops)
+        for op in ops:
+            apply_op(self._saved, copy.deepcopy(op))
+        return data, len(ops)
+
+    # Counts the whole state as saved and returns a copy of it to write with compact(), for when
+    # changes() returns None
+    def snapshot(self, state):
+        self._saved = copy.deepcopy(state)
+        track_changes(state, self)
+        return copy.deepcopy(state)
+
+    # Forgets the saved copy, so the next save writes the whole state as a snapshot. For when changes
+    # were counted as saved by changes() or snapshot() but then couldn't be written
+    def forget(self):
+        self._saved = None
+
+    # Appends entries from changes() to the journal, then compacts it once it's long enough.
+    # Without the state, compacting reads it back from the snapshot and journal
+    def append(self, data, entries, state=None):
+        with open(journal_path(self.filename), "a") as journal:
+            journal.write(data)
+            journal.flush()
+            _sync(journal.fileno())
+        metrics.count("save_journal_bytes", len(data))
+        self.entries += entries
+        if self.entries >= self.compact_every:
+            self.compact(state)
+
+    # Writes the full state as a new snapshot (to a temporary file first, so a crash never leaves a
+    # half-written save) and starts an empty journal for it
+    def compact(self, state=None):
+        """Write the whole state as a new snapshot and clear the journal."""
+        if state is None:
+            state = read_save(self.filename)[0]
+        self.generation += 1
+        temp_filename = self.filename + ".tmp"
+        write_snapshot(temp_filename, state, self.generation, binary=self.filename.endswith(".bin"))
+        os.replace(temp_filename, self.filename)
+        _sync_directory(self.filename)
+        metrics.count("save_snapshots")
+        metrics.count("save_snapshot_bytes", os.path.getsize(self.filename))
+        self._start_journal()
+        self.entries = 0
+
+    def _start_journal(self):
+        with open(journal_path(self.filename), "w") as journal:
+            journal.write(json.dumps({"generation": self.generation}) + "\n")
+            journal.flush()
+            _sync(journal.fileno())
+
+
+# One journal per save file, shared by every save to that file
+_journals = {}
+
+
+def journal_for(filename):
+    """Return the SaveJournal that writes to a save file."""
+    if filename not in _journals:
+        _journals[filename] = SaveJournal(filename)
+    return _journals[filename]
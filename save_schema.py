@@ -0,0 +1,77 @@
+import sys
+
+from inventory import Inventory
+
+# The layout of save files.
+#
+# Version 1 (the original format) wrote generated rooms twice: once under "dynamic_rooms" and again under
+# "locations", both with their full description. After loading, the two copies were separate objects,
+# so later changes to connections or 'visited' only reached one of them.
+#
+# Version 2 stores every room once under "locations". "dynamic_rooms" is just the list of generated room
+# ids, and loading rebuilds it as a dict that shares the room objects from "locations" again.
+#
+# Version 3 saves the player's inventory as item -> count ({"health_potion": 2}) instead of a list
+# with one entry per item.
+
+SAVE_VERSION = 3
+
+
+# Repeated strings (directions, room ids, item names) share one copy in memory
+def intern_string(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+# Turns a game state into the data written to a save file
+def to_save_data(state):
+    """Return a normalized, versioned copy of a game state for saving."""
+    data = {"version": SAVE_VERSION}
+    for key, value in state.items():
+        if key.startswith("_"):
+            continue  # Indexes rebuilt when the game is loaded, like the world graph
+        elif key == "dynamic_rooms":
+            data[key] = list(value)
+        elif key == "locations":
+            # Rooms loaded lazily from a binary save only hold their description in the save file
+            data[key] = {room_id: room if "description" in room else dict(room, description=room["description"])
+                         for room_id, room in value.items()}
+        else:
+            data[key] = value
+    return data
+
+
+# Turns the data read from a save file (any version) back into a game state
+def from_save_data(data):
+    """Rebuild a game state from saved data, migrating older save versions."""
+    version = data.pop("version", 1)
+    if version > SAVE_VERSION:
+        raise ValueError(f"Save file version {version} is newer than this game supports ({SAVE_VERSION})")
+    locations = data.get("locations", {})
+
+    if version == 1 and isinstance(data.get("dynamic_rooms"), dict):
+        # Merge the two copies of each generated room. 'locations' is the copy the game updates,
+        # but connections found only in the 'dynamic_rooms' copy are kept too
+        for room_id, room in data["dynamic_rooms"].items():
+            if room_id not in locations:
+                locations[room_id] = room
+                continue
+            connections = dict(room.get("connections", {}))
+            connections.update(locations[room_id].get("connections", {}))
+            if connections:
+                locations[room_id]["connections"] = connections
+
+    for room_id in list(locations):
+        room = locations.pop(room_id)
+        connections = room.get("connections")
+        if connections:
+            room["connections"] = {intern_string(d): intern_string(target) for d, target in connections.items()}
+        locations[intern_string(room_id)] = room
+
+    if "dynamic_rooms" in data:
+        data["dynamic_rooms"] = {intern_string(room_id): locations[room_id] for room_id in data["dynamic_rooms"]}
+    if "current_location" in data:
+        data["current_location"] = intern_string(data["current_location"])
+    player = data.get("player")
+    if player and "inventory" in player:
+        player["inventory"] = Inventory.from_saved(player["inventory"])
+    return data
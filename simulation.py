@@ -0,0 +1,284 @@
+import argparse
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import game_loop
+import metrics
+from content import GameRNG, game_rng
+from stub_llm import StubLLM
+
+# Headless simulation of the game for balance and load testing.
+# Games are played by the real rules in game_loop.py, but a player policy answers every prompt instead of
+# a person and all output is thrown away. Room and merchant descriptions come from the offline stub LLM.
+# Many games are spread over a process pool, one seeded game at a time, so results are reproducible
+# no matter how the games are split between workers.
+
+
+# Works out which question the game is asking from the prompt text
+PROMPT_KINDS = [
+    ("fight or flee", "fight_or_flee"),
+    ("Choose an action", "combat_action"),
+    ("lockpicking", "lockpick"),
+    ("'dodge'", "bookshelf"),
+    ("attempt solving", "puzzle"),
+    ("buy something", "merchant"),
+    ("Enter a direction", "action"),
+]
+
+# Every answer that means something for each kind of question
+ANSWERS = {
+    "fight_or_flee": ["fight", "flee"],
+    "combat_action": ["1", "2"],
+    "lockpick": ["yes", "no"],
+    "bookshelf": ["dodge", "slice"],
+    "puzzle": ["yes", "no"],
+    "merchant": ["1", "2", "exit"],
+    "action": ["north", "south", "east", "west", "use"],
+}
+
+
+def prompt_kind(prompt):
+    for text, kind in PROMPT_KINDS:
+        if text in prompt:
+            return kind
+    return None
+
+
+class Policy:
+    """A simulated player. Answers the game's prompts and ignores its output."""
+
+    def __init__(self, rng, game_state=None, script=()):
+        self.rng = rng
+        self.game_state = game_state
+        self.script = list(script)  # Inputs given in order, used by the scripted policy
+        self.inputs = 0             # Number of prompts answered
+
+    def say(self, text=""):
+        pass
+
+    def write(self, text):
+        pass
+
+    def ask(self, prompt):
+        self.inputs += 1
+        return self.answer(prompt_kind(prompt), prompt)
+
+    def answer(self, kind, prompt):
+        raise NotImplementedError
+
+
+class ScriptedPolicy(Policy):
+    """Answer prompts from a fixed list of inputs, then quit."""
+
+    def answer(self, kind, prompt):
+        if self.inputs > len(self.script):
+            return "exit" if kind == "merchant" else "quit"
+        return self.script[self.inputs - 1]
+
+
+class RandomPolicy(Policy):
+    """Pick a random meaningful answer for every prompt."""
+
+    def answer(self, kind, prompt):
+        return self.rng.choice(ANSWERS.get(kind, ["quit"]))
+
+
+class GreedyPolicy(Policy):
+    """Play sensibly: fight when healthy, heal when hurt, buy what's useful."""
+
+    def answer(self, kind, prompt):
+        player = self.game_state["player"]
+        hurt = player["current_hp"] < player["max_hp"] / 2
+        has_potion = "health_potion" in player["inventory"]
+        if kind == "fight_or_flee":
+            return "flee" if hurt else "fight"
+        if kind == "combat_action":
+            if has_potion and player["current_hp"] <= 8 and player["current_hp"] < player["max_hp"]:
+                return "2"
+            return "1"
+        if kind == "bookshelf":
+            return "slice"
+        if kind in ("lockpick", "puzzle"):
+            return "yes"
+        if kind == "merchant":
+            if player["gold"] >= 5 and player["inventory"].count("health_potion") < 3:
+                return "1"
+            if player["gold"] >= 10 and "key" not in player["inventory"]:
+                return "2"
+            return "exit"
+        if kind == "action":
+            if hurt and has_potion:
+                return "use"
+            return self.rng.choice(["north", "south", "east", "west"])
+        return "quit"
+
+
+POLICIES = {"scripted": ScriptedPolicy, "random": RandomPolicy, "greedy": GreedyPolicy}
+
+
+# All the XP a player has earned, including the XP spent on earlier levels
+def total_xp(player):
+    return 50 * (player["level"] - 1) * player["level"] // 2 + player["current_xp"]
+
+
+# Sets a worker process up to play offline
+def _init_worker():
+    game_loop.llm_backend = StubLLM()
+    game_loop.llm_client = None
+    game_loop.llm_cache = None
+    game_loop.room_prefetcher = None
+    game_loop.merchant_pool = None
+
+
+# Plays one whole game with a policy, seeded so the same seed always plays out the same way
+def simulate_game(seed, policy="greedy", max_turns=200, script=()):
+    """Play one headless game and return how it went."""
+    rng_token = game_rng.set(GameRNG(seed))
+    game_state = game_loop.new_game_state()
+    current_location = game_state["current_location"]
+    rng = random.Random(seed * 2654435761 + 1)  # The policy's own choices don't disturb the game's dice
+    player_policy = POLICIES[policy](rng, game_state, script)
+    token = game_loop.game_io.set(player_policy)
+    gold_curve = []
+    xp_curve = []
+    outcome = None
+    try:
+        for _ in range(max_turns):
+            with metrics.phase("turn"):
+                current_location, outcome = game_loop.play_turn(game_state, current_location)
+            gold_curve.append(game_state["player"]["gold"])
+            xp_curve.append(total_xp(game_state["player"]))
+            if outcome is not None:
+                break
+    finally:
+        game_loop.game_io.reset(token)
+        game_rng.reset(rng_token)
+    return {
+        "seed": seed,
+        "outcome": outcome or "survived",
+        "turns": len(gold_curve),
+        "level": game_state["player"]["level"],
+        "rooms": len(game_state.get("dynamic_rooms", {})),
+        "gold_curve": gold_curve,
+        "xp_curve": xp_curve,
+    }
+
+
+def _simulate_games(seeds, policy, max_turns):
+    return [simulate_game(seed, policy, max_turns) for seed in seeds]
+
+
+# Fights a batch of fresh level 1 characters against freshly spawned enemies
+def simulate_combats(count, seed=0, policy="greedy"):
+    """Play a number of single combats and count the victories."""
+    rng = random.Random(seed * 2654435761 + 1)
+    victories = 0
+    player_policy = POLICIES[policy](rng)
+    token = game_loop.game_io.set(player_policy)
+    rng_token = game_rng.set(GameRNG(seed))
+    try:
+        for _ in range(count):
+            game_state = game_loop.new_game_state()
+            player_policy.game_state = game_state
+            enemy = None
+            while enemy is None:
+                enemy = game_loop.spawn_enemy()
+            if game_loop.combat(game_state["player"], enemy) == "victory":
+                victories += 1
+    finally:
+        game_loop.game_io.reset(token)
+        game_rng.reset(rng_token)
+    return victories
+
+
+# Averages each turn's value over the games that lasted that long
+def _average_curve(curves):
+    longest = max((len(curve) for curve in curves), default=0)
+    averages = []
+    for turn in range(longest):
+        values = [curve[turn] for curve in curves if len(curve) > turn]
+        averages.append(sum(values) / len(values))
+    return averages
+
+
+# Splits a list into roughly even chunks for the worker processes
+def _chunks(items, count):
+    size = max(1, -(-len(items) // count))
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def run_simulations(games, policy="greedy", max_turns=200, workers=None, seed=0):
+    """Play many headless games across all cores and return aggregate statistics."""
+    workers = workers or os.cpu_count() or 1
+    seeds = list(range(seed, seed + games))
+    started = time.perf_counter()
+    if workers == 1:
+        _init_worker()
+        results = _simulate_games(seeds, policy, max_turns)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+            futures = [pool.submit(_simulate_games, chunk, policy, max_turns) for chunk in _chunks(seeds, workers * 4)]
+            results = [result for future in futures for result in future.result()]
+    elapsed = time.perf_counter() - started
+    outcomes = [result["outcome"] for result in results]
+    return {
+        "games": games,
+        "policy": policy,
+        "seconds": elapsed,
+        "win_rate": outcomes.count("survived") / games,
+        "defeat_rate": outcomes.count("defeat") / games,
+        "average_turns": sum(result["turns"] for result in results) / games,
+        "average_level": sum(result["level"] for result in results) / games,
+        "average_rooms": sum(result["rooms"] for result in results) / games,
+        "gold_curve": _average_curve([result["gold_curve"] for result in results]),
+        "xp_curve": _average_curve([result["xp_curve"] for result in results]),
+    }
+
+
+def run_combats(combats, policy="greedy", workers=None, seed=0):
+    """Play many single combats across all cores and return the win rate and throughput."""
+    workers = workers or os.cpu_count() or 1
+    chunk = max(1, -(-combats // (workers * 4)))
+    jobs = [(min(chunk, combats - start), seed + index) for index, start in enumerate(range(0, combats, chunk))]
+    started = time.perf_counter()
+    if workers == 1:
+        _init_worker()
+        victories = sum(simulate_combats(count, job_seed, policy) for count, job_seed in jobs)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+            futures = [pool.submit(simulate_combats, count, job_seed, policy) for count, job_seed in jobs]
+            victories = sum(future.result() for future in futures)
+    elapsed = time.perf_counter() - started
+    return {
+        "combats": combats,
+        "policy": policy,
+        "seconds": elapsed,
+        "win_rate": victories / combats,
+        "combats_per_minute": combats / elapsed * 60 if elapsed else float("inf"),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run headless games for balance and load testing.")
+    parser.add_argument("--games", type=int, default=1000, help="number of whole games to play")
+    parser.add_argument("--combats", type=int, default=0, help="play this many single combats instead of whole games")
+    parser.add_argument("--policy", choices=["random", "greedy"], default="greedy")
+    parser.add_argument("--turns", type=int, default=200, help="turns a player has to survive to win")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.combats:
+        stats = run_combats(args.combats, args.policy, args.workers, args.seed)
+        print(f"{stats['combats']} combats in {stats['seconds']:.2f}s ({stats['combats_per_minute']:,.0f} per minute)")
+        print(f"Win rate: {stats['win_rate']:.1%}")
+    else:
+        stats = run_simulations(args.games, args.policy, args.turns, args.workers, args.seed)
+        print(f"{stats['games']} games in {stats['seconds']:.2f}s")
+        print(f"Win rate: {stats['win_rate']:.1%}  Defeats: {stats['defeat_rate']:.1%}")
+        print(f"Average turns: {stats['average_turns']:.1f}  Average level: {stats['average_level']:.2f}  "
+              f"Average rooms explored: {stats['average_rooms']:.1f}")
+        for turn in range(0, len(stats["gold_curve"]), max(1, len(stats["gold_curve"]) // 10)):
+            print(f"  turn {turn + 1:>4}: gold {stats['gold_curve'][turn]:7.1f}  xp {stats['xp_curve'][turn]:7.1f}")
@@ -0,0 +1,447 @@
+import copy
+import json
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import metrics
+from entities import to_json
+from save_journal import apply_op, diff_changes, track_changes
+from save_schema import SAVE_VERSION, from_save_data
+
+# Saves for many players in one SQLite database.
+# Every save slot (one per player or session) is a row in 'players', holding the player, where they
+# are and anything else at the top of the game state, plus a row in 'rooms' for each room they know
+# and a row in 'connections' for each exit between rooms. Looking up a slot's rooms and exits goes
+# through the tables' primary keys, which start with the slot.
+#
+# Saving works like the save journal: the store keeps a copy of each slot as of its last save and
+# compares the rooms the game touched and the player fields that changed with it, so a save only
+# upserts the rooms, exits and player row that changed, in one transaction. Several slots can be saved in the same transaction with save_many().
+# The database runs in WAL mode, so loads never wait for a save, and threads share a small pool of
+# connections.
+#
+#   python sqlite_store.py import saves.db game_state.json saves/*.json    (the slot is the file's name)
+#   python sqlite_store.py                                                   save/load throughput at 10k slots
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS players (
+    slot TEXT PRIMARY KEY,
+    player TEXT NOT NULL,
+    current_location TEXT NOT NULL,
+    extra TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rooms (
+    slot TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    description TEXT,
+    visited INTEGER NOT NULL,
+    generated INTEGER NOT NULL,
+    fields TEXT NOT NULL,
+    PRIMARY KEY (slot, room_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS connections (
+    slot TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    direction TEXT NOT NULL,
+    target TEXT NOT NULL,
+    seq INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (slot, room_id, direction)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS players_updated ON players (updated);
+"""
+# players.extra: top-level game state other than the player, rooms and location, as JSON.
+# rooms.seq: the room's place in the game's locations, so they load in the same order.
+# rooms.generated: 1 for AI generated castle rooms (the game's dynamic_rooms).
+# rooms.fields: the room's other fields (enemy, position, ...) as JSON.
+# connections.seq: the exit's place in its room's connections, so they load in the same order (a generated
+# room's first exit leads back to the room it was generated from, see game_loop.room_description_prompt)
+
+UPSERT_ROOM = (
+    "INSERT INTO rooms (slot, room_id, seq, description, visited, generated, fields) VALUES (?, ?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT (slot, room_id) DO UPDATE SET description = excluded.description, visited = excluded.visited, "
+    "generated = excluded.generated, fields = excluded.fields"
+)
+UPSERT_CONNECTION = (
+    "INSERT INTO connections (slot, room_id, direction, target, seq) VALUES (?, ?, ?, ?, ?) "
+    "ON CONFLICT (slot, room_id, direction) DO UPDATE SET target = excluded.target"
+)
+UPSERT_PLAYER = (
+    "INSERT INTO players (slot, player, current_location, extra, updated) VALUES (?, ?, ?, ?, ?) "
+    "ON CONFLICT (slot) DO UPDATE SET player = excluded.player, current_location = excluded.current_location, "
+    "extra = excluded.extra, updated = excluded.updated"
+)
+
+_ROOM_COLUMNS = ("description", "visited", "connections")  # Room fields with columns (or a table) of their own
+_STATE_COLUMNS = ("player", "locations", "dynamic_rooms", "current_location")
+
+# Stands in for the saved copy of a slot that was just loaded, until its first save reads it again
+_IN_DATABASE = object()
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(",", ":"), default=to_json)
+
+
+class ConnectionPool:
+    """A fixed number of SQLite connections shared by any number of threads."""
+
+    def __init__(self, path, size=4):
+        self.path = path
+        self._idle = queue.LifoQueue()
+        for _ in range(size):
+            self._idle.put(self._connect())
+
+    def _connect(self):
+        # Transactions are begun explicitly (isolation_level=None), and a connection waits up to
+        # 30 seconds for another one's write to finish
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")  # With WAL, a crash can't corrupt the database
+        return connection
+
+    @contextmanager
+    def connection(self):
+        connection = self._idle.get()
+        try:
+            yield connection
+        finally:
+            self._idle.put(connection)
+
+    # Runs the body in a write transaction, rolled back if it raises.
+    # BEGIN IMMEDIATE takes the write lock up front, so two writers never deadlock upgrading a read
+    @contextmanager
+    def transaction(self):
+        with self.connection() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def close(self):
+        while not self._idle.empty():
+            self._idle.get().close()
+
+
+class SaveStore:
+    """Save and load game states in slots of a SQLite database."""
+
+    def __init__(self, path="saves.db", pool_size=4, cached_slots=1000):
+        self.path = path
+        self.cached_slots = cached_slots  # Slots whose last save is kept in memory to compare the next save with
+        self.pool = ConnectionPool(path, pool_size)
+        with self.pool.transaction() as connection:
+            for statement in SCHEMA.split(";"):
+                if statement.strip():
+                    connection.execute(statement)
+            # Databases from before exits kept their order get the column (their exits keep no order)
+            columns = [column[1] for column in connection.execute("PRAGMA table_info(connections)")]
+            if "seq" not in columns:
+                connection.execute("ALTER TABLE connections ADD COLUMN seq INTEGER NOT NULL DEFAULT 0")
+        self._saved = OrderedDict()  # Slot -> copy of the state as of its last save, least recently saved first
+        self._lock = threading.Lock()
+
+    def close(self):
+        self.pool.close()
+
+    # Reads a slot back into the data a JSON save file holds
+    def _read(self, connection, slot):
+        row = connection.execute("SELECT player, current_location, extra FROM players WHERE slot = ?",
+                                 (slot,)).fetchone()
+        if row is None:
+            return None
+        player, current_location, extra = row
+        data = dict(json.loads(extra), version=SAVE_VERSION, player=json.loads(player),
+                    current_location=current_location)
+        locations = {}
+        generated = []
+        for room_id, description, visited, is_generated, fields in connection.execute(
+                "SELECT room_id, description, visited, generated, fields FROM rooms WHERE slot = ? ORDER BY seq",
+                (slot,)):
+            room = json.loads(fields) if fields != "{}" else {}
+            room["description"] = description
+            room["visited"] = bool(visited)
+            locations[room_id] = room
+            if is_generated:
+                generated.append(room_id)
+        for room_id, direction, target in connection.execute(
+                "SELECT room_id, direction, target FROM connections WHERE slot = ? ORDER BY seq", (slot,)):
+            locations[room_id].setdefault("connections", {})[direction] = target
+        data["locations"] = locations
+        data["dynamic_rooms"] = generated
+        return data
+
+    # Loads a slot and remembers it as already saved, so its next save only writes what changed.
+    # Like the save journal, the copy to compare with is only read (again) when the slot is next saved
+    def load(self, slot):
+        """Load the game state in a slot, or return None if the slot is empty."""
+        with metrics.phase("store_load"), self.pool.connection() as connection:
+            data = self._read(connection, slot)
+        if data is None:
+            return None
+        self._remember(slot, _IN_DATABASE)
+        return from_save_data(data)
+
+    def _remember(self, slot, saved):
+        with self._lock:
+            self._saved[slot] = saved
+            self._saved.move_to_end(slot)
+            while len(self._saved) > self.cached_slots:
+                self._saved.popitem(last=False)  # Its next save rewrites the whole slot
+
+    def save(self, slot, state):
+        """Save a game state to a slot, writing only what changed since the slot's last save."""
+        self.save_many([(slot, state)])
+
+    # Saves several slots in one transaction (one sync to disk for all of them)
+    def save_many(self, saves):
+        """Save (slot, game state) pairs in a single transaction."""
+        with metrics.phase("store_save"):
+            with self._lock:
+                previous = [self._saved.get(slot) for slot, _ in saves]
+            remembered = []
+            try:
+                with self.pool.transaction() as connection:
+                    for (slot, state), saved in zip(saves, previous):
+                        if saved is _IN_DATABASE:
+                            data = self._read(connection, slot)
+                            saved = from_save_data(data) if data is not None else None
+                        if saved is None:
+                            self._write_slot(connection, slot, state)
+                            track_changes(state, (self, slot))
+                            remembered.append((slot, copy.deepcopy(state)))
+                        else:
+                            self._write_changes(connection, slot, state, saved)
+                            remembered.append((slot, saved))
+            except BaseException:
+                # The saved copies may already have the changes that were rolled back, so these slots
+                # are written whole next time
+                with self._lock:
+                    for slot, _ in saves:
+                        self._saved.pop(slot, None)
+                raise
+            # Only once the transaction has committed do the copies count as saved
+            for slot, saved in remembered:
+                self._remember(slot, saved)
+        metrics.count("store_saves", len(saves))
+
+    def _write_player(self, connection, slot, state):
+        extra = {key: value for key, value in state.items() if key not in _STATE_COLUMNS and not key.startswith("_")}
+        connection.execute(UPSERT_PLAYER, (slot, _dumps(state["player"]), state.get("current_location", "forest"),
+                                           _dumps(extra), time.time()))
+
+    @staticmethod
+    def _room_row(slot, room_id, room, seq, generated):
+        fields = {field: value for field, value in dict.items(room) if field not in _ROOM_COLUMNS}
+        return slot, room_id, seq, room["description"], int(bool(room.get("visited"))), int(generated), _dumps(fields)
+
+    # Writes a whole slot, replacing anything it held before
+    def _write_slot(self, connection, slot, state):
+        connection.execute("DELETE FROM rooms WHERE slot = ?", (slot,))
+        connection.execute("DELETE FROM connections WHERE slot = ?", (slot,))
+        self._write_player(connection, slot, state)
+        generated = state.get("dynamic_rooms", {})
+        connection.executemany(UPSERT_ROOM, [self._room_row(slot, room_id, room, seq, room_id in generated)
+                                             for seq, (room_id, room) in enumerate(state["locations"].items())])
+        connection.executemany(UPSERT_CONNECTION, [
+            (slot, room_id, direction, target, seq)
+            for room_id, room in state["locations"].items()
+            for seq, (direction, target) in enumerate(room.get("connections", {}).items())
+        ])
+        metrics.count("store_slot_rewrites")
+
+    # Upserts what changed since the last save: the player row, each changed room and each new exit.
+    # The changes are also applied to the saved copy, as the save journal does
+    def _write_changes(self, connection, slot, state, saved):
+        ops = diff_changes(saved, state, (self, slot))
+        player_changed = False
+        rooms = {}        # Room id -> its place in the locations, for the rooms to upsert
+        connections = []
+        for op in ops:
+            kind = op["op"]
+            if kind in ("player", "inventory", "set"):
+                player_changed = True
+            elif kind == "connection":
+                seq = list(state["locations"][op["id"]]["connections"]).index(op["direction"])
+                connections.append((slot, op["id"], op["direction"], op["target"], seq))
+            elif kind == "room":
+                rooms[op["id"]] = len(saved["locations"]) if op["id"] not in saved["locations"] else None
+                connections.extend((slot, op["id"], direction, target, seq)
+                                   for seq, (direction, target) in enumerate(op["value"].get("connections", {}).items()))
+            else:  # room_field, dynamic_room
+                rooms.setdefault(op["id"], None)
+            apply_op(saved, copy.deepcopy(op))
+        if player_changed:
+            self._write_player(connection, slot, state)
+        generated = state.get("dynamic_rooms", {})
+        connection.executemany(UPSERT_ROOM, [
+            self._room_row(slot, room_id, state["locations"][room_id], seq if seq is not None else 0, room_id in generated)
+            for room_id, seq in rooms.items()
+        ])
+        connection.executemany(UPSERT_CONNECTION, connections)
+        metrics.count("store_room_upserts", len(rooms))
+
+    def delete(self, slot):
+        with self.pool.transaction() as connection:
+            for table in ("players", "rooms", "connections"):
+                connection.execute(f"DELETE FROM {table} WHERE slot = ?", (slot,))
+        with self._lock:
+            self._saved.pop(slot, None)
+
+    # The slots in the store, most recently saved first
+    def slots(self, limit=None):
+        """Return the names of the saved slots, most recently saved first."""
+        with self.pool.connection() as connection:
+            rows = connection.execute("SELECT slot FROM players ORDER BY updated DESC LIMIT ?",
+                                      (-1 if limit is None else limit,)).fetchall()
+        return [slot for slot, in rows]
+
+
+# Copies save files (snapshot and journal, JSON or binary) into a store, one slot per file named after
+# the file without its extension, a batch of files per transaction
+def import_saves(store, filenames, batch=100):
+    """Import save files into a store. Returns the slots written."""
+    import os
+    from save_journal import load_state
+
+    slots = []
+    for start in range(0, len(filenames), batch):
+        saves = []
+        for filename in filenames[start:start + batch]:
+            slot = os.path.splitext(os.path.basename(filename))[0]
+            saves.append((slot, load_state(filename)))
+        store.save_many(saves)
+        slots.extend(slot for slot, _ in saves)
+    return slots
+
+
+# A game state like the ones a host keeps for each player: a castle explored 'rooms' rooms deep
+def _player_state(number, rooms):
+    from binary_save import _sample_state
+    state = _sample_state(rooms)
+    state["player"]["gold"] = number
+    return state
+
+
+# What a turn changes: some gold, a room visited and now and then a new room
+def _play(state, turn):
+    state["player"]["gold"] += 1
+    rooms = state["dynamic_rooms"]
+    room_id = list(rooms)[turn % len(rooms)]
+    state["locations"][room_id]["visited"] = not state["locations"][room_id]["visited"]
+    if turn % 3 == 0:
+        new_id = f"room_{len(rooms) + 1}"
+        room = {"description": "A newly found room.", "visited": False, "connections": {"east": room_id}}
+        state["locations"][new_id] = rooms[new_id] = room
+        state["locations"][room_id].setdefault("connections", {})["west"] = new_id
+
+
+def benchmark(slots=10_000, rooms=30, batch=100, file_slots=1_000):
+    """Print save and load throughput for many slots in one database, and for one JSON file per slot."""
+    import os
+    import random
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from save_journal import load_state, write_snapshot
+
+    def rate(count, started):
+        return count / (time.perf_counter() - started)
+
+    states = [_player_state(number, rooms) for number in range(slots)]
+    rng = random.Random(0)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        # The way a host saves today: one JSON file per player, rewritten whole on every save
+        started = time.perf_counter()
+        for number in range(file_slots):
+            write_snapshot(os.path.join(directory, f"player{number}.json"), states[number])
+        results.append(("JSON files: full rewrite per save", rate(file_slots, started)))
+        started = time.perf_counter()
+        for number in rng.sample(range(file_slots), file_slots):
+            load_state(os.path.join(directory, f"player{number}.json"))
+        results.append(("JSON files: load", rate(file_slots, started)))
+
+        store = SaveStore(os.path.join(directory, "saves.db"), cached_slots=slots)
+        started = time.perf_counter()
+        for start in range(0, slots, batch):
+            store.save_many([(f"player{number}", states[number]) for number in range(start, min(slots, start + batch))])
+        results.append((f"store: first save of {slots:,} slots, {batch} per transaction", rate(slots, started)))
+
+        for number, state in enumerate(states):
+            _play(state, number)
+        started = time.perf_counter()
+        for number, state in enumerate(states):
+            store.save(f"player{number}", state)
+        results.append(("store: a turn's changes, one save per transaction", rate(slots, started)))
+
+        for number, state in enumerate(states):
+            _play(state, number + 1)
+        started = time.perf_counter()
+        for start in range(0, slots, batch):
+            store.save_many([(f"player{number}", states[number]) for number in range(start, min(slots, start + batch))])
+        results.append((f"store: a turn's changes, {batch} saves per transaction", rate(slots, started)))
+
+        order = rng.sample(range(slots), slots)
+        started = time.perf_counter()
+        for number in order:
+            store.load(f"player{number}")
+        results.append(("store: load, one thread", rate(slots, started)))
+
+        # Loads while another thread keeps saving: with WAL, reading never waits for a write
+        for number, state in enumerate(states):
+            _play(state, number + 2)
+        saving = threading.Event()
+        saving.set()
+
+        def save_all():
+            while saving.is_set():
+                for start in range(0, slots, batch):
+                    store.save_many([(f"player{number}", states[number])
+                                     for number in range(start, min(slots, start + batch))])
+                    if not saving.is_set():
+                        return
+
+        with ThreadPoolExecutor(1) as executor:
+            writer = executor.submit(save_all)
+            started = time.perf_counter()
+            for number in order:
+                store.load(f"player{number}")
+            results.append(("store: load while another thread saves", rate(slots, started)))
+            saving.clear()
+            writer.result()
+        for start in range(0, slots, batch):
+            store.save_many([(f"player{number}", states[number]) for number in range(start, min(slots, start + batch))])
+
+        # Every slot loads back as it was last saved
+        for number in order[:100]:
+            loaded = store.load(f"player{number}")
+            if loaded["player"]["gold"] != states[number]["player"]["gold"] or \
+                    len(loaded["locations"]) != len(states[number]["locations"]):
+                raise AssertionError(f"Slot player{number} didn't load as it was saved")
+        size = os.path.getsize(store.path) + os.path.getsize(store.path + "-wal")
+        store.close()
+
+    print(f"{slots:,} save slots of {rooms} rooms ({file_slots:,} for JSON files)")
+    for name, per_second in results:
+        print(f"{name:>58}: {per_second:>9,.0f} per second")
+    print(f"Database with WAL: {size / 1024 / 1024:.1f} MiB")
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 2 and sys.argv[1] == "import":
+        # python sqlite_store.py import saves.db game_state.json ...
+        store = SaveStore(sys.argv[2])
+        print(f"Imported {len(import_saves(store, sys.argv[3:]))} saves into {sys.argv[2]}")
+        store.close()
+    else:
+        benchmark()
@@ -0,0 +1,119 @@
+import argparse
+import os
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+# Measures how long the console game takes to start.
+# Cold start is timed from launching 'python game_loop.py' to the first prompt, for a saved game resumed
+# in the forest, which needs nothing from the AI model. '-X importtime' shows which modules the game
+# imports on the way there and how long each takes. With --baseline the same measurements are taken
+# for another git revision of the game, to compare against.
+#
+#   python startup.py                       time this version
+#   python startup.py --baseline HEAD~1     and compare with the previous commit
+#   python startup.py --rooms 20000         resume a save with this many generated rooms
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIRST_PROMPT = b"Enter a direction"
+
+# Packages that take a noticeable time to import and that starting a game shouldn't need
+HEAVY_MODULES = ("openai", "dotenv", "requests", "asyncio", "sqlite3", "gzip", "argparse", "tempfile")
+
+
+# Imports a module with -X importtime in a fresh interpreter.
+# Returns every module imported, with its cumulative import time in seconds
+def import_profile(directory, module="game_loop"):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=directory,
+                            capture_output=True, text=True, check=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "cumulative" not in line:
+            _, cumulative, name = line[len("import time:"):].split("|")
+            modules[name.strip()] = int(cumulative) / 1e6
+    return modules
+
+
+# Launches the console game and returns the seconds until its first prompt, then quits it
+def first_prompt_time(directory, save_file):
+    env = dict(os.environ, SAVE_FILE=save_file, PYTHONUNBUFFERED="1")
+    started = time.perf_counter()
+    game = subprocess.Popen([sys.executable, "game_loop.py"], cwd=directory, env=env,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    output = b""
+    try:
+        while FIRST_PROMPT not in output:
+            piece = game.stdout.read1(4096)
+            if not piece:
+                raise RuntimeError(f"The game exited before its first prompt:\n{output.decode(errors='replace')}")
+            output += piece
+        elapsed = time.perf_counter() - started
+        game.communicate(b"quit\n", timeout=60)
+    finally:
+        if game.poll() is None:
+            game.kill()
+    return elapsed
+
+
+# Writes a saved game resumed in the forest, with 'rooms' generated castle rooms. The forest has been
+# visited and cleared already, so the first thing the game does is ask where to go
+def write_save(filename, rooms):
+    sys.path.insert(0, HERE)
+    from binary_save import _sample_state
+    from save_journal import write_snapshot
+
+    state = _sample_state(rooms)
+    state["current_location"] = "forest"
+    state["locations"]["forest"].update(visited=True, enemy=None)
+    write_snapshot(filename, state)
+
+
+# The game as it was at a git revision, unpacked into a directory
+def checkout(revision, directory):
+    archive = os.path.join(directory, "source.tar")
+    with open(archive, "wb") as file:
+        subprocess.run(["git", "archive", revision], cwd=HERE, stdout=file, check=True)
+    with tarfile.open(archive) as tar:
+        tar.extractall(os.path.join(directory, "source"))
+    return os.path.join(directory, "source")
+
+
+def measure(directory, rooms, runs):
+    """Return the import time, heavy modules imported and median time to the first prompt of a game directory."""
+    modules = import_profile(directory)
+    heavy = [name for name in HEAVY_MODULES if name in modules]
+    times = []
+    with tempfile.TemporaryDirectory() as saves:
+        save_file = os.path.join(saves, "game_state.json")
+        for _ in range(runs):
+            write_save(save_file, rooms)  # A fresh save each run, since quitting saves the game
+            times.append(first_prompt_time(directory, save_file))
+    return {"import": modules["game_loop"], "heavy": heavy, "first_prompt": sorted(times)[len(times) // 2]}
+
+
+def benchmark(baseline=None, rooms=200, runs=5):
+    """Print the import time and cold start to the first prompt, and compare with a baseline revision."""
+    results = {"this version": measure(HERE, rooms, runs)}
+    if baseline:
+        with tempfile.TemporaryDirectory() as directory:
+            results[baseline] = measure(checkout(baseline, directory), rooms, runs)
+
+    print(f"Resuming a save in the forest with {rooms:,} generated rooms (median of {runs} runs)")
+    print(f"{'version':>14} {'import game_loop':>17} {'first prompt':>13}  heavy modules imported")
+    for name, result in results.items():
+        print(f"{name:>14} {result['import'] * 1000:>15.1f}ms {result['first_prompt'] * 1000:>11.1f}ms  "
+              f"{', '.join(result['heavy']) or '-'}")
+    if baseline:
+        before, after = results[baseline]["first_prompt"], results["this version"]["first_prompt"]
+        print(f"Cold start to first prompt: {before / after:.1f}x faster")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the console game's startup.")
+    parser.add_argument("--baseline", help="git revision to compare against")
+    parser.add_argument("--rooms", type=int, default=200, help="generated rooms in the resumed save")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    benchmark(args.baseline, args.rooms, args.runs)
@@ -1,4 +1,4 @@
-import json
+from save_journal import journal_for
 
 # Map System
 game_map = {
@@ -19,13 +19,11 @@ game_state = {
 
 # State Persistence
 def save_game(state, filename="game_state.json"):
-    with open(filename, "w") as file:
-        json.dump(state, file)
+    journal_for(filename).save(state)
 
 def load_game(filename="game_state.json"):
     try:
-        with open(filename, "r") as file:
-            return json.load(file)
+        return journal_for(filename).load()
     except FileNotFoundError:
         return None
 
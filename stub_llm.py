@@ -0,0 +1,84 @@
+import random
+import re
+import threading
+import time
+
+# An offline stand-in for openai.ChatCompletion.
+# It answers every prompt with canned text after a fixed delay, so the game and its background
+# generators can be run and timed without a network connection or an API key.
+# It can also fail a share of requests on purpose, to exercise retries and error handling, and stream
+# its replies a word at a time like the API does with stream=True
+
+
+# Canned room descriptions handed out in order
+ROOM_DESCRIPTIONS = [
+    "A dusty armory lined with rusted racks. A broken crossbow lies on the floor.",
+    "A cold chapel with cracked stained glass. Candle stubs cover the altar.",
+    "A narrow corridor where torch brackets hang empty and water drips from the ceiling.",
+    "A collapsed library. Torn pages drift in the draft from a shattered window.",
+    "A kitchen with an iron cauldron still hanging over a long-dead fire.",
+]
+
+# Canned merchant descriptions handed out in order
+MERCHANT_DESCRIPTIONS = [
+    "A stooped old man with a patched cloak and a cart full of jars. \"Potions, keys, trinkets! Fair prices for brave souls.\"",
+    "A cheerful halfling with ink-stained fingers. \"You look like someone who needs a key. Or two!\"",
+    "A tall woman in a travel-worn coat, coins clinking at her belt. \"Gold first, questions later.\"",
+]
+
+
+class RateLimitError(Exception):
+    """Raised by StubLLM to simulate the API turning a request away."""
+
+
+class StubLLM:
+    """Answer chat prompts with canned text after a simulated delay."""
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=None, token_latency=0.0):
+        self.latency = latency        # Seconds to sleep before every reply
+        self.token_latency = token_latency  # Seconds between streamed words
+        self.error_rate = error_rate  # Share of requests that fail with RateLimitError
+        self.calls = 0                # Number of completions requested so far
+        self.errors = 0               # Number of requests failed on purpose
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    # Same call shape and response shape as openai.ChatCompletion.create
+    def create(self, model=None, messages=None, stream=False, **kwargs):
+        with self._lock:
+            self.calls += 1
+            calls = self.calls
+            fail = self.error_rate and self._random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise RateLimitError("Rate limit reached (simulated)")
+        prompt = messages[-1]["content"] if messages else ""
+        batch = re.search(r"Describe (\d+) different", prompt)
+        if batch:
+            # Batched merchant prompts get one description per requested merchant, split by '---' lines
+            count = int(batch.group(1))
+            start = (calls - 1) * count
+            content = "\n---\n".join(
+                MERCHANT_DESCRIPTIONS[(start + i) % len(MERCHANT_DESCRIPTIONS)] for i in range(count)
+            )
+        elif "merchant" in prompt.split(".")[0]:  # Room prompts can mention merchants further on
+            content = MERCHANT_DESCRIPTIONS[(calls - 1) % len(MERCHANT_DESCRIPTIONS)]
+        else:
+            content = ROOM_DESCRIPTIONS[(calls - 1) % len(ROOM_DESCRIPTIONS)]
+        if stream:
+            return self._stream(content)
+        if self.token_latency:
+            time.sleep(self.token_latency * len(content.split()))
+        return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+    # Yields the reply in the same chunks the API streams: the role first, then the text a word at a time
+    def _stream(self, content):
+        yield {"choices": [{"delta": {"role": "assistant"}}]}
+        for word in re.findall(r"\S+\s*", content):
+            if self.token_latency:
+                time.sleep(self.token_latency)
+            yield {"choices": [{"delta": {"content": word}}]}
+        yield {"choices": [{"delta": {}, "finish_reason": "stop"}]}
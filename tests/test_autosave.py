@@ -0,0 +1,46 @@
+import pytest
+
+import autosave
+from save_journal import SaveJournal
+
+
+# Kills a process that's autosaving at random moments (in journal appends and snapshot writes) and
+# checks the last save it reported finished always loads
+@pytest.mark.parametrize("binary", [False, True], ids=["json", "binary"])
+def test_last_finished_save_survives_a_kill(binary):
+    autosave.check(kills=5, binary=binary)
+
+
+# A save that fails to be written isn't counted as written, and the next save to that file writes the
+# whole state, so the changes the failed save held aren't lost
+def test_failed_save_is_rewritten_as_a_snapshot(tmp_path, monkeypatch):
+    filename = str(tmp_path / "game_state.json")
+    state = autosave._sample_state(10)
+    autosaver = autosave.Autosaver().start()
+    for number in range(1, 5):
+        autosave._advance(state, number)
+        autosaver.save(filename, state)
+    autosaver.flush()
+    assert autosaver.written == 4
+
+    append = SaveJournal.append
+
+    def fail_once(journal, *args, **kwargs):
+        monkeypatch.setattr(SaveJournal, "append", append)
+        raise OSError("disk full")
+
+    monkeypatch.setattr(SaveJournal, "append", fail_once)
+    autosave._advance(state, 5)  # Adds a room
+    assert autosaver.save(filename, state) == 5
+    with pytest.raises(OSError):
+        autosaver.flush()
+    assert autosaver.written == 4
+
+    autosave._advance(state, 6)
+    autosaver.save(filename, state)
+    autosaver.flush()
+    autosaver.stop()
+    assert autosaver.written == 6
+    saved = SaveJournal(filename).load()
+    assert saved["player"]["gold"] == 6
+    assert "autosave_room_5" in saved["locations"]
@@ -0,0 +1,14 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+import balance
+
+
+# The vectorized model has to play by the same rules as game_loop.combat, so a rules change that isn't
+# made in both fails here
+@pytest.mark.parametrize("level, potions", [(1, 2), (2, 1), (3, 0), (5, 3)])
+def test_vectorized_model_matches_combat(level, potions):
+    checks = balance.cross_check(fights=5_000, level=level, potions=potions, seed=level)
+    disagreeing = {key: check for key, check in checks.items() if not check["agrees"]}
+    assert disagreeing == {}
@@ -0,0 +1,25 @@
+import re
+
+from game_server import NAME_UNSAFE, GameServer
+
+
+class Listener:
+    def __init__(self):
+        self.lines = []
+
+    def say(self, text=""):
+        self.lines.append(text)
+
+
+# A second session with a name already in play gets a slot no player's name can turn into
+def test_second_session_with_a_name_gets_its_own_slot():
+    server = GameServer(max_sessions=4)
+    first, second, other = Listener(), Listener(), Listener()
+    assert server._claim_slot(first, "bob") == "bob"
+    assert server._claim_slot(second, "bob") == "bob.2"
+    assert second.lines == ["bob is already playing, so this game is saved as bob.2."]
+    for name in ("bob.2", "bob-2", "bob 2"):
+        assert server._claim_slot(other, re.sub(NAME_UNSAFE, "", name)) not in ("bob", "bob.2")
+    server._playing.discard("bob")
+    assert server._claim_slot(first, "bob") == "bob"
+    server._executor.shutdown()
@@ -0,0 +1,59 @@
+import pytest
+
+import game_loop
+from entities import Player
+from inventory import Inventory
+
+
+class Listener:
+    def __init__(self):
+        self.said = []
+
+    def ask(self, prompt):
+        return ""
+
+    def say(self, text=""):
+        self.said.append(text)
+
+    def write(self, text):
+        self.said.append(text)
+
+
+@pytest.fixture
+def listener():
+    listener = Listener()
+    token = game_loop.game_io.set(listener)
+    yield listener
+    game_loop.game_io.reset(token)
+
+
+def player_with(inventory, current_hp=5):
+    return Player(current_hp=current_hp, max_hp=20, current_xp=0, max_xp=50, level=1, attack_power=3, gold=0,
+                  inventory=inventory)
+
+
+# Empty or negative stacks never make it into an inventory, however it's built
+def test_inventories_leave_out_empty_stacks():
+    inventory = Inventory({"health_potion": 0, "key": 2, "gem": -1})
+    assert inventory == {"key": 2}
+    inventory["key"] = 0
+    inventory.update(health_potion=3, gem=0)
+    assert inventory == {"health_potion": 3}
+    assert "key" not in inventory
+    assert Inventory.from_saved({"health_potion": 0, "key": 1}) == {"key": 1}
+    assert Player.from_dict(dict(player_with({}).to_dict(), inventory={"health_potion": 0})).inventory == {}
+
+
+# A potion heals only if one is taken out of the inventory
+def test_potions_heal_only_when_one_is_used(listener):
+    player = player_with(Inventory({"health_potion": 1}))
+    game_loop.use_health_potion(player)
+    assert player.current_hp == 15
+    assert player.inventory == {}
+
+    # An inventory that claims a potion it can't give up (an empty stack left by older code)
+    player = player_with(Inventory())
+    dict.__setitem__(player.inventory, "health_potion", 0)
+    game_loop.use_health_potion(player)
+    assert player.current_hp == 5
+    assert listener.said[-1] == "You don't have any health potions left!"
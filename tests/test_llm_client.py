@@ -0,0 +1,170 @@
+import threading
+import time
+
+import pytest
+
+from llm_client import PRIORITY_INTERACTIVE, PRIORITY_PREFETCH, LLMClient, TokenBucket
+from stub_llm import RateLimitError, StubLLM
+
+
+class AuthenticationError(Exception):
+    """Named like the OpenAI error that retrying won't fix."""
+
+
+# A backend that remembers which prompts it was sent, in order, and can fail the first few calls
+class RecordingBackend:
+    def __init__(self, failures=0, error=RateLimitError):
+        self.prompts = []
+        self.failures = failures
+        self.error = error
+        self._lock = threading.Lock()
+
+    def create(self, model=None, messages=None, **kwargs):
+        with self._lock:
+            self.prompts.append(messages[-1]["content"])
+            if len(self.prompts) <= self.failures:
+                raise self.error("failed on purpose")
+        return {"choices": [{"message": {"role": "assistant", "content": f"Reply to {messages[-1]['content']}"}}]}
+
+
+def ask(prompt):
+    return [{"role": "user", "content": prompt}]
+
+
+@pytest.fixture
+def clients():
+    started = []
+
+    def client(backend, **options):
+        options = dict(dict(base_delay=0.001, max_delay=0.01), **options)
+        client = LLMClient(backend, **options)
+        started.append(client)
+        return client
+
+    yield client
+    for client in started:
+        client.stop()
+
+
+# An interactive request goes ahead of every prefetch queued before it
+def test_interactive_requests_overtake_prefetches(clients):
+    backend = RecordingBackend()
+    client = clients(backend, workers=1)
+    prefetches = [client.submit("stub", ask(f"room {number}"), PRIORITY_PREFETCH) for number in range(20)]
+    interactive = client.submit("stub", ask("the player's room"), PRIORITY_INTERACTIVE)
+    client.start()
+    assert interactive.result(timeout=5) == "Reply to the player's room"
+    for future in prefetches:
+        future.result(timeout=5)
+    assert backend.prompts[0] == "the player's room"
+    assert backend.prompts[1:] == [f"room {number}" for number in range(20)]
+
+
+# A prefetch that the player then waits on is moved up to the interactive lane, not sent twice
+def test_waiting_on_a_prefetch_promotes_it(clients):
+    backend = RecordingBackend()
+    client = clients(backend, workers=1)
+    for number in range(10):
+        client.submit("stub", ask(f"room {number}"), PRIORITY_PREFETCH)
+    client.submit("stub", ask("room 9"), PRIORITY_INTERACTIVE)
+    client.start()
+    client.submit("stub", ask("done"), PRIORITY_PREFETCH).result(timeout=5)
+    assert backend.prompts[0] == "room 9"
+    assert backend.prompts.count("room 9") == 1
+    assert client.stats()["coalesced"] == 1
+
+
+# Identical prompts in flight share one request, and every caller gets its reply
+def test_identical_prompts_are_coalesced(clients):
+    backend = StubLLM(latency=0.01)
+    client = clients(backend, workers=4)
+    futures = [client.submit("stub", ask(f"Describe room {number % 50}."), PRIORITY_PREFETCH) for number in range(100)]
+    client.start()
+    replies = [future.result(timeout=10) for future in futures]
+    assert replies[:50] == replies[50:]
+    stats = client.stats()
+    assert stats["submitted"] == 100
+    assert stats["coalesced"] == 50
+    assert stats["completed"] == 50
+    assert backend.calls == 50
+    assert stats["in_flight"] == 0
+
+
+# Failed calls are retried until one gets through, and each retry is counted
+def test_failed_requests_are_retried(clients):
+    backend = RecordingBackend(failures=3)
+    client = clients(backend, workers=1, max_retries=5).start()
+    assert client.complete("stub", ask("room")) == "Reply to room"
+    assert backend.prompts == ["room"] * 4
+    stats = client.stats()
+    assert stats["retries"] == 3
+    assert stats["failures"] == 0
+    assert stats["completed"] == 1
+
+
+# A request that keeps failing gives up after max_retries and passes the error to the caller
+def test_requests_give_up_after_max_retries(clients):
+    backend = RecordingBackend(failures=100)
+    client = clients(backend, workers=1, max_retries=2).start()
+    with pytest.raises(RateLimitError):
+        client.complete("stub", ask("room"))
+    assert len(backend.prompts) == 3
+    assert client.stats()["retries"] == 2
+    assert client.stats()["failures"] == 1
+
+
+# Errors that retrying won't fix are raised straight away
+def test_non_retryable_errors_are_not_retried(clients):
+    backend = RecordingBackend(failures=100, error=AuthenticationError)
+    client = clients(backend, workers=1, max_retries=5).start()
+    with pytest.raises(AuthenticationError):
+        client.complete("stub", ask("room"))
+    assert len(backend.prompts) == 1
+    assert client.stats()["retries"] == 0
+
+
+# Streamed requests retry the same way before any text comes back
+def test_streams_are_retried():
+    backend = StubLLM(error_rate=0.5, seed=1)
+    client = LLMClient(backend, base_delay=0.001, max_delay=0.01, max_retries=20)
+    for number in range(10):
+        assert "".join(client.stream("stub", ask(f"Describe room {number}."))).strip()
+    stats = client.stats()
+    assert stats["streams"] == 10
+    assert stats["completed"] == 10
+    assert stats["retries"] == backend.errors > 0
+
+
+# A full bucket allows a burst of one minute's worth, then hands out units at the per-minute rate
+def test_token_bucket_limits_the_rate():
+    bucket = TokenBucket(6000)  # 100 a second
+    started = time.monotonic()
+    for _ in range(60):
+        bucket.acquire(100)
+    assert time.monotonic() - started < 0.1
+    started = time.monotonic()
+    bucket.acquire(20)
+    assert 0.15 <= time.monotonic() - started < 1.0
+
+
+# Asking for more than the bucket holds only waits for a full bucket, and settling returns unused units
+def test_token_bucket_caps_and_settles():
+    bucket = TokenBucket(600)
+    bucket.acquire(10_000)
+    assert bucket.available < 1
+    bucket.settle(-300)
+    assert 299 <= bucket.available <= 301
+    bucket.settle(-10_000)
+    assert bucket.available <= bucket.capacity
+
+
+# The client waits on its requests-per-minute limit once the burst is spent
+def test_client_keeps_to_the_request_rate(clients):
+    backend = RecordingBackend()
+    client = clients(backend, workers=4, requests_per_minute=600).start()  # 10 a second after a burst of 600
+    client.requests.available = 0
+    started = time.monotonic()
+    futures = [client.submit("stub", ask(f"room {number}")) for number in range(5)]
+    for future in futures:
+        future.result(timeout=5)
+    assert time.monotonic() - started >= 0.4
@@ -0,0 +1,70 @@
+import time
+
+import metrics
+from llm_cache import LLMCache
+from llm_stream import StreamStats, delta_text, timed
+from stub_llm import StubLLM
+
+LATENCY = 0.05        # Seconds before the stub starts answering
+TOKEN_LATENCY = 0.005  # Seconds between the words it answers with
+RESPONSES = 3
+MESSAGES = [{"role": "user", "content": "Describe a room in an abandoned medieval castle."}]
+
+
+# Streaming shows the first words after the model's latency instead of after the whole reply, and a
+# cached reply is shown straight away
+def test_streaming_shortens_the_time_to_the_first_token(tmp_path):
+    backend = StubLLM(latency=LATENCY, token_latency=TOKEN_LATENCY)
+    whole = StreamStats()
+    for _ in range(RESPONSES):
+        started = time.perf_counter()
+        backend.create(model="stub", messages=MESSAGES)
+        elapsed = time.perf_counter() - started
+        whole.record(elapsed, elapsed)
+
+    streamed = StreamStats()
+    replayed = StreamStats()
+    cache = LLMCache(str(tmp_path / "cache.sqlite3"), variants=1)
+    texts = []
+    for _ in range(RESPONSES):
+        started = time.perf_counter()
+        cached = cache.get("stub", MESSAGES)
+        if cached is not None:
+            texts.append("".join(timed([cached], replayed, started, cached=True)))
+            continue
+        text = "".join(timed(delta_text(backend.create(model="stub", messages=MESSAGES, stream=True)),
+                             streamed, started))
+        texts.append(text.strip())
+        cache.put("stub", MESSAGES, text.strip())
+    cache.close()
+
+    whole, streamed, replayed = whole.summary(), streamed.summary(), replayed.summary()
+    assert (whole["streams"], streamed["streams"], replayed["streams"]) == (RESPONSES, 1, RESPONSES - 1)
+    assert replayed["cached"] == RESPONSES - 1
+    assert len(set(texts)) == 1
+    assert streamed["first_token_avg"] < whole["first_token_avg"] / 2
+    assert streamed["total_avg"] > whole["total_avg"] / 2
+    assert replayed["first_token_p50"] < LATENCY / 10
+
+
+# Timings are kept in histograms, so recording many responses keeps a bounded sample
+def test_stream_stats_stay_bounded():
+    stats = StreamStats()
+    for number in range(metrics.SAMPLES * 3):
+        stats.record(0.01, 0.02 + number % 10 / 100, cached=number % 2 == 0)
+    summary = stats.summary()
+    assert summary["streams"] == metrics.SAMPLES * 3
+    assert summary["cached"] == metrics.SAMPLES * 3 // 2
+    assert len(stats.first_token.samples) == len(stats.total.samples) == metrics.SAMPLES
+    assert abs(summary["first_token_avg"] - 0.01) < 1e-9
+    assert abs(summary["total_avg"] - 0.065) < 1e-3
+    assert summary["first_token_p50"] == 0.01
+
+
+# A stream that ends without any text counts its whole time as the time to the first token
+def test_empty_streams_are_timed():
+    stats = StreamStats()
+    assert list(timed(delta_text([{"choices": [{"delta": {"role": "assistant"}}]}]), stats)) == []
+    summary = stats.summary()
+    assert summary["streams"] == 1
+    assert summary["first_token_avg"] == summary["total_avg"]
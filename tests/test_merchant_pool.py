@@ -0,0 +1,74 @@
+import time
+
+import pytest
+
+import game_loop
+from merchant_pool import MerchantPool
+from stub_llm import MERCHANT_DESCRIPTIONS, StubLLM
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    stub = StubLLM()
+    monkeypatch.setattr(game_loop, "llm_backend", stub)
+    return stub
+
+
+# Waits for the refill thread, failing the test if it takes too long
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_refill_splits_one_batched_completion(stub):
+    pool = MerchantPool(game_loop.generate_merchant_descriptions, size=6, batch_size=3)
+    assert pool.refill()
+    assert stub.calls == 1
+    assert [pool.take() for _ in range(3)] == MERCHANT_DESCRIPTIONS
+    stats = pool.stats()
+    assert (stats["refills"], stats["generated"], stats["served"], stats["failures"]) == (1, 3, 3, 0)
+
+
+def test_take_from_an_empty_pool_is_a_miss(stub):
+    pool = MerchantPool(game_loop.generate_merchant_descriptions)
+    assert pool.take() is None
+    assert pool.stats()["misses"] == 1
+
+
+def test_background_refill_below_low_water(stub):
+    pool = MerchantPool(game_loop.generate_merchant_descriptions, size=6, low_water=2, batch_size=3).start()
+    try:
+        wait_for(lambda: len(pool) == 6)
+        for _ in range(5):
+            assert pool.take() is not None
+        wait_for(lambda: len(pool) == 6)
+        assert pool.stats()["refills"] == 4
+    finally:
+        pool.stop()
+
+
+def test_failed_completion_is_counted(monkeypatch):
+    monkeypatch.setattr(game_loop, "llm_backend", StubLLM(error_rate=1.0))
+    pool = MerchantPool(game_loop.generate_merchant_descriptions)
+    assert not pool.refill()
+    assert (pool.stats()["failures"], pool.stats()["refills"], len(pool)) == (1, 0, 0)
+
+
+# A reply that ignores the separators can split into nothing but blanks
+def test_empty_batch_is_a_failure():
+    pool = MerchantPool(lambda count: game_loop.split_merchant_descriptions("---\n---\n"))
+    assert not pool.refill()
+    assert (pool.stats()["failures"], pool.stats()["refills"], len(pool)) == (1, 0, 0)
+
+
+# A reply with more merchants than were asked for only fills the pool up to its size
+def test_refill_never_overfills_the_pool():
+    pool = MerchantPool(lambda count: [f"Merchant {number}" for number in range(count + 5)], size=4, batch_size=3)
+    assert pool.refill()
+    assert len(pool) == 3
+    assert pool.refill()
+    assert len(pool) == 4
+    assert pool.stats()["generated"] == 4
+    assert [pool.take() for _ in range(4)] == ["Merchant 0", "Merchant 1", "Merchant 2", "Merchant 0"]
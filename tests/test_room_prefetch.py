@@ -0,0 +1,117 @@
+import threading
+import time
+
+import pytest
+
+import game_loop
+from room_prefetch import RoomPrefetcher
+from stub_llm import ROOM_DESCRIPTIONS, StubLLM
+
+LATENCY = 0.2  # Seconds the stub LLM takes to answer
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    stub = StubLLM(latency=LATENCY)
+    monkeypatch.setattr(game_loop, "llm_backend", stub)
+    return stub
+
+
+# A prefetcher installed in the game like the console game does, stopped after the test
+@pytest.fixture
+def install(monkeypatch):
+    prefetchers = []
+
+    def install(generate=game_loop.request_room_description, **options):
+        prefetcher = RoomPrefetcher(generate, **options).start()
+        prefetchers.append(prefetcher)
+        monkeypatch.setattr(game_loop, "room_prefetcher", prefetcher)
+        return prefetcher
+
+    yield install
+    for prefetcher in prefetchers:
+        prefetcher.stop()
+
+
+# What play_turn does while the player is in a room
+def prefetch_around(game_state, location):
+    prefetcher = game_loop.room_prefetcher
+    prefetcher.prefetch(game_loop.unexplored_exits(game_state, location, prefetcher.depth))
+
+
+def test_move_into_a_prefetched_room_does_not_wait(stub, install):
+    prefetcher = install(concurrency=4)
+    game_state = game_loop.new_game_state()
+    prefetch_around(game_state, "castle")
+    time.sleep(LATENCY * 2)  # The player reads the room
+    calls = stub.calls
+    started = time.perf_counter()
+    room_id = game_loop.generate_dynamic_room("north", "castle", game_state)
+    assert time.perf_counter() - started < LATENCY / 4
+    assert stub.calls == calls  # No request made for the move
+    assert game_state["locations"][room_id]["description"] in ROOM_DESCRIPTIONS
+    assert (prefetcher.hits, prefetcher.misses) == (1, 0)
+
+
+def test_failed_prefetch_falls_back_to_on_demand(stub, install):
+    def fail(location, direction):
+        raise ConnectionError("the AI model is down")
+
+    prefetcher = install(fail)
+    game_state = game_loop.new_game_state()
+    prefetch_around(game_state, "castle")
+    room_id = game_loop.generate_dynamic_room("north", "castle", game_state)
+    assert game_state["locations"][room_id]["description"] in ROOM_DESCRIPTIONS
+    assert stub.calls == 1  # Generated on demand instead
+    assert (prefetcher.hits, prefetcher.misses) == (0, 1)
+
+
+def test_exit_that_was_not_prefetched_is_generated_on_demand(stub, install):
+    prefetcher = install()
+    game_state = game_loop.new_game_state()
+    room_id = game_loop.generate_dynamic_room("east", "castle", game_state)
+    assert game_state["locations"][room_id]["description"] in ROOM_DESCRIPTIONS
+    assert (stub.calls, prefetcher.misses) == (1, 1)
+
+
+def test_concurrency_limit(install):
+    running, most = 0, 0
+    lock = threading.Lock()
+
+    def generate(location, direction):
+        nonlocal running, most
+        with lock:
+            running += 1
+            most = max(most, running)
+        time.sleep(0.05)
+        with lock:
+            running -= 1
+        return f"{location} {direction}"
+
+    prefetcher = install(generate, concurrency=2)
+    exits = [(f"room_{number}", direction) for number in range(3) for direction in ("north", "south")]
+    prefetcher.prefetch(exits)
+    assert [prefetcher.take(*key) for key in exits] == [f"{location} {direction}" for location, direction in exits]
+    assert most == 2
+
+
+@pytest.mark.parametrize("depth, expected", [
+    (0, set()),
+    (1, {("castle", "south"), ("castle", "east"), ("castle", "west")}),
+    (2, {("castle", "south"), ("castle", "east"), ("castle", "west"),
+         ("room_1", "north"), ("room_1", "east"), ("room_1", "west")}),
+])
+def test_depth(stub, install, depth, expected):
+    requested = set()
+
+    def generate(location, direction):
+        requested.add((location, direction))
+        return f"{location} {direction}"
+
+    prefetcher = install(generate, depth=depth)
+    game_state = game_loop.new_game_state()
+    game_loop.generate_dynamic_room("north", "castle", game_state)
+    prefetch_around(game_state, "castle")
+    for key in expected:
+        assert prefetcher.take(*key) == f"{key[0]} {key[1]}"
+    assert requested == expected
@@ -0,0 +1,62 @@
+import itertools
+import json
+
+import pytest
+
+import game_loop
+from content import GameRNG, game_rng
+from entities import to_json
+from save_journal import load_state
+from save_schema import to_save_data
+from stub_llm import StubLLM
+
+# Moves with answers for the fights, encounters and merchants met on the way
+COMMANDS = ["north", "fight", "1", "1", "yes", "east", "fight", "1", "1", "slice", "exit",
+            "south", "fight", "1", "1", "no", "west", "1", "north", "east", "exit", "stats"]
+
+
+class ScriptedIO:
+    def __init__(self, commands):
+        self.commands = itertools.cycle(commands)
+
+    def ask(self, prompt):
+        return next(self.commands)
+
+    def say(self, text=""):
+        pass
+
+    def write(self, text):
+        pass
+
+
+# The state as it would be written, in plain JSON
+def saved_form(state):
+    data = to_save_data(state)
+    data.pop("save_generation", None)
+    return json.loads(json.dumps(data, default=to_json))
+
+
+# Saves only look at the rooms the game touched and the player fields that changed, so every save of a
+# long game (and of the same game loaded again partway) has to load back exactly as the game was
+@pytest.mark.parametrize("extension", ["json", "bin"])
+def test_every_save_loads_as_the_game_was(tmp_path, monkeypatch, extension):
+    monkeypatch.setattr(game_loop, "llm_backend", StubLLM())
+    filename = str(tmp_path / f"game.{extension}")
+    rng_token = game_rng.set(GameRNG(1))
+    io_token = game_loop.game_io.set(ScriptedIO(COMMANDS))
+    try:
+        game_state = game_loop.new_game_state()
+        game_state["player"].max_hp = game_state["player"].current_hp = 10_000  # Long enough to explore
+        current_location = game_state["current_location"]
+        for turn in range(300):
+            if turn == 100:
+                game_state = game_loop.load_game(filename)
+                current_location = game_state["current_location"]
+            game_loop.save_game(game_state, current_location, filename)
+            assert saved_form(load_state(filename)) == saved_form(game_state), f"turn {turn}"
+            current_location, outcome = game_loop.play_turn(game_state, current_location)
+            assert outcome is None
+    finally:
+        game_loop.game_io.reset(io_token)
+        game_rng.reset(rng_token)
+    assert len(game_state["dynamic_rooms"]) > 20
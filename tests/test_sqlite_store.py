@@ -0,0 +1,75 @@
+import itertools
+import json
+
+import pytest
+
+import game_loop
+from content import GameRNG, game_rng
+from entities import to_json
+from save_schema import to_save_data
+from sqlite_store import SaveStore
+from stub_llm import StubLLM
+
+# Moves with answers for the fights, encounters and merchants met on the way
+COMMANDS = ["north", "fight", "1", "1", "yes", "east", "fight", "1", "1", "slice", "exit",
+            "south", "fight", "1", "1", "no", "west", "1", "north", "east", "exit", "stats"]
+
+
+class ScriptedIO:
+    def __init__(self, commands):
+        self.commands = itertools.cycle(commands)
+
+    def ask(self, prompt):
+        return next(self.commands)
+
+    def say(self, text=""):
+        pass
+
+    def write(self, text):
+        pass
+
+
+def saved_form(state):
+    data = to_save_data(state)
+    return json.loads(json.dumps(data, default=to_json))
+
+
+# Each room's exits in order: a generated room's first exit has to lead back where it was generated from
+def exit_order(state):
+    return {room_id: list(room.get("connections", {})) for room_id, room in state["locations"].items()}
+
+
+@pytest.fixture
+def game(monkeypatch):
+    monkeypatch.setattr(game_loop, "llm_backend", StubLLM())
+    rng_token = game_rng.set(GameRNG(3))
+    io_token = game_loop.game_io.set(ScriptedIO(COMMANDS))
+    yield
+    game_loop.game_io.reset(io_token)
+    game_rng.reset(rng_token)
+
+
+# Saves only upsert what the game touched, so every save (including ones after the slot is loaded again
+# partway) has to load back exactly as the game was, exits in the same order
+def test_every_save_loads_as_the_game_was(game, tmp_path):
+    store = SaveStore(str(tmp_path / "saves.db"))
+    reader = SaveStore(str(tmp_path / "saves.db"))  # Loading from the store saving would reset its saved copy
+    try:
+        game_state = game_loop.new_game_state()
+        game_state["player"].max_hp = game_state["player"].current_hp = 10_000  # Long enough to explore
+        current_location = game_state["current_location"]
+        for turn in range(300):
+            if turn == 100:
+                game_state = game_loop.state_from_save(store.load("bob"))
+                current_location = game_state["current_location"]
+            game_state["current_location"] = current_location
+            store.save("bob", game_state)
+            loaded = reader.load("bob")
+            assert saved_form(loaded) == saved_form(game_state), f"turn {turn}"
+            assert exit_order(loaded) == exit_order(game_state), f"turn {turn}"
+            current_location, outcome = game_loop.play_turn(game_state, current_location)
+            assert outcome is None
+    finally:
+        store.close()
+        reader.close()
+    assert len(game_state["dynamic_rooms"]) > 20
@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+import game_loop
+from save_journal import load_state, write_snapshot
+from stub_llm import StubLLM
+from world_memory import BUDGET, ENCOUNTER_EVENTS, tokens
+
+DIRECTIONS = ["north", "south", "east", "west"]
+EVENTS = ["defeated a Skeleton", "defeated a Giant Rat", "fled from a Knight Statue"] + list(ENCOUNTER_EVENTS.values())
+
+
+# The stub LLM, noting the size of every room prompt it's sent
+class MeasuringStub(StubLLM):
+    def __init__(self):
+        super().__init__()
+        self.prompt_tokens = []
+
+    def create(self, model=None, messages=None, **kwargs):
+        self.prompt_tokens.append(tokens(messages[-1]["content"]))
+        return super().create(model=model, messages=messages, **kwargs)
+
+
+class QuietIO:
+    def ask(self, prompt):
+        return "1"
+
+    def say(self, text=""):
+        pass
+
+    def write(self, text):
+        pass
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    stub = MeasuringStub()
+    monkeypatch.setattr(game_loop, "llm_backend", stub)
+    monkeypatch.setattr(game_loop, "room_context_tokens", BUDGET)
+    for service in ("llm_client", "llm_cache", "room_prefetcher", "merchant_pool", "world_pack"):
+        monkeypatch.setattr(game_loop, service, None)
+    token = game_loop.game_io.set(QuietIO())
+    yield stub
+    game_loop.game_io.reset(token)
+
+
+# Generates rooms off random exits until the castle has 'rooms' of them, noting an event every few rooms
+def grow(game_state, rooms, rng):
+    while len(game_state["dynamic_rooms"]) < rooms:
+        location = rng.choice(["castle"] + list(game_state["dynamic_rooms"]))
+        before = len(game_state["dynamic_rooms"])
+        game_loop.generate_dynamic_room(rng.choice(DIRECTIONS), location, game_state)
+        if len(game_state["dynamic_rooms"]) > before and len(game_state["dynamic_rooms"]) % 7 == 0:
+            game_loop.remember(game_state, rng.choice(EVENTS))
+
+
+# Room prompts stay within the budget and the same size as the castle grows, including after the game is
+# saved and loaded again partway (a binary save reads room descriptions from the file when they're needed)
+@pytest.mark.parametrize("extension", ["json", "bin"])
+def test_room_prompts_stay_bounded_after_a_reload(stub, tmp_path, extension):
+    rng = random.Random(0)
+    plain = tokens(game_loop.room_prompt("room_10000", "north"))
+    game_state = game_loop.new_game_state()
+    grow(game_state, 500, rng)
+
+    filename = str(tmp_path / f"castle.{extension}")
+    write_snapshot(filename, game_state)
+    game_state = game_loop.state_from_save(load_state(filename))
+    location, direction = game_loop.unexplored_exits(game_state, "castle", 30)[0]
+    context = game_loop.room_context(game_state, location, direction)
+    assert "Next to it" in context or "rooms away" in context  # The loaded rooms around it are described
+
+    start = len(stub.prompt_tokens)
+    grow(game_state, 1_000, rng)
+    middle = len(stub.prompt_tokens)
+    grow(game_state, 2_000, rng)
+    early, late = stub.prompt_tokens[start:middle], stub.prompt_tokens[middle:]
+    assert max(stub.prompt_tokens) <= plain + BUDGET + 1  # Counting in one piece can round up by one
+    assert sum(late) / len(late) <= sum(early) / len(early) * 1.1
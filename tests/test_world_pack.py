@@ -0,0 +1,119 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import game_loop
+import world_pack
+from stub_llm import StubLLM
+from world_graph import DIRECTIONS
+from world_pack import WorldPack, generate
+
+ROOMS = 300
+MERCHANTS = 30
+SEED = 7
+
+
+# Starts generating a pack with the stub AI model in another process and kills it a third of the way in
+def interrupted_generation(filename):
+    options = ["--rooms", str(ROOMS), "--merchants", str(MERCHANTS), "--seed", str(SEED)]
+    generator = subprocess.Popen([sys.executable, os.path.abspath(world_pack.__file__), "generate", filename,
+                                  *options, "--stub", "0.01", "--workers", "4"], stdout=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                with open(filename + ".progress") as file:
+                    if file.read().count("\n") > ROOMS // 3:
+                        return
+            except FileNotFoundError:
+                pass
+            assert generator.poll() is None, "The generator finished before it could be interrupted"
+            time.sleep(0.01)
+    finally:
+        generator.kill()
+        generator.wait()
+
+
+@pytest.fixture(scope="module")
+def pack_file(tmp_path_factory):
+    filename = str(tmp_path_factory.mktemp("pack") / "castle.pack")
+    interrupted_generation(filename)
+    backend = StubLLM(latency=0.002, error_rate=0.1, seed=SEED)
+    counts = generate(filename, ROOMS, MERCHANTS, SEED, backend=backend, workers=8, base_delay=0.01, max_delay=0.05)
+    return filename, counts, backend
+
+
+# Resuming a killed run only sends the prompts it hadn't finished, and leaves a complete pack behind
+def test_generation_resumes_after_being_killed(pack_file):
+    filename, counts, backend = pack_file
+    total = ROOMS + -(-MERCHANTS // 3)
+    assert counts["reused"] >= ROOMS // 3
+    assert counts["sent"] + counts["reused"] == total
+    assert counts["sent"] == backend.calls - backend.errors
+    assert not os.path.exists(filename + ".progress")
+
+    pack = WorldPack(filename)
+    assert len(pack) == ROOMS
+    assert pack.merchants == MERCHANTS
+    assert len(pack.graph().reachable(0)) == ROOMS + 1
+    pack.close()
+
+
+@pytest.fixture
+def pack(pack_file, monkeypatch):
+    pack = WorldPack(pack_file[0])
+    live = StubLLM()
+    monkeypatch.setattr(game_loop, "llm_backend", live)
+    for name in ("llm_client", "llm_cache", "room_prefetcher", "merchant_pool"):
+        monkeypatch.setattr(game_loop, name, None)
+    monkeypatch.setattr(game_loop, "world_pack", pack)
+    yield pack
+    pack.close()
+
+
+# Every room in the pack is played without asking the AI model; a step past its edge asks once
+def test_game_plays_from_the_pack_offline(pack):
+    live = game_loop.llm_backend
+    game_state = game_loop.new_game_state()
+    names = ["castle"]
+    for x, y, parent, direction in pack.layout:
+        names.append(game_loop.generate_dynamic_room(DIRECTIONS[direction], names[parent], game_state))
+        assert game_state["locations"][names[-1]]["description"] is not None, f"The room at {x}, {y}"
+    assert live.calls == 0
+
+    edge = max(names, key=lambda name: game_state["locations"][name]["position"][0])
+    game_loop.generate_dynamic_room("east", edge, game_state)
+    assert live.calls == 1
+
+
+# Each of the pack's merchants is handed out once per game, then there are none left
+def test_pack_merchants_are_each_met_once(pack):
+    game_state = game_loop.new_game_state()
+    merchants = [pack.take_merchant(game_state) for _ in range(MERCHANTS + 1)]
+    assert None not in merchants[:MERCHANTS]
+    assert merchants[MERCHANTS] is None
+    assert pack.take_merchant(game_loop.new_game_state()) == merchants[0]
+
+
+# A loaded game meets the merchant after the last one it met before saving, not the pack's first again
+def test_loaded_games_carry_on_with_the_next_merchant(pack, tmp_path, monkeypatch):
+    monkeypatch.setattr(game_loop, "save_store", None)
+    monkeypatch.setattr(game_loop, "autosaver", None)
+    filename = str(tmp_path / "game_state.json")
+    game_state = game_loop.new_game_state()
+    for _ in range(3):
+        pack.take_merchant(game_state)
+    game_loop.save_game(game_state, "castle", filename)
+    game_loop.save_game(game_state, "castle", filename)
+    pack.take_merchant(game_state)
+    game_loop.save_game(game_state, "castle", filename)
+
+    loaded = game_loop.load_game(filename)
+    fresh = game_loop.new_game_state()
+    fifth = [pack.take_merchant(fresh) for _ in range(5)][-1]
+    assert pack.take_merchant(loaded) == fifth
+    left = [pack.take_merchant(loaded) for _ in range(MERCHANTS - 5)]
+    assert None not in left
+    assert pack.take_merchant(loaded) is None
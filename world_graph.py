@@ -0,0 +1,296 @@
+import random
+import sys
+import time
+import tracemalloc
+from array import array
+from collections import deque
+
+# An index of the castle's rooms for fast movement and map queries.
+# Every castle room has an integer id: the castle is 0 and "room_N" is N, so names and ids convert
+# without a lookup table. Exits live in one flat array with four slots per room (north, south, east,
+# west) and every room has a grid position, with the castle at (0, 0) and north being +y. A coordinate
+# index maps each position to the room there, so walking around a block comes back into the room that's
+# already there instead of generating a new one.
+#
+# The rooms themselves (descriptions, enemies, 'visited') stay in game_state["locations"], which is what
+# gets saved. The graph is rebuilt from those rooms when a game is loaded.
+
+DIRECTIONS = ("north", "south", "east", "west")
+DIRECTION_INDEX = {direction: index for index, direction in enumerate(DIRECTIONS)}
+OPPOSITE = (1, 0, 3, 2)                         # Index of the opposite direction
+OFFSETS = ((0, 1), (0, -1), (1, 0), (-1, 0))    # Grid step for each direction
+NO_ROOM = -1
+
+
+# Packs a grid position into one int for the coordinate index (cheaper than a tuple key)
+def _position_key(x, y):
+    return (x << 32) | (y & 0xFFFFFFFF)
+
+
+class RoomRecord:
+    """A read-only view of one room in the graph."""
+
+    __slots__ = ("id", "name", "x", "y", "exits")
+
+    def __init__(self, room_id, name, x, y, exits):
+        self.id = room_id
+        self.name = name
+        self.x = x
+        self.y = y
+        self.exits = exits  # Direction -> id of the room that way
+
+    def __repr__(self):
+        return f"RoomRecord({self.name!r}, x={self.x}, y={self.y}, exits={self.exits})"
+
+
+class WorldGraph:
+    """Castle rooms with integer ids, an exit array and a grid position index."""
+
+    def __init__(self):
+        self._exits = array("i")        # Four entries per room id: the room id that way, or NO_ROOM
+        self._x = array("i")
+        self._y = array("i")
+        self._present = bytearray()     # 1 for ids that are rooms (ids from old saves can have gaps)
+        self._positions = {}            # Packed grid position -> room id
+        self._other_ids = {}            # Rooms whose name isn't "room_N" (none in games made by this version)
+        self._other_names = {}
+        self.rooms = 0
+
+    # A graph is part of the game state but never saved or copied with it: save copies share it
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __len__(self):
+        return self.rooms
+
+    def __contains__(self, name):
+        return self.id_of(name) is not None
+
+    # Converts a room name to its id, or None if it isn't a castle room in the graph
+    def id_of(self, name):
+        if name == "castle":
+            room_id = 0
+        elif name.startswith("room_") and name[5:].isdigit():
+            room_id = int(name[5:])
+        else:
+            return self._other_ids.get(name)
+        return room_id if room_id < len(self._present) and self._present[room_id] else None
+
+    def name_of(self, room_id):
+        if room_id in self._other_names:
+            return self._other_names[room_id]
+        return "castle" if room_id == 0 else f"room_{room_id}"
+
+    # The id the next new room gets. Its name is name_of(next_id())
+    def next_id(self):
+        return len(self._present)
+
+    def _grow(self, size):
+        missing = size - len(self._present)
+        if missing > 0:
+            self._exits.extend([NO_ROOM] * (4 * missing))
+            self._x.extend([0] * missing)
+            self._y.extend([0] * missing)
+            self._present.extend(bytes(missing))
+
+    # Adds a room at a grid position and returns its id. The position is only indexed if no other
+    # room is there already (rooms from old saves can overlap)
+    def add_room(self, x, y, name=None):
+        """Add a room to the graph and return its id."""
+        room_id = self.next_id() if name is None else self.id_of_new(name)
+        self._grow(room_id + 1)
+        self._present[room_id] = 1
+        self._x[room_id] = x
+        self._y[room_id] = y
+        self._positions.setdefault(_position_key(x, y), room_id)
+        self.rooms += 1
+        return room_id
+
+    # The id a room with this name is stored under
+    def id_of_new(self, name):
+        if name == "castle":
+            return 0
+        if name.startswith("room_") and name[5:].isdigit():
+            return int(name[5:])
+        room_id = max(self.next_id(), max(self._other_names, default=0) + 1)
+        self._other_ids[name] = room_id
+        self._other_names[room_id] = name
+        return room_id
+
+    # Links two rooms in both directions
+    def connect(self, room_id, direction, other_id):
+        index = DIRECTION_INDEX[direction]
+        self._exits[4 * room_id + index] = other_id
+        self._exits[4 * other_id + OPPOSITE[index]] = room_id
+
+    # The id of the room through an exit, or NO_ROOM
+    def neighbor(self, room_id, direction):
+        return self._exits[4 * room_id + DIRECTION_INDEX[direction]]
+
+    def position(self, room_id):
+        return self._x[room_id], self._y[room_id]
+
+    # The grid position one step from a room
+    def step(self, room_id, direction):
+        dx, dy = OFFSETS[DIRECTION_INDEX[direction]]
+        return self._x[room_id] + dx, self._y[room_id] + dy
+
+    # The id of the room at a grid position, or None
+    def room_at(self, x, y):
+        return self._positions.get(_position_key(x, y))
+
+    def room(self, room_id):
+        """Return a RoomRecord for a room id."""
+        exits = {direction: self._exits[4 * room_id + index]
+                 for index, direction in enumerate(DIRECTIONS) if self._exits[4 * room_id + index] != NO_ROOM}
+        return RoomRecord(room_id, self.name_of(room_id), self._x[room_id], self._y[room_id], exits)
+
+    # Breadth-first search over exits. Returns the ids on the shortest path, both ends included,
+    # or None if the rooms aren't connected
+    def shortest_path(self, start, goal):
+        """Return the room ids on a shortest path between two rooms, or None."""
+        if start == goal:
+            return [start]
+        previous = {start: start}
+        queue = deque([start])
+        exits = self._exits
+        while queue:
+            room_id = queue.popleft()
+            for other in exits[4 * room_id:4 * room_id + 4]:
+                if other != NO_ROOM and other not in previous:
+                    previous[other] = room_id
+                    if other == goal:
+                        path = [goal]
+                        while path[-1] != start:
+                            path.append(previous[path[-1]])
+                        return path[::-1]
+                    queue.append(other)
+        return None
+
+    # Breadth-first search from a room. Returns the id and distance of every room that can be
+    # reached, stopping 'max_distance' exits away if it's given
+    def reachable(self, start, max_distance=None):
+        """Return {room id: distance} for every room reachable from 'start'."""
+        distances = {start: 0}
+        queue = deque([start])
+        exits = self._exits
+        while queue:
+            room_id = queue.popleft()
+            distance = distances[room_id] + 1
+            if max_distance is not None and distance > max_distance:
+                continue
+            for other in exits[4 * room_id:4 * room_id + 4]:
+                if other != NO_ROOM and other not in distances:
+                    distances[other] = distance
+                    queue.append(other)
+        return distances
+
+    # Builds the graph for the castle rooms of a game's locations. Rooms saved before positions existed
+    # are placed by walking their connections out from the castle, and their position is added to the room
+    @classmethod
+    def from_locations(cls, locations, is_castle_room):
+        """Build a graph from game_state["locations"]."""
+        world = cls()
+        if "castle" not in locations:
+            return world
+        castle_rooms = [name for name in locations if is_castle_room(name)]
+        # Place rooms by breadth-first search from the castle, so each unplaced room sits one step from
+        # the room it was found from
+        locations["castle"].setdefault("position", [0, 0])
+        queue = deque(["castle"])
+        placed = {"castle"}
+        while queue:
+            name = queue.popleft()
+            x, y = locations[name]["position"]
+            for direction, target in locations[name].get("connections", {}).items():
+                if target in placed or target not in locations or not is_castle_room(target):
+                    continue
+                dx, dy = OFFSETS[DIRECTION_INDEX[direction]]
+                locations[target].setdefault("position", [x + dx, y + dy])
+                placed.add(target)
+                queue.append(target)
+        for name in castle_rooms:
+            x, y = locations[name].get("position", (0, 0))
+            world.add_room(x, y, name)
+        for name in castle_rooms:
+            room_id = world.id_of(name)
+            for direction, target in locations[name].get("connections", {}).items():
+                other_id = world.id_of(target)
+                if other_id is not None:
+                    world._exits[4 * room_id + DIRECTION_INDEX[direction]] = other_id
+        return world
+
+
+# Builds a square-ish world of 'rooms' rooms by walking back and forth in rows, generating a room
+# on every step the way the game does
+def _grid_world(rooms):
+    world = WorldGraph()
+    world.add_room(0, 0, "castle")
+    current = 0
+    width = max(1, int(rooms ** 0.5))
+    row = 0
+    while world.rooms < rooms:
+        direction = "east" if row % 2 == 0 else "west"
+        for _ in range(min(width - 1, rooms - world.rooms)):
+            current = _move(world, current, direction)
+        if world.rooms < rooms:
+            current = _move(world, current, "north")
+        row += 1
+    return world
+
+
+# One move, as game_loop.move_player makes it: follow the exit, or join the room at the next position,
+# or add a new room there
+def _move(world, current, direction):
+    other = world.neighbor(current, direction)
+    if other != NO_ROOM:
+        return other
+    x, y = world.step(current, direction)
+    other = world.room_at(x, y)
+    if other is None:
+        other = world.add_room(x, y)
+    world.connect(current, direction, other)
+    return other
+
+
+def benchmark(rooms=1_000_000, moves=1_000_000, seed=0):
+    """Print the memory per room and the time per move of a large world."""
+    tracemalloc.start()
+    world = _grid_world(rooms)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"{world.rooms:,} rooms: {memory / 1e6:.1f} MB ({memory / world.rooms:.0f} bytes per room)")
+
+    # Random walks from the middle of the world follow known exits, join neighbors and, near the
+    # edges, generate new rooms
+    rng = random.Random(seed)
+    directions = [DIRECTIONS[rng.randrange(4)] for _ in range(moves)]
+    current = world.room_at(*world.position(world.next_id() // 2))
+    added = world.rooms
+    started = time.perf_counter()
+    for direction in directions:
+        current = _move(world, current, direction)
+    per_move = (time.perf_counter() - started) / moves
+    print(f"Moves: {per_move * 1e6:.2f} µs per move over {moves:,} moves ({world.rooms - added:,} new rooms)")
+
+    # Walking straight out of the world generates a new room on every move
+    started = time.perf_counter()
+    for _ in range(100_000):
+        current = _move(world, current, "south")
+    print(f"New rooms: {(time.perf_counter() - started) / 100_000 * 1e6:.2f} µs per room")
+
+    started = time.perf_counter()
+    path = world.shortest_path(0, world.room_at(*world.position(rooms - 1)))
+    print(f"Shortest path from the castle to the far corner: {len(path) - 1} steps "
+          f"in {(time.perf_counter() - started) * 1000:.1f}ms")
+    started = time.perf_counter()
+    nearby = world.reachable(current, max_distance=10)
+    print(f"Rooms within 10 steps of the player: {len(nearby)} in {(time.perf_counter() - started) * 1000:.2f}ms")
+
+
+if __name__ == "__main__":
+    # python world_graph.py [rooms]
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
@@ -0,0 +1,156 @@
+import heapq
+import re
+from collections import Counter, OrderedDict, deque
+
+from world_graph import OFFSETS
+
+# World memory for room prompts.
+# A generated room used to be described knowing only which room it's connected to, so it had nothing to do
+# with anything the player had seen. Pasting in every room described so far would make each prompt (and
+# its cost) grow with the castle. Instead a WorldMemory adds a few sentences of context that never grow past
+# a fixed number of tokens, however big the castle gets:
+#   - the rooms around the new one: its neighbors on the grid and the rooms a couple of exits from the room
+#     it's generated from, nearest first, each shortened to a summary of its first sentence
+#   - the player: level, HP, gold and what they carry most of
+#   - what happened lately: the last few events word for word, and the most common of the older ones counted
+# Summaries are made once per room, the first time the room is near a new one, and kept.
+# The context for an exit is kept too once it's been made, so the prompt sent ahead of time for a room and
+# the prompt sent when the player walks in are the same (and a request already queued is joined).
+
+BUDGET = 150           # Tokens of context added to a room prompt
+ROOM_TOKENS = 24       # Most tokens one room's summary takes
+RADIUS = 2             # Rooms up to this many exits from the room the new one is generated from are nearby
+MAX_ROOMS = 6          # Nearby rooms described at most
+RECENT_EVENTS = 4      # Events kept word for word
+EARLIER_EVENTS = 3     # Older events listed (the most common ones)
+CACHED_CONTEXTS = 64   # Exits whose context is kept
+
+# What an encounter adds to the events
+ENCOUNTER_EVENTS = {
+    "locked_chest": "found a locked chest",
+    "falling_bookshelf": "were nearly crushed by a falling bookshelf",
+    "mysterious_puzzle": "found a puzzle etched into a wall",
+    "traveling_merchant": "met a traveling merchant",
+}
+
+
+# A rough token count, about four characters per token (the same estimate as llm_client.estimate_tokens)
+def tokens(text):
+    return len(text) // 4
+
+
+# Shortens a room description to its first sentence, cut at a word to fit in 'max_tokens'
+def summarize(description, max_tokens=ROOM_TOKENS):
+    """Return a short summary of a room description."""
+    text = " ".join(description.split())
+    end = re.search(r"[.!?](\s|$)", text)
+    if end:
+        text = text[:end.start() + 1]
+    if len(text) > max_tokens * 4:
+        text = text[:max_tokens * 4 - 3].rsplit(" ", 1)[0].rstrip(",;:") + "..."
+    return text
+
+
+# Which way a grid position lies from another one, like "north" or "south-east"
+def _bearing(dx, dy):
+    return "-".join(part for part in ("north" if dy > 0 else "south" if dy < 0 else "",
+                                      "east" if dx > 0 else "west" if dx < 0 else "") if part)
+
+
+class WorldMemory:
+    """Short, bounded context about the world around a new room, for its prompt."""
+
+    def __init__(self, budget=BUDGET, recent_events=RECENT_EVENTS):
+        self.budget = budget                         # Most tokens of context for one room
+        self.recent = deque(maxlen=recent_events)    # The latest events, oldest first
+        self.earlier = Counter()                     # Older events -> times they happened
+        self._summaries = {}                         # Room id -> (description, summary)
+        self._contexts = OrderedDict()               # (location, direction) -> context, least recently used first
+
+    # The memory is part of the game state but never saved or copied with it, like the room graph
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    # Notes something the player did or found ("defeated a Skeleton")
+    def record(self, event):
+        if len(self.recent) == self.recent.maxlen:
+            self.earlier[self.recent[0]] += 1
+        self.recent.append(event)
+
+    # A room's summary, made the first time it's needed and again only if the description changes
+    def summary(self, room_id, description):
+        cached = self._summaries.get(room_id)
+        if cached is None or cached[0] != description:
+            cached = self._summaries[room_id] = (description, summarize(description))
+        return cached[1]
+
+    # The rooms near the room behind an exit, nearest first: (room id, grid distance, bearing from the new room).
+    # Only the rooms a few exits away are looked at, so this takes the same time in any size of castle
+    def neighborhood(self, world, origin, direction):
+        x, y = world.step(origin, direction)
+        nearby = set(world.reachable(origin, RADIUS))
+        for dx, dy in OFFSETS:
+            room = world.room_at(x + dx, y + dy)
+            if room is not None:
+                nearby.add(room)
+        nearby.discard(world.room_at(x, y))  # The new room itself, when it's already in the graph
+        rooms = []
+        for room in nearby:
+            room_x, room_y = world.position(room)
+            rooms.append((abs(room_x - x) + abs(room_y - y), room, _bearing(room_x - x, room_y - y)))
+        return [(room, distance, bearing) for distance, room, bearing in heapq.nsmallest(MAX_ROOMS, rooms)]
+
+    # A line about the player: level, HP, gold and the three things they carry most of
+    @staticmethod
+    def player_summary(player):
+        items = heapq.nlargest(3, player.inventory.items(), key=lambda item: item[1])
+        carrying = ", ".join(f"{count} {item.replace('_', ' ')}{'s' if count > 1 else ''}"
+                             for item, count in items) or "nothing"
+        others = len(player.inventory) - len(items)
+        if others > 0:
+            carrying += f" and {others} other kind{'s' if others > 1 else ''} of item"
+        return (f"The player is level {player.level} with {player.current_hp}/{player.max_hp} HP and "
+                f"{player.gold} gold, carrying {carrying}.")
+
+    def events_summary(self):
+        recent = f"Lately they {'; '.join(reversed(self.recent))}." if self.recent else ""
+        earlier = "; ".join(f"{event} (x{count})" if count > 1 else event
+                            for event, count in self.earlier.most_common(EARLIER_EVENTS))
+        return recent, f"Before that they {earlier}." if earlier else ""
+
+    # The context for the room behind an exit, made the first time it's asked for and kept after that
+    def context(self, game_state, world, location, direction):
+        """Return a few sentences about the world around the room behind an exit, within the budget."""
+        key = (location, direction)
+        context = self._contexts.get(key)
+        if context is not None:
+            self._contexts.move_to_end(key)
+            return context
+        context = self._build(game_state, world, world.id_of(location), direction)
+        self._contexts[key] = context
+        if len(self._contexts) > CACHED_CONTEXTS:
+            self._contexts.popitem(last=False)
+        return context
+
+    # Adds the pieces of context in order of importance (the nearest room, the player, recent events, the
+    # other nearby rooms, older events), leaving out any that would go over the budget
+    def _build(self, game_state, world, origin, direction):
+        locations = game_state["locations"]
+        rooms = []
+        for room, distance, bearing in self.neighborhood(world, origin, direction):
+            # Indexing (not .get) so a room from a binary save reads its description from the file
+            description = locations[world.name_of(room)]["description"]
+            if description:
+                where = "Next to it" if distance == 1 else f"{distance} rooms away"
+                rooms.append(f"{where} to the {bearing}: {self.summary(room, description)}")
+        recent, earlier = self.events_summary()
+        pieces = rooms[:1] + [self.player_summary(game_state["player"]), recent] + rooms[1:] + [earlier]
+        context = "Keep it consistent with what the player has seen so far."
+        for piece in pieces:
+            if piece and tokens(context + " " + piece) <= self.budget:
+                context += " " + piece
+        return context
+
@@ -0,0 +1,316 @@
+import json
+import mmap
+import os
+import random
+import struct
+import time
+import zlib
+
+from llm_client import PRIORITY_PREFETCH, LLMClient
+from world_graph import DIRECTIONS, OFFSETS, WorldGraph
+
+# Castle content generated ahead of time.
+# A world pack holds the castle's rooms and a supply of merchants, generated offline from a seed so the
+# game can serve them without asking the AI model anything. The seed lays out the castle: rooms grow
+# out from the castle one at a time, each next to a room already placed, and every room gets the prompt
+# the game would send for it, walking in from the room it grew from. All the prompts go through a shared
+# LLMClient, so a pool of workers generates many rooms at once while staying under the API's rate limits.
+#
+# Every finished description is appended to a progress file next to the pack as it arrives. A run
+# that's interrupted picks up from there when it's started again, and only sends the prompts that are
+# still missing. Once everything is in, the pack is written and the progress file is removed.
+#
+# Layout of a pack file:
+#   magic b"DDWP", format version (u16), header length (u32)
+#   header: JSON with the seed, the pack's id and the layout, one [x, y, parent, direction] per room,
+#           where parent is the index of the room it grew from (0 is the castle, rooms count from 1)
+#   index: record count (u32), then an (offset u64, length u32) entry per record: the rooms in layout
+#          order, then the merchants
+#   records: the descriptions, each UTF-8 and zlib compressed on its own
+#
+# The game memory-maps the pack and only reads and decompresses a record when it needs that room.
+#
+#   python world_pack.py generate castle.pack --rooms 500 --merchants 30 --seed 7
+#   python world_pack.py info castle.pack
+#   WORLD_PACK=castle.pack python game_loop.py
+
+MAGIC = b"DDWP"
+FORMAT_VERSION = 1
+PREAMBLE = struct.Struct("<4sHI")
+INDEX_ENTRY = struct.Struct("<QI")
+COUNT = struct.Struct("<I")
+
+
+# Lays out 'rooms' castle rooms from a seed. Each room is placed next to a room that's already there,
+# through a randomly picked open exit, so the castle grows outwards like a player exploring it would.
+# Returns [x, y, parent, direction index] for every room, with the castle (0, at 0, 0) left out
+def castle_layout(rooms, seed):
+    rng = random.Random(seed)
+    taken = {(0, 0)}
+    layout = []
+    exits = [(0, 0, 0, direction) for direction in range(len(DIRECTIONS))]  # (x, y, room, direction)
+    while len(layout) < rooms:
+        if not exits:
+            raise ValueError("The castle has no room left to grow")
+        index = rng.randrange(len(exits))
+        exits[index], exits[-1] = exits[-1], exits[index]
+        x, y, parent, direction = exits.pop()
+        dx, dy = OFFSETS[direction]
+        position = (x + dx, y + dy)
+        if position in taken:
+            continue
+        taken.add(position)
+        layout.append([position[0], position[1], parent, direction])
+        exits.extend((position[0], position[1], len(layout), other) for other in range(len(DIRECTIONS)))
+    return layout
+
+
+def _room_name(index):
+    return "castle" if index == 0 else f"room_{index}"
+
+
+# The prompts a pack is generated from: one per room, then one per batch of merchants.
+# Every prompt is different, since the client would otherwise send identical prompts only once
+def pack_prompts(layout, merchants, batch_size):
+    import game_loop
+
+    prompts = {}
+    for index, (_, _, parent, direction) in enumerate(layout, 1):
+        prompts[f"room {index}"] = game_loop.room_prompt(_room_name(parent), DIRECTIONS[direction])
+    batches = -(-merchants // batch_size)
+    for batch in range(batches):
+        count = min(batch_size, merchants - batch * batch_size)
+        prompts[f"merchants {batch}"] = game_loop.merchant_batch_prompt(count) + f" (Batch {batch + 1} of {batches}.)"
+    return prompts
+
+
+class Progress:
+    """The responses a pack generation has collected so far, kept in a file as they arrive."""
+
+    def __init__(self, filename, settings):
+        self.filename = filename
+        self.settings = settings  # The generation settings, which a resumed run has to match
+        self.done = {}            # Prompt key -> response text
+
+    # Reads what an earlier run collected. A half-written last line (from a run that was killed) is cut off
+    def load(self):
+        try:
+            with open(self.filename, "r+", encoding="utf-8") as file:
+                lines = file.read().split("\n")
+                header = json.loads(lines[0])
+                if header != self.settings:
+                    raise ValueError(f"{self.filename} was started with other settings ({header}); "
+                                     f"remove it to start over")
+                good = 1
+                for line in lines[1:]:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    self.done[entry["key"]] = entry["text"]
+                    good += 1
+                file.seek(0)
+                file.truncate(len("".join(line + "\n" for line in lines[:good]).encode("utf-8")))
+        except FileNotFoundError:
+            with open(self.filename, "w", encoding="utf-8") as file:
+                file.write(json.dumps(self.settings) + "\n")
+        return self
+
+    def add(self, key, text):
+        self.done[key] = text
+        with open(self.filename, "a", encoding="utf-8") as file:
+            file.write(json.dumps({"key": key, "text": text}) + "\n")
+
+
+def generate(filename, rooms=200, merchants=24, seed=0, backend=None, workers=8, batch_size=3,
+             model="gpt-3.5-turbo", progress=None, **client_options):
+    """Generate a world pack, resuming an interrupted run. Returns how many prompts were sent and reused.
+
+    'backend' is openai.ChatCompletion (the default) or anything with the same create() method, like
+    stub_llm.StubLLM. Other keyword arguments are passed on to the LLMClient (rate limits and retries).
+    'progress', if given, is called with (prompts done, prompts in total) as responses arrive.
+    """
+    from concurrent.futures import as_completed
+    import game_loop
+
+    settings = {"version": FORMAT_VERSION, "rooms": rooms, "merchants": merchants, "seed": seed,
+                "batch_size": batch_size, "model": model}
+    layout = castle_layout(rooms, seed)
+    prompts = pack_prompts(layout, merchants, batch_size)
+    done = Progress(filename + ".progress", settings).load()
+    reused = len(done.done)
+    missing = [key for key in prompts if key not in done.done]
+
+    if missing:
+        if backend is None:
+            game_loop.load_environment()
+            backend = game_loop.openai_api().ChatCompletion
+        # A prompt that fails even after the client's retries doesn't stop the others. Everything that
+        # comes back is kept, so running again only sends the prompts that failed
+        client = LLMClient(backend, workers=workers, **client_options).start()
+        futures = {client.submit(model, game_loop.dungeon_master_messages(prompts[key]), PRIORITY_PREFETCH): key
+                   for key in missing}
+        error = None
+        for future in as_completed(futures):
+            try:
+                done.add(futures[future], future.result().strip())
+            except Exception as failure:
+                error = error or failure
+                continue
+            if progress is not None:
+                progress(len(done.done), len(prompts))
+        client.stop()
+        if error is not None:
+            raise error
+
+    descriptions = [done.done[f"room {index}"] for index in range(1, rooms + 1)]
+    merchant_descriptions = []
+    for key in prompts:
+        if key.startswith("merchants "):
+            merchant_descriptions.extend(game_loop.split_merchant_descriptions(done.done[key]))
+    write_pack(filename, seed, layout, descriptions, merchant_descriptions[:merchants])
+    os.remove(done.filename)
+    return {"sent": len(missing), "reused": reused}
+
+
+# Writes a pack file (to a temporary file first, so an interrupted write never leaves a broken pack)
+def write_pack(filename, seed, layout, descriptions, merchants):
+    """Write rooms and merchants to a world pack file."""
+    records = [zlib.compress(text.encode("utf-8"), 9) for text in descriptions + merchants]
+    pack_id = os.urandom(8).hex()  # Tells packs apart, so a replay can check it has the pack it was recorded with
+    header = json.dumps({"seed": seed, "id": pack_id, "layout": layout, "merchants": len(merchants)},
+                        separators=(",", ":")).encode("utf-8")
+    offset = PREAMBLE.size + len(header) + COUNT.size + len(records) * INDEX_ENTRY.size
+    index = bytearray(COUNT.pack(len(records)))
+    for record in records:
+        index += INDEX_ENTRY.pack(offset, len(record))
+        offset += len(record)
+
+    with open(filename + ".tmp", "wb") as file:
+        file.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+        file.write(header)
+        file.write(index)
+        for record in records:
+            file.write(record)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(filename + ".tmp", filename)
+
+
+class WorldPack:
+    """Serve castle rooms and merchants from a world pack file."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_length = PREAMBLE.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{filename} is not a world pack")
+        if version > FORMAT_VERSION:
+            raise ValueError(f"World pack version {version} is newer than this game supports ({FORMAT_VERSION})")
+        header = json.loads(self._map[PREAMBLE.size:PREAMBLE.size + header_length])
+        self.seed = header["seed"]
+        self.pack_id = header["id"]
+        self.layout = header["layout"]
+        self.merchants = header["merchants"]
+        self._index_offset = PREAMBLE.size + header_length
+        self._positions = {(x, y): index for index, (x, y, _, _) in enumerate(self.layout)}
+        self.rooms_served = 0
+        self.merchants_served = 0
+
+    def __len__(self):
+        return len(self.layout)
+
+    def _record(self, index):
+        offset, length = INDEX_ENTRY.unpack_from(self._map, self._index_offset + COUNT.size + index * INDEX_ENTRY.size)
+        return zlib.decompress(self._map[offset:offset + length]).decode("utf-8")
+
+    def has_room(self, x, y):
+        return (x, y) in self._positions
+
+    # The description of the room at a grid position, or None if the pack has no room there
+    def room_at(self, x, y):
+        """Return the pack's description for the room at a position, or None."""
+        index = self._positions.get((x, y))
+        if index is None:
+            return None
+        self.rooms_served += 1
+        return self._record(index)
+
+    # Merchants are handed out in order, each once per game. None once they've all been met.
+    # How many the game has met is kept in its state, so a loaded game carries on with the next one
+    def take_merchant(self, game_state):
+        """Return the game's next merchant description, or None when the pack has run out."""
+        met = game_state.get("pack_merchants_met", 0)
+        if met >= self.merchants:
+            return None
+        game_state["pack_merchants_met"] = met + 1
+        self.merchants_served += 1
+        return self._record(len(self.layout) + met)
+
+    # The castle as the pack lays it out, with every room joined to the room it grew from
+    def graph(self):
+        """Return the pack's layout as a WorldGraph."""
+        world = WorldGraph()
+        world.add_room(0, 0, "castle")
+        for x, y, parent, direction in self.layout:
+            world.connect(parent, DIRECTIONS[direction], world.add_room(x, y))
+        return world
+
+    def close(self):
+        self._map.close()
+
+
+def info(filename):
+    """Print what a world pack holds."""
+    pack = WorldPack(filename)
+    distances = pack.graph().reachable(0)
+    xs = [x for x, _, _, _ in pack.layout]
+    ys = [y for _, y, _, _ in pack.layout]
+    print(f"{filename}: seed {pack.seed}, {len(pack)} rooms, {pack.merchants} merchants, "
+          f"{os.path.getsize(filename) / 1024:.1f} KiB")
+    if pack.layout:
+        print(f"The castle spans x {min(xs)}..{max(xs)}, y {min(ys)}..{max(ys)}, and its farthest room is "
+              f"{max(distances.values())} rooms from the entrance")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate castle content ahead of time.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    make = commands.add_parser("generate", help="generate a pack, or finish an interrupted one")
+    make.add_argument("pack")
+    make.add_argument("--rooms", type=int, default=200)
+    make.add_argument("--merchants", type=int, default=24)
+    make.add_argument("--seed", type=int, default=0)
+    make.add_argument("--workers", type=int, default=8, help="prompts sent at the same time")
+    make.add_argument("--batch", type=int, default=3, help="merchants per prompt")
+    make.add_argument("--requests-per-minute", type=int, default=3500)
+    make.add_argument("--tokens-per-minute", type=int, default=90000)
+    make.add_argument("--stub", type=float, metavar="LATENCY", help="use the offline stub AI model with this latency")
+    commands.add_parser("info", help="describe a pack").add_argument("pack")
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        backend = None
+        limits = {"requests_per_minute": args.requests_per_minute, "tokens_per_minute": args.tokens_per_minute}
+        if args.stub is not None:
+            from stub_llm import StubLLM
+            backend = StubLLM(latency=args.stub, seed=args.seed)
+            limits = {"requests_per_minute": 10 ** 9, "tokens_per_minute": 10 ** 12}  # The stub has no rate limits
+        started = time.perf_counter()
+        counts = generate(args.pack, args.rooms, args.merchants, args.seed, backend=backend, workers=args.workers,
+                          batch_size=args.batch, **limits,
+                          progress=lambda done, total: print(f"\r{done}/{total} prompts", end="", flush=True))
+        elapsed = time.perf_counter() - started
+        print(f"\n{counts['sent']} prompts sent ({counts['reused']} reused from an earlier run) "
+              f"in {elapsed:.1f}s with {args.workers} workers")
+        info(args.pack)
+    else:
+        info(args.pack)
+
+
+if __name__ == "__main__":
+    main()